@@ -1,58 +1,615 @@
 #!/usr/bin/env python
 import os
-from flask import Flask, jsonify, Response, request, abort
+import datetime
+import hashlib
+import json
+import tempfile
+import typing as t
+from flask import Blueprint, Flask, current_app, jsonify, Response, request, abort, stream_with_context
 import xml.etree.ElementTree as ET
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 
-from markr.db.models import db, Student, init_db
-from markr.db.db_helpers import extract_data, get_test_score_summary
+from markr.cache import aggregate_cache, init_cache
+from markr.compression import DecompressionBombError, DecompressionError, UnsupportedEncodingError, decoded_stream
+from markr.db.models import db, Student, Test, init_db, warm_pool
+from markr.export import EXPORT_MIMETYPES, ExportFormatError, check_format, render
+from markr.live import init_live
+from markr.parsing import ParsePoolError, parse_in_parallel
+from markr.jobs import ImportJob, QueueFullError, import_jobs, init_jobs
+from markr.replicas import init_replicas
+from markr.scorestore import init_score_store, score_store
+from markr import metrics
+from markr.db.db_helpers import (
+    DEFAULT_CHUNK_SIZE,
+    UnexpectedDocumentError,
+    SKETCH_BIN_WIDTH,
+    compute_rollup_summary,
+    compute_test_score_summaries,
+    compute_test_score_summary,
+    compute_test_score_timeseries,
+    extract_data,
+    find_import_fingerprint,
+    get_cached_test_score_summary,
+    get_item_analysis,
+    get_student_results,
+    iter_score_batches,
+    iter_test_results,
+    parse_timestamp,
+    rebuild_test_aggregates,
+)
 
-_EXPECTED_DOC_TAG: str = "mcq-test-results"
+bp = Blueprint("markr", __name__, cli_group=None)
 
-app = Flask(__name__)
-init_db(app)
 
-@app.route("/import", methods=["POST"])
+def _import_error_message(e: Exception) -> str:
+    if isinstance(e, ET.ParseError):
+        # Parallel parsing locates the result holding the error.
+        record = getattr(e, "record", None)
+        return f"Unable to read XML at test result {record}" if record else "Unable to read XML"
+    if isinstance(e, UnexpectedDocumentError):
+        return "Unexpected XML format"
+    if isinstance(e, DecompressionError):
+        return f"Unable to decompress body: {e}"
+    return f"Error extracting test data: {e}"
+
+
+def _decoded_body(source: t.BinaryIO, content_encoding: t.Optional[str]) -> t.BinaryIO:
+    return decoded_stream(source, content_encoding, current_app.config["IMPORT_MAX_DECOMPRESSION_RATIO"])
+
+
+def _wants_async_import() -> bool:
+    return (
+        request.args.get("async", "").lower() in ("1", "true")
+        or "respond-async" in request.headers.get("Prefer", "")
+    )
+
+
+def _spool_body() -> t.Tuple[t.BinaryIO, str]:
+    """
+    Copies the request body (as sent, so still compressed) to a temporary
+    file, held in memory up to IMPORT_SPOOL_MEMORY bytes. Returns the file
+    and the body's SHA-256 hex digest.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=current_app.config["IMPORT_SPOOL_MEMORY"])
+    digest = hashlib.sha256()
+    while True:
+        block = request.stream.read(64 * 1024)
+        if not block:
+            break
+        digest.update(block)
+        spool.write(block)
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def _import_message(processed: int, skipped: int) -> str:
+    message = f"Added/modified {processed} test scores"
+    if skipped:
+        message += f", skipped {skipped} duplicates"
+    return message
+
+
+def _import_records(body: t.BinaryIO, content_length: t.Optional[int]) -> t.Iterable[t.Any]:
+    """
+    Large uploads are parsed by a pool of processes when IMPORT_PARSE_WORKERS
+    is set, others as a stream on the current thread.
+    """
+    workers = current_app.config["IMPORT_PARSE_WORKERS"]
+    if workers and (content_length or 0) >= current_app.config["IMPORT_PARSE_MIN_BYTES"]:
+        return parse_in_parallel(body, workers, current_app.config["IMPORT_PARSE_CHUNK_BYTES"])
+    return iter_test_results(body)
+
+
+def _import_options(payload_digest: t.Optional[str]) -> t.Dict[str, t.Any]:
+    return {
+        "chunk_size": current_app.config["IMPORT_CHUNK_SIZE"],
+        "fingerprint_retention": current_app.config["IMPORT_FINGERPRINT_RETENTION"] or None,
+        "payload_digest": payload_digest,
+        "parallelism": current_app.config["IMPORT_PARALLELISM"],
+        "max_retries": current_app.config["IMPORT_MAX_RETRIES"],
+    }
+
+
+@bp.route("/import", methods=["POST"])
 def import_xml() -> Response:
     """
     Accepts XML formatted test scores to be processed and added to the DB.
+
+    By default the import runs within the request and either every result is
+    added or none are. With ?async=1 (or a `Prefer: respond-async` header) 
+    the body is spooled and a 202 is returned immediately with the ID of a
+    background job, whose progress is reported by /import/jobs/<id>. The job
+    has the same all-or-nothing semantics. If too many jobs are pending the 
+    request is refused with a 429. With IMPORT_PARALLELISM above 1, results
+    are written by concurrent transactions once they have all been 
+    validated, and partitions written before a database error are kept.
+
+    Bodies may be compressed with gzip, deflate or zstd, as given by the
+    Content-Encoding header. They are decompressed as they are parsed.
+
+    An upload identical to one already imported is answered straight away,
+    and results identical to ones already imported are skipped. Both are
+    reported as duplicates.
     """
     if request.content_type != 'text/xml+markr':
         abort(400, "content_type must be text/xml+markr")
 
-    root = ""
-    try: 
-        root = ET.fromstring(request.data)
-    except ET.ParseError: 
-        abort(400, "Unable to read XML")
-    
-    if root.tag != _EXPECTED_DOC_TAG:
-        abort(400, "Unexpected XML format")
-    
-    entries = 0
+    # The body must be read in full to fingerprint it before any DB work, so 
+    # it is spooled. Otherwise it is parsed straight off the request stream.
+    payload_digest = None
+    if current_app.config["IMPORT_FINGERPRINT_RETENTION"] or _wants_async_import():
+        source, payload_digest = _spool_body()
+    else:
+        source = request.stream
+
     try:
-       entries = extract_data(root)
-    except RuntimeError as e: 
-        abort(400, f"Error extracting test data: {e}")
+        body = _decoded_body(source, request.headers.get("Content-Encoding"))
+    except UnsupportedEncodingError as e:
+        abort(415, str(e))
+
+    if current_app.config["IMPORT_FINGERPRINT_RETENTION"]:
+        previous = find_import_fingerprint(payload_digest)
+        if previous is not None:
+            metrics.import_duplicates_total.inc(previous.records, kind="payload")
+            return jsonify(_import_message(0, previous.records))
+    else:
+        payload_digest = None
+
+    if _wants_async_import():
+        return _submit_import_job(source, body, payload_digest, request.content_length)
+
+    # Results are parsed one at a time (or one chunk per parse worker), so 
+    # the full document is never held in memory.
+    try:
+        result = extract_data(_import_records(body, request.content_length), **_import_options(payload_digest))
+    except DecompressionBombError as e:
+        abort(413, _import_error_message(e))
+    except ParsePoolError as e:
+        # Not the upload's fault, so it may be retried.
+        abort(503, str(e))
+    except (ET.ParseError, RuntimeError) as e: 
+        abort(400, _import_error_message(e))
+
+    return jsonify(_import_message(result.processed, result.skipped))
+
+
+def _submit_import_job(
+    spool: t.BinaryIO, body: t.BinaryIO, payload_digest: t.Optional[str], content_length: t.Optional[int]
+) -> Response:
+    app = current_app._get_current_object()
+
+    def run(job: ImportJob) -> int:
+        try:
+            with app.app_context():
+                result = extract_data(
+                    _import_records(body, content_length),
+                    on_progress=job.set_progress,
+                    **_import_options(payload_digest),
+                )
+                job.records_skipped = result.skipped
+                return result.processed
+        except (ET.ParseError, RuntimeError) as e:
+            raise RuntimeError(_import_error_message(e)) from e
+        finally:
+            spool.close()
+
+    try:
+        job = import_jobs.submit(run, current_app.extensions["markr_job_store"])
+    except QueueFullError as e:
+        spool.close()
+        abort(429, str(e))
+    except Exception:
+        spool.close()
+        raise
+
+    resp = jsonify(job.to_dict())
+    resp.status_code = 202
+    resp.headers["Location"] = f"/import/jobs/{job.id}"
+    return resp
+
+
+@bp.route("/import/jobs/<job_id>", methods=["GET"])
+def import_job_status(job_id: str) -> Response:
+    """
+    Reports the status, progress, record count, error and timings of an
+    asynchronous import. Jobs run by other worker processes are reported
+    as last saved, so without their progress until they finish.
+    """
+    job = import_jobs.get(job_id, current_app.extensions["markr_job_store"])
+    if job is None:
+        abort(404, f"No import job found with ID {job_id}")
+    return jsonify(job.to_dict())
 
-    return jsonify(f"Added/modified {entries} test scores")
 
+def _wants_approx() -> bool:
+    return request.args.get("approx", "").lower() in ("1", "true")
 
-@app.route("/results/<test_id>/aggregate", methods=["GET"])
+
+def _parse_window() -> t.Tuple[t.Optional[datetime.datetime], t.Optional[datetime.datetime]]:
+    """
+    Reads the ISO 8601 `from` (inclusive) and `to` (exclusive) query 
+    parameters, either of which may be omitted.
+    """
+    try:
+        return tuple(
+            parse_timestamp(request.args[name]) if request.args.get(name) else None
+            for name in ("from", "to")
+        )
+    except RuntimeError as e:
+        abort(400, f"Invalid time window. Error: {e}")
+
+
+@bp.route("/results/<test_id>/aggregate", methods=["GET"])
 def aggregate_test_results(test_id: str) -> Response:
     """
     Provides aggregate statistics (p50|25|75, mean, stddev etc) 
     pertaining to the given test_id. 
+
+    Responses carry an ETag of the test's aggregate version, so pollers 
+    sending If-None-Match get a 304 until the next import touches the test.
+
+    With ?from= and/or ?to= (ISO 8601 timestamps) only scores scanned in 
+    that window are included. These are computed from the scores on each 
+    request rather than from the running aggregate.
+
+    With ?approx=1 percentiles are estimated from a fixed size sketch of the
+    test's running aggregate (see /results/rollup).
     """
     try: 
         test_id = int(test_id)
     except ValueError:
         abort(400, "Invalid test id supplied. Must be an integer")
+
+    scanned_from, scanned_to = _parse_window()
+    if _wants_approx():
+        if scanned_from or scanned_to:
+            abort(400, "approx is not supported with a time window")
+        try:
+            summary, _ = compute_rollup_summary([test_id], approx=True)
+        except RuntimeError as e: 
+            abort(400, f"Unable to retrieve score summary. Error: {e}")
+        return jsonify({**summary, "quantile_error": SKETCH_BIN_WIDTH / 2})
+
+    if scanned_from or scanned_to:
+        try:
+            return jsonify(compute_test_score_summary(test_id, scanned_from, scanned_to))
+        except RuntimeError as e: 
+            abort(400, f"Unable to retrieve score summary. Error: {e}")
     
     try:
-        resp = get_test_score_summary(int(test_id))
+        summary, version = get_cached_test_score_summary(test_id)
     except RuntimeError as e: 
         abort(400, f"Unable to retrieve score summary. Error: {e}")
 
+    etag = f"{test_id}-{version}" if version is not None else None
+    if etag and request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(summary)
+    if etag:
+        resp.set_etag(etag)
+    return resp
+
+
+@bp.route("/results/<test_id>/timeseries", methods=["GET"])
+def test_results_timeseries(test_id: str) -> Response:
+    """
+    Provides aggregate statistics for the given test_id per ?bucket= (hour,
+    day, week, month or year, default day) in which its scores were 
+    scanned, optionally limited to a ?from=&to= window.
+    """
+    try: 
+        test_id = int(test_id)
+    except ValueError:
+        abort(400, "Invalid test id supplied. Must be an integer")
+
+    scanned_from, scanned_to = _parse_window()
+    try:
+        series = compute_test_score_timeseries(
+            test_id, request.args.get("bucket", "day"), scanned_from, scanned_to
+        )
+    except RuntimeError as e: 
+        abort(400, f"Unable to retrieve score time series. Error: {e}")
+
+    return jsonify({"test_id": test_id, "bucket": request.args.get("bucket", "day"), "series": series})
+
+
+@bp.route("/results/<test_id>/items", methods=["GET"])
+def item_analysis(test_id: str) -> Response:
+    """
+    Provides per-question statistics (facility, chosen option distribution
+    and point-biserial correlation) for the given test_id.
+    """
+    try: 
+        test_id = int(test_id)
+    except ValueError:
+        abort(400, "Invalid test id supplied. Must be an integer")
+
+    try:
+        resp = get_item_analysis(test_id)
+    except RuntimeError as e: 
+        abort(400, f"Unable to retrieve item analysis. Error: {e}")
+
+    return jsonify(resp)
+
+
+@bp.route("/students/<student_id>/results", methods=["GET"])
+def student_results(student_id: str) -> Response:
+    """
+    Provides the given student's score in every test they have sat, with 
+    their percentile rank within each test: the percentage of the test's 
+    scores below theirs, counting half of those equal to it.
+    """
+    try: 
+        student_id = int(student_id)
+    except ValueError:
+        abort(400, "Invalid student id supplied. Must be an integer")
+
+    try:
+        resp = get_student_results(student_id)
+    except RuntimeError as e: 
+        abort(400, f"Unable to retrieve student results. Error: {e}")
+
     return jsonify(resp)
 
 
+def _parse_test_ids(spec: t.Union[str, t.List[t.Union[int, str]]]) -> t.List[int]:
+    """
+    Parses a list of test IDs, given either as a list or as a comma separated
+    string where each item is an ID or an inclusive range, e.g. "1,4,10-20".
+    """
+    max_ids = current_app.config["BATCH_AGGREGATE_MAX_IDS"]
+    items = spec.split(",") if isinstance(spec, str) else spec
+    test_ids = []
+    for item in items:
+        item = str(item).strip()
+        if not item:
+            continue
+        start, dash, end = item.partition("-")
+        if dash and not (start.strip() and end.strip()):
+            raise ValueError(f"Range {item} needs both a start and an end")
+        ids = range(int(start), int(end or start) + 1)
+        if not ids:
+            raise ValueError(f"Range {item} ends before it starts")
+        # Checked before ranges expand to every ID between the bounds.
+        if len(test_ids) + len(ids) > max_ids:
+            raise ValueError(f"At most {max_ids} test ids may be requested")
+        test_ids.extend(ids)
+    return list(dict.fromkeys(test_ids))
+
+
+def _requested_test_ids() -> t.List[int]:
+    """
+    Parses the test IDs a request asks for, from its JSON body 
+    {"test_ids": [...]} if POSTed and otherwise from ?test_ids=. Aborts with
+    400 unless at least one valid ID is given.
+    """
+    try:
+        if request.method == "POST":
+            body = request.get_json(silent=True) or {}
+            if not isinstance(body, dict):
+                raise ValueError('Expected a JSON object {"test_ids": [...]}')
+            test_ids = _parse_test_ids(body.get("test_ids", []))
+        else:
+            test_ids = _parse_test_ids(request.args.get("test_ids", ""))
+    except (TypeError, ValueError) as e:
+        abort(400, f"Invalid test ids supplied: {e}")
+    if not test_ids:
+        abort(400, "No test ids supplied")
+    return test_ids
+
+
+@bp.route("/results/aggregate", methods=["GET", "POST"])
+def batch_aggregate_test_results() -> Response:
+    """
+    Provides aggregate statistics for many tests at once. Test IDs are given
+    by the `test_ids` query parameter (e.g. ?test_ids=1,4,10-20) or as a JSON
+    body {"test_ids": [...]}.
+
+    Responds with {"results": {test_id: stats}, "errors": {test_id: message}},
+    or, when the client accepts application/x-ndjson, streams one JSON object
+    per test so very large requests need not be built up in memory.
+    """
+    test_ids = _requested_test_ids()
+
+    if request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        block_size = current_app.config["BATCH_AGGREGATE_BLOCK_SIZE"]
+
+        def generate():
+            for i in range(0, len(test_ids), block_size):
+                block = test_ids[i:i + block_size]
+                summaries, errors = compute_test_score_summaries(block)
+                for test_id in block:
+                    if test_id in summaries:
+                        line = {"test_id": test_id, "summary": summaries[test_id]}
+                    else:
+                        line = {"test_id": test_id, "error": errors[test_id]}
+                    yield json.dumps(line) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    summaries, errors = compute_test_score_summaries(test_ids)
+    return jsonify({"results": summaries, "errors": errors})
+
+
+@bp.route("/results/rollup", methods=["GET", "POST"])
+def rollup_test_results() -> Response:
+    """
+    Provides aggregate statistics over the scores of several tests combined, 
+    e.g. a school's tests for a term. Test IDs are given as for 
+    /results/aggregate. Computed from each test's running aggregate, so the
+    cost does not grow with the number of scores.
+
+    With ?approx=1 the sketch imports keep for each test is merged instead,
+    percentiles being accurate to within the reported quantile_error 
+    (percentage points), and the mean and stddev to within 0.01.
+
+    Responds with {"summary": stats, "missing": [test IDs with no scores]}.
+    """
+    test_ids = _requested_test_ids()
+
+    approx = _wants_approx()
+    try:
+        summary, missing = compute_rollup_summary(test_ids, approx=approx)
+    except RuntimeError as e: 
+        abort(400, f"Unable to retrieve rollup. Error: {e}")
+
+    resp = {"summary": summary, "missing": missing}
+    if approx:
+        resp["quantile_error"] = SKETCH_BIN_WIDTH / 2
+    return jsonify(resp)
+
+
+def _export_scores(test_id: t.Optional[int]) -> Response:
+    """
+    Streams scores in the format chosen by ?format= (ndjson, csv or parquet)
+    or else by the Accept header, defaulting to NDJSON.
+    """
+    fmt = request.args.get("format")
+    if fmt is None:
+        mimetype = next(iter(EXPORT_MIMETYPES))
+        if request.accept_mimetypes:
+            mimetype = request.accept_mimetypes.best_match(list(EXPORT_MIMETYPES))
+        if mimetype is None:
+            abort(406, f"Scores can be exported as {', '.join(EXPORT_MIMETYPES)}")
+        fmt = EXPORT_MIMETYPES[mimetype]
+    try:
+        check_format(fmt)
+    except ExportFormatError as e:
+        abort(406, str(e))
+
+    batches = iter_score_batches(test_id, batch_size=current_app.config["EXPORT_BATCH_SIZE"])
+    mimetype = next(mimetype for mimetype, name in EXPORT_MIMETYPES.items() if name == fmt)
+    name = f"scores-{test_id}" if test_id is not None else "scores"
+    resp = Response(stream_with_context(render(batches, fmt)), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{name}.{fmt}"'
+    return resp
+
+
+@bp.route("/results/<test_id>/scores", methods=["GET"])
+def export_test_scores(test_id: str) -> Response:
+    """
+    Exports every score of the given test_id with the student's name, as
+    NDJSON, CSV or Parquet. Rows are streamed from a server side cursor, so
+    memory stays flat however many scores the test has.
+    """
+    try: 
+        test_id = int(test_id)
+    except ValueError:
+        abort(400, "Invalid test id supplied. Must be an integer")
+
+    if db.session.get(Test, test_id) is None:
+        abort(400, f"No test found with test ID {test_id}")
+    return _export_scores(test_id)
+
+
+@bp.route("/results/scores", methods=["GET"])
+def export_all_scores() -> Response:
+    """
+    Exports every score of every test, as /results/<test_id>/scores does.
+    """
+    return _export_scores(None)
+
+
+@bp.route("/metrics", methods=["GET"])
+def prometheus_metrics() -> Response:
+    """
+    Exposes import and aggregate instrumentation in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/cache/stats", methods=["GET"])
+def cache_stats() -> Response:
+    """
+    Reports the aggregate cache's size and hit rate.
+    """
+    return jsonify(aggregate_cache.stats())
+
+
+@bp.route("/healthz", methods=["GET"])
+def healthz() -> Response:
+    """
+    Liveness check: the process is up and serving requests.
+    """
+    return jsonify({"status": "ok"})
+
+
+@bp.route("/readyz", methods=["GET"])
+def readyz() -> Response:
+    """
+    Readiness check: the database answers a trivial query. Also reports 
+    whether the background connection pool warm-up has finished.
+    """
+    try:
+        db.session.execute(text("SELECT 1"))
+    except SQLAlchemyError as e:
+        resp = jsonify({"status": "unavailable", "error": str(e.__cause__ or e)})
+        resp.status_code = 503
+        return resp
+    return jsonify({"status": "ready", "pool_warm": current_app.extensions.get("markr_pool_warm", False)})
+
+
+@bp.cli.command("rebuild-aggregates")
+def rebuild_aggregates_command():
+    """
+    Recomputes the running aggregate of every test from its stored scores.
+    """
+    print(f"Rebuilt aggregates for {rebuild_test_aggregates()} tests")
+
+
+def create_app(warm: bool = False) -> Flask:
+    """
+    Builds the markr app from the environment. 
+
+    Creating the app does not touch the database (except for the in-memory 
+    test database, whose schema is created on the spot) or import numpy, so
+    workers boot quickly and even while the database is down. Schema changes
+    are applied explicitly with `flask db upgrade`. With warm, the connection 
+    pool is filled in the background, see /readyz, and the score store's
+    snapshot is mapped.
+
+    Markr runs one app per process: the aggregate cache, import queue,
+    replica router and score store are process-wide, and creating another
+    app reconfigures them for it, under any app already created. Use
+    markr.app.app rather than creating a second one.
+    """
+    app = Flask(__name__)
+    app.config["IMPORT_CHUNK_SIZE"] = int(os.getenv("IMPORT_CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+    # Compressed uploads expanding by more than this ratio are refused (0 disables the check).
+    app.config["IMPORT_MAX_DECOMPRESSION_RATIO"] = float(os.getenv("IMPORT_MAX_DECOMPRESSION_RATIO", 200))
+    # How long (seconds) upload and test result fingerprints are kept for skipping duplicate imports. 0 disables deduplication.
+    app.config["IMPORT_FINGERPRINT_RETENTION"] = float(os.getenv("IMPORT_FINGERPRINT_RETENTION", 7 * 24 * 3600))
+    # Processes parsing large uploads (0 parses on the request thread). 
+    # Uploads of at least IMPORT_PARSE_MIN_BYTES are split into chunks of 
+    # about IMPORT_PARSE_CHUNK_BYTES, parsed and validated in parallel.
+    app.config["IMPORT_PARSE_WORKERS"] = int(os.getenv("IMPORT_PARSE_WORKERS", 0))
+    app.config["IMPORT_PARSE_MIN_BYTES"] = int(os.getenv("IMPORT_PARSE_MIN_BYTES", 4 * 1024 * 1024))
+    app.config["IMPORT_PARSE_CHUNK_BYTES"] = int(os.getenv("IMPORT_PARSE_CHUNK_BYTES", 1024 * 1024))
+    # Concurrent transactions writing each import, partitioned by test. Above 1
+    # an import is validated in full before writing, and is no longer 
+    # all-or-nothing once writing starts.
+    app.config["IMPORT_PARALLELISM"] = int(os.getenv("IMPORT_PARALLELISM", 1))
+    # Times a parallel import's transaction is retried after a deadlock.
+    app.config["IMPORT_MAX_RETRIES"] = int(os.getenv("IMPORT_MAX_RETRIES", 3))
+    app.config["BATCH_AGGREGATE_MAX_IDS"] = int(os.getenv("BATCH_AGGREGATE_MAX_IDS", 100_000))
+    # Number of tests summarised per query when streaming batch aggregates.
+    app.config["BATCH_AGGREGATE_BLOCK_SIZE"] = int(os.getenv("BATCH_AGGREGATE_BLOCK_SIZE", 1000))
+    # Scores fetched from the DB (and held in memory) at a time by exports.
+    app.config["EXPORT_BATCH_SIZE"] = int(os.getenv("EXPORT_BATCH_SIZE", 5000))
+    init_db(app)
+    init_cache(app)
+    init_jobs(app)
+    init_replicas(app)
+    init_live(app)
+    init_score_store(app)
+    metrics.init_metrics(app)
+    app.register_blueprint(bp)
+    if warm:
+        warm_pool(app)
+        score_store.start(app, app.config["SCORE_STORE_SNAPSHOT_SECONDS"])
+    return app
+
+
+app = create_app()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Benchmarks for markr's hot paths: /import throughput and memory, parsing
+throughput against the number of parse processes, /results/<test_id>/aggregate
+latency as the number of scores per test grows, /students/<id>/results
+latency as the table grows, and cold start (importing the app and serving
+its first request).
+
+Each case runs in a fresh process so peak RSS is measured per case. Results
+are written as JSON, and can be compared against an earlier run to catch
+regressions:
+
+    python -m markr.benchmarks.bench --output before.json
+    ... make changes ...
+    python -m markr.benchmarks.bench --output after.json --compare before.json
+
+By default cases run against an in-memory SQLite database. Pass
+--database-url (e.g. postgresql+psycopg2://postgres:pw@localhost/markr_bench)
+to run against Postgres instead. The tables in that database are emptied
+before every case, so never point it at real data.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import typing as t
+
+# Metrics where a larger value is better; for every other metric smaller is better.
+_HIGHER_IS_BETTER = ("records_per_second", "mb_per_second")
+
+
+def _configure_env(database_url: t.Optional[str]):
+    if database_url:
+        os.environ["DATABASE_URL"] = database_url
+    else:
+        os.environ["RUN_ENV"] = "TESTING"
+
+
+def _reset_db(app):
+    from markr.db.models import db
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def _gen_mocks(records: int, students_per_test: int, answers: int, dup_ratio: float, seed: int = 0):
+    """
+    Builds `records` results spread over tests of `students_per_test` students.
+    A `dup_ratio` fraction of them repeat an earlier student/test pair.
+    """
+    from markr.tests.test_import import MockData
+
+    rng = random.Random(seed)
+    mocks = []
+    for i in range(records):
+        if mocks and rng.random() < dup_ratio:
+            previous = rng.choice(mocks)
+            student_number, test_id = previous.student_number, previous.test_id
+        else:
+            student_number, test_id = i, i // students_per_test
+        mocks.append(MockData(
+            student_number=student_number,
+            test_id=test_id,
+            available_marks=max(answers, 20),
+            obtained_marks=rng.randrange(max(answers, 20) + 1),
+            answers=answers,
+        ))
+    return mocks
+
+
+def _peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _import_case(params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    _configure_env(database_url)
+    from markr.app import app
+    from markr.tests.test_import import gen_input
+
+    _reset_db(app)
+    app.config["IMPORT_PARALLELISM"] = params.get("parallelism", 1)
+    body = gen_input(_gen_mocks(
+        params["records"], params["students_per_test"], params["answers"], params["dup_ratio"]
+    )).encode()
+    baseline_rss = _peak_rss_kb()
+
+    with app.test_client() as client:
+        start = time.perf_counter()
+        resp = client.post("/import", data=body, content_type="text/xml+markr")
+        elapsed = time.perf_counter() - start
+    if resp.status_code != 200:
+        raise RuntimeError(f"Import failed: {resp.status_code} {resp.text}")
+
+    return {
+        "seconds": elapsed,
+        "records_per_second": params["records"] / elapsed,
+        "mb_per_second": len(body) / 1e6 / elapsed,
+        "upload_mb": len(body) / 1e6,
+        "peak_rss_kb": _peak_rss_kb(),
+        "rss_growth_kb": _peak_rss_kb() - baseline_rss,
+    }
+
+
+def _aggregate_case(params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    _configure_env(database_url)
+    import numpy as np
+    from markr.app import app
+    from markr.cache import aggregate_cache
+    from markr.db.db_helpers import compute_test_score_summary, get_test_score_summary
+    from markr.scorestore import score_store
+    from markr.tests.test_import import gen_input
+
+    _reset_db(app)
+    scores = params["scores_per_test"]
+    mocks = _gen_mocks(scores, scores, answers=0, dup_ratio=0)
+    with app.test_client() as client:
+        for i in range(0, scores, 20_000):
+            client.post("/import", data=gen_input(mocks[i:i + 20_000]), content_type="text/xml+markr")
+
+        def timed(request: t.Callable[[], t.Any]) -> t.List[float]:
+            latencies = []
+            for _ in range(params["requests"]):
+                start = time.perf_counter()
+                request()
+                latencies.append((time.perf_counter() - start) * 1000)
+            return latencies
+
+        def cold_get():
+            aggregate_cache.clear()
+            client.get("/results/0/aggregate")
+
+        def direct():
+            with app.app_context():
+                compute_test_score_summary(0)
+
+        def stored():
+            with app.app_context():
+                get_test_score_summary(0)
+
+        cold = timed(cold_get)
+        warm = timed(lambda: client.get("/results/0/aggregate"))
+        scan = timed(direct)
+        # Summaries from the score store, once it has loaded the test.
+        score_store.configure(1024 ** 3, min_reads=1)
+        stored()
+        store = timed(stored)
+        score_store.configure(0)
+
+    metrics = {}
+    for name, latencies in (("cold", cold), ("warm", warm), ("scan", scan), ("store", store)):
+        metrics[f"{name}_p50_ms"] = float(np.percentile(latencies, 50))
+        metrics[f"{name}_p99_ms"] = float(np.percentile(latencies, 99))
+    return metrics
+
+
+def _student_case(params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    """
+    Latency of /students/<id>/results for a student who sat 20 tests, as the
+    number of stored scores grows.
+    """
+    _configure_env(database_url)
+    import numpy as np
+    from markr.app import app
+    from markr.tests.test_import import gen_input
+
+    _reset_db(app)
+    scores = params["scores"]
+    students_per_test = max(scores // 20, 1)
+    mocks = _gen_mocks(scores, students_per_test, answers=0, dup_ratio=0)
+    # The first result of each of the (up to 20) tests is the student's.
+    student_number = scores
+    for mock in mocks[:20 * students_per_test:students_per_test]:
+        mock.student_number = student_number
+    with app.test_client() as client:
+        for i in range(0, scores, 20_000):
+            client.post("/import", data=gen_input(mocks[i:i + 20_000]), content_type="text/xml+markr")
+
+        latencies = []
+        for _ in range(params["requests"]):
+            start = time.perf_counter()
+            resp = client.get(f"/students/{student_number}/results")
+            latencies.append((time.perf_counter() - start) * 1000)
+    if resp.status_code != 200:
+        raise RuntimeError(f"Student results failed: {resp.status_code} {resp.text}")
+
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def _parse_case(params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    """
+    Parsing and validation alone, on the current thread (workers=0) or in a
+    pool of parse processes, to show how parsing scales with cores.
+    """
+    _configure_env(database_url)
+    import io
+    from markr.db.db_helpers import ScoreData, iter_test_results
+    from markr.parsing import parse_in_parallel, shutdown_parse_pool
+    from markr.tests.test_import import gen_input
+
+    body = gen_input(_gen_mocks(params["records"], 500, params["answers"], dup_ratio=0)).encode()
+    workers = params["workers"]
+    if workers:
+        # Start the pool's processes before timing.
+        list(parse_in_parallel(io.BytesIO(gen_input(_gen_mocks(workers * 2, 500, 0, 0)).encode()), workers, 64))
+
+    start = time.perf_counter()
+    if workers:
+        count = sum(1 for _ in parse_in_parallel(io.BytesIO(body), workers))
+    else:
+        count = sum(1 for _ in map(ScoreData, iter_test_results(io.BytesIO(body))))
+    elapsed = time.perf_counter() - start
+    shutdown_parse_pool()
+    if count != params["records"]:
+        raise RuntimeError(f"Parsed {count} of {params['records']} records")
+
+    return {
+        "seconds": elapsed,
+        "records_per_second": count / elapsed,
+        "mb_per_second": len(body) / 1e6 / elapsed,
+    }
+
+
+def _startup_case(params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    _configure_env(database_url)
+    start = time.perf_counter()
+    from markr.app import app
+    imported = time.perf_counter()
+
+    with app.test_client() as client:
+        resp = client.get("/healthz")
+    served = time.perf_counter()
+    if resp.status_code != 200:
+        raise RuntimeError(f"Health check failed: {resp.status_code} {resp.text}")
+
+    return {
+        "import_seconds": imported - start,
+        "first_request_ms": (served - imported) * 1000,
+        # Heavy libraries should only be loaded by the requests that need them.
+        "numpy_loaded": float("numpy" in sys.modules),
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+
+
+_CASES = {"import": _import_case, "aggregate": _aggregate_case, "parse": _parse_case, "student": _student_case, "startup": _startup_case}
+
+
+def _run_isolated(name: str, params: t.Dict[str, t.Any], database_url: t.Optional[str]) -> t.Dict[str, float]:
+    # Executor workers aren't daemons, so cases can start processes of their own.
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+        return pool.submit(_CASES[name], params, database_url).result()
+
+
+def _git_commit() -> t.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: t.Dict[str, t.Any], baseline: t.Dict[str, t.Any], tolerance: float) -> t.List[str]:
+    """
+    Lists every metric that is more than `tolerance` (a fraction) worse than
+    the matching case in the baseline run.
+    """
+    key = lambda result: (result["name"], json.dumps(result["params"], sort_keys=True))
+    baseline_results = {key(result): result for result in baseline["results"]}
+
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_results.get(key(result))
+        if previous is None:
+            continue
+        for metric, value in result["metrics"].items():
+            before = previous["metrics"].get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            if metric in _HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{result['name']} {result['params']} {metric}: {before:.4g} -> {value:.4g} ({change:+.0%} worse)"
+                )
+    return regressions
+
+
+def _int_list(value: str) -> t.List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=None, help="Database to benchmark against (default: in-memory SQLite)")
+    parser.add_argument("--records", type=_int_list, default=[1_000, 10_000], help="Records per upload")
+    parser.add_argument("--students-per-test", type=int, default=500)
+    parser.add_argument("--answers", type=int, default=20, help="Answers per record")
+    parser.add_argument(
+        "--parallelism", type=_int_list, default=[1],
+        help="Import write parallelism (in-memory SQLite always writes serially)",
+    )
+    parser.add_argument("--dup-ratio", type=float, default=0.05, help="Fraction of records repeating an earlier student/test")
+    parser.add_argument(
+        "--parse-workers", type=_int_list, default=[0, 1, 2, 4],
+        help="Parse processes to time parsing with (0 parses on the current thread)",
+    )
+    parser.add_argument("--parse-records", type=int, default=50_000, help="Records per upload for parse cases")
+    parser.add_argument("--scores-per-test", type=_int_list, default=[100, 10_000, 100_000])
+    parser.add_argument("--requests", type=int, default=100, help="Aggregate requests timed per case")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="Earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed fractional slowdown before flagging")
+    args = parser.parse_args(argv)
+
+    cases = [("startup", {})] + [
+        ("import", {
+            "records": records,
+            "students_per_test": args.students_per_test,
+            "answers": args.answers,
+            "dup_ratio": args.dup_ratio,
+            "parallelism": parallelism,
+        })
+        for records in args.records
+        for parallelism in args.parallelism
+    ] + [
+        ("parse", {"records": args.parse_records, "answers": args.answers, "workers": workers})
+        for workers in args.parse_workers
+    ] + [
+        ("aggregate", {"scores_per_test": scores, "requests": args.requests})
+        for scores in args.scores_per_test
+    ] + [
+        ("student", {"scores": scores, "requests": args.requests})
+        for scores in args.scores_per_test
+    ]
+
+    results = []
+    for name, params in cases:
+        metrics = _run_isolated(name, params, args.database_url)
+        results.append({"name": name, "params": params, "metrics": metrics})
+        print(f"{name} {params}: " + ", ".join(f"{k}={v:.4g}" for k, v in metrics.items()))
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "database": "postgresql" if args.database_url and args.database_url.startswith("postgres") else "sqlite",
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
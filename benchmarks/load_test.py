@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Closed-loop HTTP load test for a running markr server, used to compare
+serving modes, e.g. the Flask dev server against gunicorn:
+
+    python -m markr.benchmarks.load_test --url http://localhost:4567 --seed
+
+Each of --concurrency threads issues requests back to back for --duration
+seconds. Throughput and latency percentiles are printed as JSON.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import typing as t
+import urllib.error
+import urllib.request
+
+
+def _request(url: str, data: t.Optional[bytes] = None, content_type: t.Optional[str] = None) -> int:
+    req = urllib.request.Request(url, data=data)
+    if content_type:
+        req.add_header("Content-Type", content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def seed(base_url: str):
+    """
+    Imports the sample data used by the unit tests.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "sample_data.xml")
+    with open(path, "rb") as f:
+        status = _request(f"{base_url}/import", f.read(), "text/xml+markr")
+    if status != 200:
+        raise RuntimeError(f"Seeding failed with status {status}")
+
+
+def run(url: str, concurrency: int, duration: float) -> t.Dict[str, t.Any]:
+    latencies: t.List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status = _request(url)
+            local.append(time.perf_counter() - start)
+            failed += status >= 400
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    percentile = lambda q: latencies[min(int(q / 100 * len(latencies)), len(latencies) - 1)] * 1000 if latencies else None
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:4567")
+    parser.add_argument("--path", default="/results/9863/aggregate")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed", action="store_true", help="Import the sample data before the run")
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.url)
+    print(json.dumps(run(f"{args.url}{args.path}", args.concurrency, args.duration), indent=2))
+
+
+if __name__ == "__main__":
+    main()
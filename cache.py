@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import typing as t
+from collections import OrderedDict
+
+from markr import metrics
+from markr.signals import import_committed
+
+# A cached summary: the statistics dictionary and the aggregate version it
+# was computed from.
+CacheEntry = t.Tuple[t.Dict[str, t.Union[float, int]], t.Optional[int]]
+
+
+class CacheBackend:
+    """
+    Storage used by the AggregateCache. Backends must be safe to use from
+    multiple threads.
+    """
+    # Whether every worker process uses the same store, so an import's 
+    # invalidation reaches them all.
+    shared = False
+
+    def get(self, key: int) -> t.Optional[CacheEntry]:
+        raise NotImplementedError
+
+    def set(self, key: int, value: CacheEntry):
+        raise NotImplementedError
+
+    def delete(self, keys: t.Iterable[int]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def size(self) -> t.Optional[int]:
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Bounded, in-process LRU store. Each worker process has its own copy, so
+    it only sees invalidations for imports handled by that process. Entries
+    made stale by other processes are caught by AggregateCache's version
+    check.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: int) -> t.Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: int, value: CacheEntry):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys: t.Iterable[int]):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Store shared by every worker, for multi-process deployments. Entries
+    expire after ttl seconds; bounding memory is left to Redis' own
+    maxmemory eviction policy. An import in any process deletes its tests'
+    entries for every process.
+    """
+    _PREFIX = "markr:aggregate:"
+    shared = True
+
+    def __init__(self, url: str, ttl: int):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is required to use a shared aggregate cache")
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: int) -> t.Optional[CacheEntry]:
+        raw = self._client.get(f"{self._PREFIX}{key}")
+        if raw is None:
+            return None
+        summary, version = json.loads(raw)
+        return summary, version
+
+    def set(self, key: int, value: CacheEntry):
+        self._client.set(f"{self._PREFIX}{key}", json.dumps(value), ex=self.ttl)
+
+    def delete(self, keys: t.Iterable[int]):
+        names = [f"{self._PREFIX}{key}" for key in keys]
+        if names:
+            self._client.delete(*names)
+
+    def clear(self):
+        self.delete(int(name[len(self._PREFIX):]) for name in self._keys())
+
+    def size(self) -> int:
+        return sum(1 for _ in self._keys())
+
+    def _keys(self) -> t.Iterator[str]:
+        for name in self._client.scan_iter(match=f"{self._PREFIX}*"):
+            yield name.decode()
+
+
+class AggregateCache:
+    """
+    Caches aggregate summaries by test ID. Entries are dropped whenever an
+    import touching their test is committed. Unless the backend is shared,
+    imports handled by another process are noticed by checking an entry's 
+    version before using it.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get_or_compute(
+        self,
+        test_id: int,
+        compute: t.Callable[[int, t.Optional[int]], CacheEntry],
+        current_version: t.Optional[t.Callable[[int], t.Optional[int]]] = None,
+    ) -> CacheEntry:
+        """
+        Returns the cached entry for test_id, or computes and caches it.
+
+        Input:
+        - compute: function computing a test's entry, given its current 
+          version (None if unknown)
+        - current_version: function returning a test's current aggregate 
+          version. Unless the backend is shared, an entry computed from 
+          another version is recomputed. Entries are always computed given
+          the current version.
+        """
+        entry = self.backend.get(test_id)
+        if entry is not None and (current_version is None or self.backend.shared):
+            self.hits += 1
+            return entry
+
+        version = current_version(test_id) if current_version is not None else None
+        if entry is not None:
+            if entry[1] == version:
+                self.hits += 1
+                return entry
+            self.stale += 1
+
+        self.misses += 1
+        entry = compute(test_id, version)
+        self.backend.set(test_id, entry)
+        return entry
+
+    def invalidate(self, test_ids: t.Iterable[int]):
+        self.backend.delete(test_ids)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> t.Dict[str, t.Union[int, float, str, None]]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stale": self.stale,
+            "evictions": getattr(self.backend, "evictions", None),
+        }
+
+
+aggregate_cache = AggregateCache(MemoryCacheBackend(max_size=1024))
+metrics.register_gauge("markr_aggregate_cache_size", "Entries in the aggregate cache.", lambda: aggregate_cache.backend.size() or 0)
+metrics.register_gauge("markr_aggregate_cache_hits", "Aggregate cache hits since startup.", lambda: aggregate_cache.hits)
+metrics.register_gauge("markr_aggregate_cache_misses", "Aggregate cache misses since startup.", lambda: aggregate_cache.misses)
+
+
+@import_committed.connect
+def _invalidate_imported_tests(sender, test_ids: t.FrozenSet[int]):
+    aggregate_cache.invalidate(test_ids)
+
+
+def init_cache(app):
+    """
+    Configures the aggregate cache backend from the environment.
+
+    AGGREGATE_CACHE_URL selects a shared Redis store (e.g. redis://cache:6379/0),
+    otherwise an in-process LRU of AGGREGATE_CACHE_SIZE entries is used.
+    """
+    app.config.setdefault("AGGREGATE_CACHE_URL", os.getenv("AGGREGATE_CACHE_URL"))
+    app.config.setdefault("AGGREGATE_CACHE_SIZE", int(os.getenv("AGGREGATE_CACHE_SIZE", 1024)))
+    app.config.setdefault("AGGREGATE_CACHE_TTL", int(os.getenv("AGGREGATE_CACHE_TTL", 3600)))
+
+    if app.config["AGGREGATE_CACHE_URL"]:
+        aggregate_cache.backend = RedisCacheBackend(
+            app.config["AGGREGATE_CACHE_URL"], app.config["AGGREGATE_CACHE_TTL"]
+        )
+    else:
+        aggregate_cache.backend = MemoryCacheBackend(app.config["AGGREGATE_CACHE_SIZE"])
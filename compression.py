@@ -0,0 +1,159 @@
+import io
+import typing as t
+import zlib
+
+# Bytes of compressed input read from the source at a time.
+_READ_SIZE = 64 * 1024
+# Output below this size is never treated as a bomb, however well it compressed.
+_RATIO_GRACE_BYTES = 1024 * 1024
+
+
+class DecompressionError(RuntimeError):
+    """
+    Raised when a request body cannot be decompressed.
+    """
+
+
+class UnsupportedEncodingError(DecompressionError):
+    """
+    Raised for a Content-Encoding that is unknown, or whose codec is not installed.
+    """
+
+
+class DecompressionBombError(DecompressionError):
+    """
+    Raised when a body expands by more than the permitted ratio.
+    """
+
+
+class _CountingReader(io.RawIOBase):
+    """
+    Passes reads through to the wrapped stream, counting the bytes read.
+    """
+
+    def __init__(self, source: t.BinaryIO):
+        self._source = source
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _ZlibReader(io.RawIOBase):
+    """
+    Incrementally inflates a gzip or zlib stream. Output is produced at most
+    one read's worth at a time, so a small input can't expand into a large
+    buffer before the ratio guard sees it.
+    """
+
+    def __init__(self, source: t.BinaryIO, wbits: int):
+        self._source = source
+        self._wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while True:
+            data = self._pending or self._source.read(_READ_SIZE)
+            if not data:
+                if not self._decompressor.eof:
+                    raise DecompressionError("Compressed body is truncated")
+                return 0
+            try:
+                out = self._decompressor.decompress(data, len(b))
+            except zlib.error as e:
+                raise DecompressionError(f"Invalid compressed body: {e}") from e
+            self._pending = self._decompressor.unconsumed_tail
+            if self._decompressor.eof and self._decompressor.unused_data:
+                # gzip allows several concatenated members.
+                self._pending = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(self._wbits)
+            if out:
+                b[:len(out)] = out
+                return len(out)
+
+
+class _ZstdReader(io.RawIOBase):
+    def __init__(self, source: t.BinaryIO):
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedEncodingError("The zstandard package is required to accept zstd bodies")
+        self._error = zstandard.ZstdError
+        self._reader = zstandard.ZstdDecompressor().stream_reader(source, read_size=_READ_SIZE)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        try:
+            return self._reader.readinto(b)
+        except self._error as e:
+            raise DecompressionError(f"Invalid compressed body: {e}") from e
+
+
+class _RatioGuard(io.RawIOBase):
+    """
+    Fails the read once the decompressed output exceeds max_ratio times the
+    compressed input consumed so far.
+    """
+
+    def __init__(self, decompressed: io.RawIOBase, compressed: _CountingReader, max_ratio: float):
+        self._decompressed = decompressed
+        self._compressed = compressed
+        self._max_ratio = max_ratio
+        self.bytes_written = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self._decompressed.readinto(b)
+        self.bytes_written += n
+        if (
+            self._max_ratio
+            and self.bytes_written > _RATIO_GRACE_BYTES
+            and self.bytes_written > self._max_ratio * max(self._compressed.bytes_read, 1)
+        ):
+            raise DecompressionBombError(
+                f"Body expands by more than the permitted ratio of {self._max_ratio:g}:1"
+            )
+        return n
+
+
+_DECODERS: t.Dict[str, t.Callable[[t.BinaryIO], io.RawIOBase]] = {
+    "gzip": lambda source: _ZlibReader(source, 16 + zlib.MAX_WBITS),
+    "x-gzip": lambda source: _ZlibReader(source, 16 + zlib.MAX_WBITS),
+    "deflate": lambda source: _ZlibReader(source, zlib.MAX_WBITS),
+    "zstd": _ZstdReader,
+}
+
+
+def decoded_stream(source: t.BinaryIO, content_encoding: t.Optional[str], max_ratio: float) -> t.BinaryIO:
+    """
+    Input: a binary stream of a request body, its Content-Encoding header and
+    the largest permitted decompressed:compressed size ratio (0 to disable).
+    Output: a buffered stream of the decoded body, decompressed lazily as it
+    is read.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return source
+    if encoding not in _DECODERS:
+        raise UnsupportedEncodingError(f"Unsupported Content-Encoding: {encoding}")
+
+    compressed = _CountingReader(source)
+    return io.BufferedReader(_RatioGuard(_DECODERS[encoding](compressed), compressed, max_ratio))
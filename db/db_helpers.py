@@ -1,9 +1,108 @@
+from __future__ import annotations
+
+import bisect
+import concurrent.futures
+import contextvars
+import datetime
+import functools
+import hashlib
+import importlib
+import itertools
+import math
+import random
+import time
 import typing as t
 import xml.etree.ElementTree as ET
-import numpy as np
 from dataclasses import dataclass
+from flask import current_app
+from sqlalchemy import BigInteger, case, cast, delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError, OperationalError
 from sqlalchemy.orm import Session, relationship
-from markr.db.models import Student, Test, TestScore, db
+from markr.db.models import ImportFingerprint, RecordFingerprint, Student, Test, TestAggregate, TestScore, db
+from markr import metrics
+from markr.cache import aggregate_cache
+from markr.replicas import replica_router
+from markr.scorestore import StoredScores, score_store
+from markr.signals import import_committed
+
+T = t.TypeVar("T")
+
+_EXPECTED_DOC_TAG: str = "mcq-test-results"
+_RESULT_TAG: str = "mcq-test-result"
+
+# Number of parsed test results held in memory before they are written to
+# the DB. Keeps memory flat for very large uploads.
+DEFAULT_CHUNK_SIZE: int = 500
+
+
+class _LazyModule:
+    """
+    Stands in for a module that is only imported on first attribute access.
+    Keeps heavy libraries (numpy) out of the app's import time.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+np = _LazyModule("numpy")
+
+
+@functools.lru_cache(maxsize=None)
+def _answer_dtype():
+    # Layout of the answers packed into TestScore.answers, 8 bytes per question.
+    return np.dtype([
+        ("question", "<u2"),
+        ("available", "<i2"),
+        ("awarded", "<i2"),
+        ("option", "S2"),
+    ])
+
+
+# Bounds of the answer fields that fit _answer_dtype().
+_MAX_QUESTION = 2 ** 16 - 1
+_MIN_ANSWER_MARKS, _MAX_ANSWER_MARKS = -(2 ** 15), 2 ** 15 - 1
+_MAX_OPTION_LENGTH = 2
+
+
+def __getattr__(name: str):
+    # ANSWER_DTYPE is built on first use, so importing this module doesn't import numpy.
+    if name == "ANSWER_DTYPE":
+        return _answer_dtype()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Postgres SQLSTATEs of a transaction aborted by a deadlock or serialization
+# failure. Retrying the transaction is safe.
+_RETRYABLE_SQLSTATES: t.FrozenSet[str] = frozenset({"40P01", "40001"})
+
+# Fingerprints older than the retention period are deleted at most this often.
+_FINGERPRINT_PRUNE_INTERVAL: float = 60.0
+_last_fingerprint_prune: float = 0.0
+
+
+class UnexpectedDocumentError(RuntimeError):
+    """
+    Raised when the uploaded XML is well formed but is not a
+    mcq-test-results document.
+    """
+
+
+class InvalidRecordError(RuntimeError):
+    """
+    Raised for a test result that is missing data or has invalid data. 
+    record is the result's position in the document, counting from 1.
+    """
+
+    def __init__(self, record: int, reason: str):
+        super().__init__(f"Test result {record}: {reason}")
+        self.record = record
+        self.reason = reason
 
 @dataclass
 class ScoreData: 
@@ -16,17 +115,30 @@ class ScoreData:
     student_number : int 
     obtained_marks : int 
     available_marks : int 
+    answers : t.Optional[bytes]
+    scanned_on : t.Optional[datetime.datetime]
 
     def __init__(self, elem: ET.Element):
-        self.first_name = elem.find("first-name").text
-        self.last_name = elem.find("last-name").text
-        if elem.find("student-number") is None:
+        # Each child is looked up once. Most of an import's CPU time is spent here.
+        scanned_on = elem.get("scanned-on")
+        self.scanned_on = parse_timestamp(scanned_on) if scanned_on else None
+        first_name = elem.find("first-name")
+        if first_name is None:
+            raise RuntimeError("No first name available")
+        self.first_name = first_name.text
+        last_name = elem.find("last-name")
+        if last_name is None:
+            raise RuntimeError("No last name available")
+        self.last_name = last_name.text
+
+        student_number = elem.find("student-number")
+        if student_number is None:
             raise RuntimeError("No student number available")
-        
-        self.student_number = int(elem.find("student-number").text)
-        if elem.find("test-id") is None: 
+        self.student_number = _to_int(student_number.text, "student number")
+        test_id = elem.find("test-id")
+        if test_id is None: 
             raise RuntimeError("No test ID given")
-        self.test_id = int(elem.find("test-id").text)
+        self.test_id = _to_int(test_id.text, "test ID")
 
         summary_marks = elem.find("summary-marks")
         if summary_marks is None: 
@@ -34,76 +146,992 @@ class ScoreData:
 
         # TODO: potentially handle obtained marks > available, although this 
         # may be desired in the case of bonus marks. 
-        if not summary_marks.attrib.get("available"):
+        available = summary_marks.get("available")
+        if not available:
             raise RuntimeError("Available marks not set")
-        self.available_marks = int(summary_marks.attrib.get("available"))
-        if not summary_marks.attrib.get("obtained"): 
+        self.available_marks = _to_int(available, "available marks")
+        obtained = summary_marks.get("obtained")
+        if not obtained: 
             raise RuntimeError("Obtained marks not set")
+        self.obtained_marks = _to_int(obtained, "obtained marks")
+
+        self.answers = self._pack_answers(elem.findall("answer"))
+
+    @classmethod
+    def from_values(
+        cls,
+        first_name: t.Optional[str],
+        last_name: t.Optional[str],
+        student_number: int,
+        test_id: int,
+        obtained_marks: int,
+        available_marks: int,
+        answers: t.Optional[bytes],
+        scanned_on: t.Optional[datetime.datetime],
+    ) -> "ScoreData":
+        """
+        Builds a ScoreData from values that have already been validated.
+        """
+        sd = cls.__new__(cls)
+        sd.first_name = first_name
+        sd.last_name = last_name
+        sd.student_number = student_number
+        sd.test_id = test_id
+        sd.obtained_marks = obtained_marks
+        sd.available_marks = available_marks
+        sd.answers = answers
+        sd.scanned_on = scanned_on
+        return sd
 
-        self.obtained_marks = int(summary_marks.attrib.get("obtained"))
+    @staticmethod
+    def _pack_answers(answers: t.List[ET.Element]) -> t.Optional[bytes]:
+        if not answers:
+            return None
+        try:
+            packed = [
+                (
+                    int(answer.attrib["question"]),
+                    int(answer.attrib["marks-available"]),
+                    int(answer.attrib["marks-awarded"]),
+                    (answer.text or "").strip(),
+                )
+                for answer in answers
+            ]
+        except (KeyError, ValueError):
+            raise RuntimeError("Answers must have integer question, marks-available and marks-awarded")
+
+        # Checked explicitly, since numpy would wrap or truncate some values
+        # to fit _answer_dtype() rather than reject them.
+        for question, available, awarded, option in packed:
+            if not 0 <= question <= _MAX_QUESTION:
+                raise RuntimeError(f"Invalid answer question {question}")
+            if not (_MIN_ANSWER_MARKS <= available <= _MAX_ANSWER_MARKS and _MIN_ANSWER_MARKS <= awarded <= _MAX_ANSWER_MARKS):
+                raise RuntimeError(f"Invalid answer marks for question {question}")
+            if not option.isascii() or len(option) > _MAX_OPTION_LENGTH:
+                raise RuntimeError(f"Invalid answer option {option!r} for question {question}")
+        try:
+            return np.array(packed, dtype=_answer_dtype()).tobytes()
+        except (OverflowError, ValueError, UnicodeEncodeError) as e:
+            raise RuntimeError(f"Invalid answers: {e}")
     
     @property
     def percent_score(self) -> float: 
-        return round((self.obtained_marks / self.available_marks) * 100 , 2)
+        return percent(self.obtained_marks, self.available_marks)
+
+
+def _to_int(value: t.Optional[str], name: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RuntimeError(f"Invalid {name} {value}")
+
+
+def percent(score: int, available_marks: int) -> float:
+    return round((score / available_marks) * 100 , 2)
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """
+    Parses an ISO 8601 timestamp, e.g. 2017-12-04T12:12:10+11:00, into UTC.
+    Timestamps without an offset are taken to be UTC already.
+    """
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise RuntimeError(f"Invalid timestamp {value}")
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+def iter_test_results(source: t.BinaryIO) -> t.Iterator[ET.Element]:
+    """
+    Incrementally parses XML from a file-like object, yielding each top level
+    <mcq-test-result> element as soon as its closing tag has been read.
+
+    Every finished child of the document root is cleared once the consumer
+    moves on, so memory is bounded by a single test result rather than by
+    the size of the whole document.
+
+    Raises ET.ParseError for malformed XML and UnexpectedDocumentError if the
+    document root is not <mcq-test-results>.
+    """
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                if elem.tag != _EXPECTED_DOC_TAG:
+                    raise UnexpectedDocumentError(f"Unexpected root element {elem.tag}")
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if elem.tag == _RESULT_TAG:
+                yield elem
+            # Drop the finished child (and any answers it holds) from the tree.
+            root.clear()
 
 
-def extract_data(root: ET.Element) -> int:
+@dataclass
+class ImportResult:
     """
-    Responsible for extracting relevant test data from an XML root.
+    Outcome of an import: records written, and records skipped because an
+    identical one had already been imported.
+    """
+    processed: int = 0
+    skipped: int = 0
+
+
+def extract_data(
+    records: t.Union[ET.Element, t.Iterable[ET.Element], t.Iterable[ScoreData]],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_progress: t.Optional[t.Callable[[int], None]] = None,
+    fingerprint_retention: t.Optional[float] = None,
+    payload_digest: t.Optional[str] = None,
+    parallelism: int = 1,
+    max_retries: int = 3,
+) -> ImportResult:
+    """
+    Responsible for extracting relevant test data from XML test results.
     If any error occurs in extracting data for one test, then the entire
     request is aborted. 
 
     Input: 
-     - XML root element.
+     - XML root element, or an iterable of <mcq-test-result> elements
+       (see iter_test_results for streaming input) or of already validated
+       ScoreData (see markr.parsing.parse_in_parallel).
+     - chunk_size: number of results staged before flushing to the DB.
+     - on_progress: optionally called with the running record count after
+       each chunk is written (the records are not committed until the end).
+     - fingerprint_retention: if set, results already imported within this
+       many seconds are skipped, and older fingerprints are pruned.
+     - payload_digest: fingerprint of the upload, recorded with the import
+       (see find_import_fingerprint).
+     - parallelism: with more than one, the results are validated in full 
+       and then written by that many concurrent transactions, see 
+       write_partitioned. The import is then no longer all-or-nothing once
+       writing starts. In-memory SQLite is always written serially.
+     - max_retries: times a parallel transaction aborted by a deadlock or
+       serialization failure is retried.
 
     Output: 
-     - Number of test result records that were added or updated in the DB. 
+     - Numbers of test result records that were added or updated in the DB,
+       and that were skipped as duplicates.
+    """
+    if isinstance(records, ET.Element):
+        records = records.findall(_RESULT_TAG)
+
+    result = ImportResult()
+    chunk = []
+    test_ids: t.Set[int] = set()
+    timer = metrics.StageTimer()
+    records = iter(records)
+    position = 0
+    parallel = parallelism > 1 and not _in_memory_database()
+
+    def write(chunk: t.List[ScoreData]):
+        nonlocal test_ids
+        with timer("upsert"):
+            if fingerprint_retention:
+                chunk, skipped = _drop_seen_records(chunk)
+                result.skipped += skipped
+            test_ids |= create_or_update_entries(chunk)
+        result.processed += len(chunk)
+
+    try:
+        with metrics.count_queries() as queries:
+            while True:
+                # Parsing happens lazily as the next result is pulled from 
+                # the stream, so time the pull separately from validation.
+                start = time.perf_counter()
+                elem = next(records, None)
+                parsed = time.perf_counter()
+                timer.add("parse", parsed - start)
+                if elem is None:
+                    break
+                position += 1
+                if isinstance(elem, ScoreData):
+                    # Already validated, see markr.parsing.
+                    chunk.append(elem)
+                else:
+                    try:
+                        chunk.append(ScoreData(elem))
+                    except RuntimeError as e:
+                        raise InvalidRecordError(position, str(e)) from e
+                timer.add("validate", time.perf_counter() - parsed)
+
+                # Upserted rows stay inside the open transaction, so a later
+                # failure still rolls back the whole document.
+                if len(chunk) >= chunk_size and not parallel:
+                    write(chunk)
+                    chunk = []
+                    if on_progress:
+                        on_progress(result.processed)
+            if parallel:
+                with timer("upsert"):
+                    write_partitioned(
+                        chunk, parallelism, chunk_size, result, test_ids,
+                        fingerprint_retention=fingerprint_retention,
+                        max_retries=max_retries,
+                        on_progress=on_progress,
+                    )
+            elif chunk:
+                write(chunk)
+            if fingerprint_retention:
+                if payload_digest:
+                    db.session.execute(_insert(ImportFingerprint).on_conflict_do_nothing(), [
+                        {"digest": payload_digest, "records": result.processed + result.skipped}
+                    ])
+                _maybe_prune_fingerprints(fingerprint_retention)
+            with timer("commit"):
+                db.session.commit()
+    except Exception:
+        db.session.rollback()
+        metrics.imports_total.inc(status="failed")
+        if parallel and test_ids:
+            # Partitions committed before the failure are kept.
+            import_committed.send(test_ids=frozenset(test_ids))
+        raise
+
+    for stage, seconds in timer.totals.items():
+        metrics.import_stage_seconds.observe(seconds, stage=stage)
+    metrics.import_records.observe(result.processed)
+    metrics.import_queries.observe(queries[0])
+    metrics.imports_total.inc(status="succeeded")
+    if result.skipped:
+        metrics.import_duplicates_total.inc(result.skipped, kind="record")
+
+    import_committed.send(test_ids=frozenset(test_ids))
+    return result
+
+
+def _in_memory_database() -> bool:
+    # Every session shares the one connection to an in-memory SQLite database.
+    return db.engine.url.get_backend_name() == "sqlite" and db.engine.url.database in (None, "", ":memory:")
+
+
+def _is_retryable(e: DBAPIError) -> bool:
+    # psycopg2 reports the SQLSTATE as pgcode, psycopg 3 as sqlstate.
+    sqlstate = getattr(e.orig, "pgcode", None) or getattr(e.orig, "sqlstate", None)
+    if sqlstate in _RETRYABLE_SQLSTATES:
+        return True
+    return isinstance(e, OperationalError) and "database is locked" in str(e.orig)
+
+
+def _commit_with_retries(apply: t.Callable[[], T], max_retries: int) -> T:
+    """
+    Runs apply() and commits, in a transaction of its own. If the database
+    aborts the transaction to break a deadlock or serialization conflict,
+    it is rolled back and run again, up to max_retries times, after a 
+    randomised exponential backoff.
+    """
+    for attempt in itertools.count():
+        try:
+            outcome = apply()
+            db.session.commit()
+            return outcome
+        except DBAPIError as e:
+            db.session.rollback()
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            metrics.import_retries_total.inc()
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def _partitions(records: t.List[ScoreData], size: int) -> t.List[t.List[ScoreData]]:
+    """
+    Splits records into batches of about size records, such that each 
+    test's results are all in one batch, except for tests with more than 
+    size results which are split into batches of their own. 
+    """
+    by_test: t.Dict[int, t.List[ScoreData]] = {}
+    for sd in records:
+        by_test.setdefault(sd.test_id, []).append(sd)
+
+    partitions: t.List[t.List[ScoreData]] = []
+    current: t.List[ScoreData] = []
+    for test_id in sorted(by_test):
+        results = by_test[test_id]
+        if len(results) >= size:
+            partitions.extend(results[i:i + size] for i in range(0, len(results), size))
+            continue
+        if len(current) + len(results) > size:
+            partitions.append(current)
+            current = []
+        current.extend(results)
+    if current:
+        partitions.append(current)
+    return partitions
+
+
+def write_partitioned(
+    records: t.List[ScoreData],
+    workers: int,
+    batch_size: int,
+    result: ImportResult,
+    committed: t.Set[int],
+    fingerprint_retention: t.Optional[float] = None,
+    max_retries: int = 3,
+    on_progress: t.Optional[t.Callable[[int], None]] = None,
+):
+    """
+    Writes validated results with a pool of workers, each running its own 
+    transactions, so large imports use several cores and DB connections.
+
+    Students are inserted first, split by student ID, and committed. Scores
+    are then written in partitions by test ID (see _partitions). A test with
+    more than batch_size results is split over several partitions, which 
+    workers may write at the same time. They serialize on the test's 
+    aggregate row, which each locks before reading the scores it compares
+    against. Locks are taken in ID order, and transactions aborted by a 
+    deadlock with another import are retried. The max score semantics are 
+    those of create_or_update_entries, whatever order partitions commit in.
+
+    Input:
+    - result: updated with the records written and skipped as they commit.
+    - committed: updated with the IDs of the tests whose partitions committed.
+    A failure in any partition cancels those not yet started and is raised 
+    once the running ones finish. Partitions already committed are kept.
+    """
+    app = current_app._get_current_object()
+
+    def run(apply: t.Callable[[], T]) -> T:
+        # Each worker has an app context, and so a session, of its own.
+        with app.app_context():
+            return _commit_with_retries(apply, max_retries)
+
+    def write_students(batch: t.List[ScoreData]) -> None:
+        _upsert_students(batch)
+
+    def write_scores(batch: t.List[ScoreData]) -> t.Tuple[t.Set[int], int, int]:
+        skipped = 0
+        if fingerprint_retention:
+            batch, skipped = _drop_seen_records(batch)
+        return create_or_update_entries(batch, with_students=False), len(batch), skipped
+
+    students = sorted({sd.student_number: sd for sd in reversed(records)}.items())
+    student_batches = [
+        [sd for _, sd in students[i:i + batch_size]] for i in range(0, len(students), batch_size)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="markr-ingest") as pool:
+        # The context is copied per task so worker queries are counted with the import's.
+        for future in [
+            pool.submit(contextvars.copy_context().run, run, lambda batch=batch: write_students(batch))
+            for batch in student_batches
+        ]:
+            future.result()
+
+        futures = [
+            pool.submit(contextvars.copy_context().run, run, lambda batch=batch: write_scores(batch))
+            for batch in _partitions(records, batch_size)
+        ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                test_ids, processed, skipped = future.result()
+                committed |= test_ids
+                result.processed += processed
+                result.skipped += skipped
+                if on_progress:
+                    on_progress(result.processed)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            # Partitions still running may yet commit.
+            for future in concurrent.futures.wait(futures).done:
+                if not future.cancelled() and future.exception() is None:
+                    committed |= future.result()[0]
+            raise
+
+
+def record_fingerprint(sd: ScoreData) -> bytes:
+    """
+    Input: a parsed test result.
+    Output: a 16 byte hash of its student, test and marks. 
+    
+    Names and answers are left out, since an import never changes them for
+    a student/test pair whose marks are unchanged.
+    """
+    key = f"{sd.student_number}:{sd.test_id}:{sd.available_marks}:{sd.obtained_marks}"
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def _drop_seen_records(batch: t.List[ScoreData]) -> t.Tuple[t.List[ScoreData], int]:
+    """
+    Removes results from the batch that repeat one already imported, or one
+    earlier in the batch, and records fingerprints for the rest. Costs one
+    lookup and one insert per batch.
+
+    Output: the remaining results and the number removed.
     """
-    tally = 0
-    for elem in root.findall("mcq-test-result"):
-        create_or_update_entries(
-            ScoreData(elem)
+    fresh: t.Dict[bytes, ScoreData] = {}
+    for sd in batch:
+        fresh.setdefault(record_fingerprint(sd), sd)
+
+    seen = db.session.scalars(
+        select(RecordFingerprint.digest).where(RecordFingerprint.digest.in_(list(fresh)))
+    )
+    for digest in seen:
+        del fresh[digest]
+
+    if fresh:
+        db.session.execute(
+            _insert(RecordFingerprint).on_conflict_do_nothing(),
+            [{"digest": digest} for digest in fresh],
         )
-        tally += 1
-    db.session.commit()
-    return tally 
+    return list(fresh.values()), len(batch) - len(fresh)
 
-def create_or_update_entries(sd: ScoreData):
+
+def find_import_fingerprint(digest: str) -> t.Optional[ImportFingerprint]:
+    """
+    Input: SHA-256 hex digest of an upload's body.
+    Output: the fingerprint recorded when an identical upload was imported,
+    or None.
     """
-    Stages updates and/or new entries to be commited to the DB. 
+    return db.session.get(ImportFingerprint, digest)
 
+
+def prune_fingerprints(retention: float) -> int:
+    """
+    Deletes payload and record fingerprints older than `retention` seconds.
     NOT responsible for committing.
+
+    Output: number of fingerprints deleted.
     """
-    existing_student = Student.query.get(sd.student_number)
-    existing_test = Test.query.get(sd.test_id)
-    existing_score = TestScore.query.filter_by(
-        test_id=sd.test_id, student_id=sd.student_number
-    ).first()
- 
-    if not existing_student:
-        student = Student(id=sd.student_number, fname=sd.first_name, lname=sd.last_name)
-        db.session.add(student)
-
-    if not existing_test:
-        test = Test(id=sd.test_id, available_marks=sd.available_marks)
-        db.session.add(test)
-    elif existing_test.available_marks < sd.available_marks:
-        existing_test.available_marks = sd.available_marks
-    
-    if not existing_score:
-        score = TestScore(
-            test_id=sd.test_id, student_id=sd.student_number, score=sd.obtained_marks, percent_score=sd.percent_score
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=retention)
+    deleted = 0
+    for model in (ImportFingerprint, RecordFingerprint):
+        deleted += db.session.execute(delete(model).where(model.created_at < cutoff)).rowcount
+    return deleted
+
+
+def _maybe_prune_fingerprints(retention: float):
+    global _last_fingerprint_prune
+    now = time.monotonic()
+    if now - _last_fingerprint_prune >= _FINGERPRINT_PRUNE_INTERVAL:
+        _last_fingerprint_prune = now
+        prune_fingerprints(retention)
+
+
+def _insert(model):
+    """
+    Returns a dialect specific INSERT construct for the model, which 
+    supports ON CONFLICT clauses.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise RuntimeError(f"Unsupported database dialect: {dialect}")
+
+
+def _upsert_students(batch: t.Iterable[ScoreData]):
+    # Existing students keep the names they were first imported with.
+    # Rows are inserted in ID order so concurrent imports lock them in the same order.
+    students: t.Dict[int, ScoreData] = {}
+    for sd in batch:
+        students.setdefault(sd.student_number, sd)
+    stmt = _insert(Student).on_conflict_do_nothing(index_elements=[Student.id])
+    db.session.execute(stmt, [
+        {"id": student_id, "fname": sd.first_name, "lname": sd.last_name}
+        for student_id, sd in sorted(students.items())
+    ])
+
+
+def create_or_update_entries(batch: t.List[ScoreData], with_students: bool = True) -> t.Set[int]:
+    """
+    Stages updates and/or new entries for a batch of test results to be 
+    commited to the DB. 
+
+    The batch is deduplicated in memory first (keeping the highest available 
+    marks per test and the highest score per student/test pair), then written
+    with one INSERT ... ON CONFLICT statement per table, rather than looking up 
+    each record individually. Rows are written in ID order, so concurrent 
+    imports of overlapping batches lock them in the same order rather than 
+    deadlocking.
+
+    NOT responsible for committing.
+
+    Input:
+    - with_students: False if the batch's students have already been inserted.
+
+    Output: 
+    - IDs of the tests the batch touched.
+    """
+    if not batch:
+        return set()
+
+    available_marks: t.Dict[int, int] = {}
+    best_scores: t.Dict[t.Tuple[int, int], ScoreData] = {}
+    for sd in batch:
+        if sd.available_marks > available_marks.get(sd.test_id, 0):
+            available_marks[sd.test_id] = sd.available_marks
+        key = (sd.test_id, sd.student_number)
+        if key not in best_scores or best_scores[key].obtained_marks < sd.obtained_marks:
+            best_scores[key] = sd
+
+    if with_students:
+        _upsert_students(batch)
+
+    # Available marks only ever rise. Every row is written, so each test's
+    # current marks are returned for its aggregate's sketch.
+    stmt = _insert(Test)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Test.id],
+        set_={"available_marks": case(
+            (stmt.excluded.available_marks > Test.available_marks, stmt.excluded.available_marks),
+            else_=Test.available_marks,
+        )},
+    ).returning(Test.id, Test.available_marks)
+    current_marks = dict(db.session.execute(stmt, [
+        {"id": test_id, "available_marks": marks}
+        for test_id, marks in sorted(available_marks.items())
+    ]).all())
+
+    _update_aggregates(best_scores, current_marks)
+
+    stmt = _insert(TestScore)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TestScore.test_id, TestScore.student_id],
+        set_={
+            "score": stmt.excluded.score,
+            "answers": stmt.excluded.answers,
+            "scanned_on": stmt.excluded.scanned_on,
+        },
+        where=stmt.excluded.score > TestScore.score,
+    )
+    db.session.execute(stmt, [
+        {
+            "test_id": sd.test_id,
+            "student_id": sd.student_number,
+            "score": sd.obtained_marks,
+            "answers": sd.answers,
+            "scanned_on": sd.scanned_on,
+        }
+        for _, sd in sorted(best_scores.items())
+    ])
+    return set(available_marks)
+
+
+def _update_aggregates(best_scores: t.Dict[t.Tuple[int, int], ScoreData], available_marks: t.Dict[int, int]):
+    """
+    Applies the score changes a batch is about to make to the running 
+    aggregates of each affected test, given the tests' current available
+    marks.
+
+    Must run before the scores themselves are upserted, since it compares
+    against the scores currently stored.
+    """
+    test_ids = {test_id for test_id, _ in best_scores}
+    student_ids = {student_id for _, student_id in best_scores}
+
+    # Create or bump the version of each aggregate in one upsert, in ID order. 
+    # This locks the rows, so concurrent imports of the same test apply 
+    # their changes one after the other, and an import racing to create the
+    # same aggregate waits for it rather than failing on the primary key.
+    # The version is bumped even if no score changes, since available marks may have.
+    stmt = _insert(TestAggregate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TestAggregate.test_id],
+        set_={"version": TestAggregate.version + 1},
+    ).returning(TestAggregate)
+    aggregates = {
+        agg.test_id: agg
+        for agg in db.session.scalars(
+            stmt,
+            [
+                {"test_id": test_id, "count": 0, "score_sum": 0, "score_sum_sq": 0, "histogram": {}, "version": 1}
+                for test_id in sorted(test_ids)
+            ],
+            execution_options={"populate_existing": True},
+        )
+    }
+    existing_scores = {
+        (test_id, student_id): score
+        for test_id, student_id, score in db.session.execute(
+            select(TestScore.test_id, TestScore.student_id, TestScore.score)
+            .where(TestScore.test_id.in_(test_ids), TestScore.student_id.in_(student_ids))
         )
-        db.session.add(score)
-    elif existing_score.score < sd.obtained_marks:
-        existing_score.score = sd.obtained_marks
-        existing_score.percent_score = sd.percent_score
+    }
+
+    histograms: t.Dict[int, t.Dict[str, int]] = {}
+    # A test with scores but an empty aggregate (deleted, or never built) 
+    # has it rebuilt from its scores first, so the changes below apply to it.
+    unbuilt = {test_id for test_id, _ in existing_scores if aggregates[test_id].count == 0}
+    if unbuilt:
+        for test_id, score, count in db.session.execute(
+            select(TestScore.test_id, TestScore.score, func.count())
+            .where(TestScore.test_id.in_(unbuilt))
+            .group_by(TestScore.test_id, TestScore.score)
+        ):
+            agg = aggregates[test_id]
+            agg.count += count
+            agg.score_sum += score * count
+            agg.score_sum_sq += score * score * count
+            histograms.setdefault(test_id, {})[str(score)] = count
+
+    for key, sd in best_scores.items():
+        old = existing_scores.get(key)
+        new = sd.obtained_marks
+        if old is not None and old >= new:
+            continue
+
+        agg = aggregates[sd.test_id]
+        hist = histograms.setdefault(sd.test_id, dict(agg.histogram))
+
+        if old is None or not hist.get(str(old)):
+            # A score the aggregate hasn't counted, even if out of sync.
+            agg.count += 1
+        else:
+            # An upgraded score replaces the student's previous one.
+            agg.score_sum -= old
+            agg.score_sum_sq -= old * old
+            hist[str(old)] -= 1
+            if hist[str(old)] == 0:
+                del hist[str(old)]
+        agg.score_sum += new
+        agg.score_sum_sq += new * new
+        hist[str(new)] = hist.get(str(new), 0) + 1
+
+    for test_id, hist in histograms.items():
+        agg = aggregates[test_id]
+        # Reassign so the JSON column is marked as modified.
+        agg.histogram = hist
+        agg.min_score = min(int(score) for score in hist)
+        agg.max_score = max(int(score) for score in hist)
+    # Sketches are rebuilt even where no score changed, since the test's 
+    # available marks, and so every percentage, may have.
+    for test_id, agg in aggregates.items():
+        agg.sketch = _sketch_from_histogram(agg.histogram, available_marks[test_id])
+    db.session.flush()
+
+
+def _lerp(a: float, b: float, t: float) -> float:
+    """
+    Linear interpolation between a and b, arranged exactly as numpy does it
+    so results match np.percentile bit for bit.
+    """
+    if t >= 0.5:
+        return b - (b - a) * (1 - t)
+    return a + (b - a) * t
+
+
+def _percentile(value_at: t.Callable[[int], float], n: int, q: float) -> float:
+    """
+    Computes the q-th percentile of n sorted values using numpy's default 
+    (linear) method, where value_at(i) returns the i-th smallest value.
+    """
+    virtual_index = (n - 1) * (q / 100)
+    lower = math.floor(virtual_index)
+    upper = min(lower + 1, n - 1)
+    return _lerp(value_at(lower), value_at(upper), virtual_index - lower)
+
+
+def _summary_from_aggregate(agg: TestAggregate, available_marks: int) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Derives the aggregate statistics for a test from its running aggregate.
+    Cost depends only on the number of distinct scores, not on the number 
+    of students.
+    """
+    scores = sorted(int(score) for score in agg.histogram)
+    return _summary_from_histogram(scores, [agg.histogram[str(score)] for score in scores], available_marks)
+
+
+def _summary_from_histogram(
+    scores: t.Sequence[int], counts: t.Sequence[int], available_marks: int
+) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Derives the aggregate statistics for a test from its sorted distinct 
+    raw scores and how often each occurs.
+    """
+    cumulative = list(itertools.accumulate(counts))
+
+    def value_at(rank: int) -> float:
+        return percent(scores[bisect.bisect_right(cumulative, rank)], available_marks)
+
+    return _summary_from_distribution(value_at, scores, counts, available_marks)
+
+
+def _summary_from_stored_scores(stored: StoredScores) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Derives the aggregate statistics for a test from its sorted scores in
+    the score store, identical to _summary_from_aggregate's. Each 
+    percentile is an index into the array.
+    """
+    scores = stored.scores
+
+    def value_at(rank: int) -> float:
+        return percent(int(scores[rank]), stored.available_marks)
+
+    return _summary_from_distribution(value_at, stored.distinct, stored.counts, stored.available_marks)
+
+
+def _summary_from_distribution(
+    value_at: t.Callable[[int], float],
+    scores: t.Sequence[int],
+    counts: t.Sequence[int],
+    available_marks: int,
+) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Computes the aggregate statistics of a test's scores, given as sorted 
+    distinct raw scores and how often each occurs, where value_at(i) 
+    returns the i-th smallest as a percentage.
+
+    Like every other summary, the mean and stddev are taken over the 
+    rounded percentages rather than the raw scores, so a test gets the same
+    numbers from every endpoint.
+    """
+    percents = np.array([percent(int(score), available_marks) for score in scores])
+    weights = np.asarray(counts, dtype=np.int64)
+    n = int(weights.sum())
+    mean = float(np.dot(percents, weights) / n)
+    variance = float(np.dot(weights, (percents - mean) ** 2) / n)
+
+    if n % 2:
+        median = value_at(n // 2)
+    else:
+        median = (value_at(n // 2 - 1) + value_at(n // 2)) / 2
+    return {
+        "mean": round(mean, 2),
+        "median": median,
+        "stddev": round(math.sqrt(variance), 2),
+        "min": int(percents[0]),
+        "max": int(percents[-1]),
+        "count": n,
+        "p25": _percentile(value_at, n, 25),
+        "p50": _percentile(value_at, n, 50),
+        "p95": _percentile(value_at, n, 95),
+    }
+
+
+def _weighted_summary(
+    values: np.ndarray, counts: np.ndarray, mean: float, variance: float, min_: float, max_: float
+) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Computes the aggregate statistics of a distribution given as sorted 
+    distinct values and how often each occurs, with percentiles and median
+    following numpy's linear method as _summary_from_aggregate does.
+    """
+    cumulative = np.cumsum(counts)
+    n = int(cumulative[-1])
+
+    def value_at(rank: int) -> float:
+        return float(values[np.searchsorted(cumulative, rank, side="right")])
+
+    if n % 2:
+        median = value_at(n // 2)
+    else:
+        median = (value_at(n // 2 - 1) + value_at(n // 2)) / 2
+    return {
+        "mean": round(mean, 2),
+        "median": median,
+        "stddev": round(math.sqrt(variance), 2),
+        "min": int(min_),
+        "max": int(max_),
+        "count": n,
+        "p25": _percentile(value_at, n, 25),
+        "p50": _percentile(value_at, n, 50),
+        "p95": _percentile(value_at, n, 95),
+    }
+
+
+# Width, in percentage points, of the bins of each test's sketch. 
+# Approximate percentiles and medians are within half a bin of the exact
+# value, whatever range the percentages cover.
+SKETCH_BIN_WIDTH: float = 0.1
+
+
+def _sketch_from_histogram(histogram: t.Dict[str, int], available_marks: int) -> t.Dict[str, int]:
+    """
+    Counts a test's percentages, given its raw score histogram, into bins 
+    of SKETCH_BIN_WIDTH centred on multiples of it. Only occupied bins are
+    kept, so there is a bin for every percentage, even above 100%.
+    """
+    sketch: t.Dict[str, int] = {}
+    for score, count in histogram.items():
+        key = str(round(percent(int(score), available_marks) / SKETCH_BIN_WIDTH))
+        sketch[key] = sketch.get(key, 0) + count
+    return sketch
+
+
+def compute_rollup_summary(
+    test_ids: t.Iterable[int], approx: bool = False
+) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.List[int]]:
+    """
+    Computes aggregate statistics over the scores of several tests combined,
+    e.g. every test sat by a school in a term, from each test's running 
+    aggregate rather than its scores. 
+
+    Each aggregate's raw score histogram is a mergeable summary of the test:
+    converted to percentages of the test's available marks, histograms of 
+    different tests simply add. By default the merged histogram is exact, 
+    matching numpy over every score, at the cost of converting and sorting
+    every test's distinct scores. With approx, each test's sketch, kept by
+    imports, is merged instead: at most one count per SKETCH_BIN_WIDTH bin,
+    however many distinct scores the test has. Percentiles and the median
+    are then within SKETCH_BIN_WIDTH / 2 of the exact value. The mean and 
+    stddev come from the aggregates' moments, within 0.01 of the exact value
+    (which is taken over rounded percentages). Min, max and count are exact
+    either way.
+
+    Input: 
+    - test_ids of the tests to combine
+    - approx: merge the tests' sketches
+
+    Output: 
+    - Tuple of the statistics dictionary and the IDs of tests with no 
+      scores (or no running aggregate), which are left out.
+    """
+    test_ids = list(dict.fromkeys(test_ids))
+    if approx:
+        return _approx_rollup_summary(test_ids)
+
+    start = time.perf_counter()
+    rows = replica_router.read(test_ids, lambda session: session.execute(
+        select(TestAggregate.test_id, TestAggregate.histogram, Test.available_marks)
+        .join(Test, Test.id == TestAggregate.test_id)
+        .where(TestAggregate.test_id.in_(test_ids), TestAggregate.count > 0)
+    ).all())
+    if not rows:
+        raise RuntimeError("No scores found for any of the given test IDs")
+
+    fetched = time.perf_counter()
+    entries = [
+        (int(score), count, available_marks)
+        for _, histogram, available_marks in rows
+        for score, count in histogram.items()
+    ]
+    scores, counts, available_marks = np.array(entries, dtype=np.int64).T
+    percents = _percentages(scores, available_marks)
+
+    n = counts.sum()
+    mean = float(np.dot(percents, counts) / n)
+    variance = float(np.dot(counts, (percents - mean) ** 2) / n)
+    values, inverse = np.unique(percents, return_inverse=True)
+    value_counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+    summary = _weighted_summary(values, value_counts, mean, variance, percents.min(), percents.max())
+
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="merged_aggregates")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="merged_aggregates")
+    found = {test_id for test_id, _, _ in rows}
+    return summary, [test_id for test_id in test_ids if test_id not in found]
+
+
+def _approx_rollup_summary(test_ids: t.List[int]) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.List[int]]:
+    start = time.perf_counter()
+
+    def read(session: Session):
+        rows = session.execute(
+            select(
+                TestAggregate.test_id,
+                TestAggregate.count,
+                TestAggregate.score_sum,
+                TestAggregate.score_sum_sq,
+                TestAggregate.min_score,
+                TestAggregate.max_score,
+                TestAggregate.sketch,
+                Test.available_marks,
+            )
+            .join(Test, Test.id == TestAggregate.test_id)
+            .where(TestAggregate.test_id.in_(test_ids), TestAggregate.count > 0)
+        ).all()
+        # Aggregates written before sketches were kept are sketched from 
+        # their histograms, until an import or rebuild-aggregates stores one.
+        unsketched = [row.test_id for row in rows if row.sketch is None]
+        histograms = dict(session.execute(
+            select(TestAggregate.test_id, TestAggregate.histogram).where(TestAggregate.test_id.in_(unsketched))
+        ).all()) if unsketched else {}
+        return rows, histograms
+
+    rows, histograms = replica_router.read(test_ids, read)
+    if not rows:
+        raise RuntimeError("No scores found for any of the given test IDs")
+
+    fetched = time.perf_counter()
+    n = total = total_sq = 0
+    min_, max_ = math.inf, -math.inf
+    merged: t.Dict[int, int] = {}
+    for row in rows:
+        scale = 100 / row.available_marks
+        n += row.count
+        total += row.score_sum * scale
+        total_sq += row.score_sum_sq * scale * scale
+        min_ = min(min_, percent(row.min_score, row.available_marks))
+        max_ = max(max_, percent(row.max_score, row.available_marks))
+        sketch = row.sketch
+        if sketch is None:
+            sketch = _sketch_from_histogram(histograms[row.test_id], row.available_marks)
+        for key, count in sketch.items():
+            merged[int(key)] = merged.get(int(key), 0) + count
+
+    bins = sorted(merged)
+    mean = total / n
+    variance = max(total_sq / n - mean * mean, 0.0)
+    values = np.round(np.array(bins, dtype=np.float64) * SKETCH_BIN_WIDTH, 6)
+    summary = _weighted_summary(values, np.array([merged[b] for b in bins], dtype=np.int64), mean, variance, min_, max_)
+
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="sketch")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="sketch")
+    found = {row.test_id for row in rows}
+    return summary, [test_id for test_id in test_ids if test_id not in found]
+
+
+def _load_test_score_summary(
+    test_id: int, version: t.Optional[int] = None
+) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.Optional[int]]:
+    """
+    Reads the aggregate statistics for a test along with its aggregate 
+    version (None when summarised directly from the scores table). Tests 
+    held in the score store are summarised without touching the database,
+    unless their stored version differs from version, the test's current
+    one if the caller has read it.
+    """
+    start = time.perf_counter()
+    stored = score_store.get(test_id, version)
+    if stored is not None:
+        fetched = time.perf_counter()
+        summary = _summary_from_stored_scores(stored)
+        metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="score_store")
+        metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="score_store")
+        return summary, stored.version
+    return replica_router.read([test_id], lambda session: _read_test_score_summary(session, test_id))
+
+
+def _read_test_score_summary(
+    session: Session, test_id: int
+) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.Optional[int]]:
+    start = time.perf_counter()
+    row = session.execute(
+        select(TestAggregate, Test.available_marks)
+        .join(Test, Test.id == TestAggregate.test_id)
+        .where(TestAggregate.test_id == test_id)
+    ).first()
+    if row is None:
+        # Scores imported before aggregates were maintained.
+        return _compute_test_score_summary(session, test_id), None
+    if row[0].count == 0:
+        raise RuntimeError(f"No test found with test ID {test_id}")
+
+    fetched = time.perf_counter()
+    agg, available_marks = row
+    summary = _summary_from_aggregate(agg, available_marks)
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="running_aggregate")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="running_aggregate")
+    return summary, agg.version
 
 
 def get_test_score_summary(test_id: int) -> t.Dict[str, t.Union[float, int]]: 
     """
-    Collects all test scores from the DB for the given test ID, and returns 
-    related aggregate statistics. 
+    Returns aggregate statistics for the given test ID, read from its 
+    running aggregate. This is a single row lookup regardless of how many 
+    scores have been recorded for the test. Hot tests are served from the
+    score store when it is enabled and up to date.
 
     Input: 
     - test_id for the test of interest 
@@ -111,19 +1139,564 @@ def get_test_score_summary(test_id: int) -> t.Dict[str, t.Union[float, int]]:
     Output: 
     - Dictionary with various aggregate statistics pertaining to the given test.
     """
-    scores = TestScore.query.filter_by(test_id=test_id).all()
-    if len(scores) == 0:
-        raise RuntimeError(f"No test found with test ID {test_id}")
-    
-    dataset = np.array([score.percent_score for score in scores])
+    return _load_test_score_summary(test_id)[0]
+
+
+def get_primary_test_score_summary(test_id: int) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.Optional[int]]:
+    """
+    As get_cached_test_score_summary, but always read from the primary and
+    never from the cache, so the result reflects every committed import 
+    even in a process whose cache no import invalidates.
+    """
+    return _read_test_score_summary(db.session, test_id)
+
+
+def get_cached_test_score_summary(test_id: int) -> t.Tuple[t.Dict[str, t.Union[float, int]], t.Optional[int]]:
+    """
+    As get_test_score_summary, but served from the aggregate cache when 
+    possible. Imports invalidate the cached entries of the tests they touch.
+    Unless the cache is shared between processes (Redis), a cached entry is
+    only used while the test's aggregate version (a primary key lookup) 
+    still matches, so imports by other worker processes are seen too. 
+    Entries are computed given the test's current version, which the score
+    store is checked against.
+
+    Output: 
+    - Tuple of the statistics dictionary and the test's aggregate version.
+    """
+    return aggregate_cache.get_or_compute(test_id, _load_test_score_summary, _read_aggregate_version)
+
+
+def _read_aggregate_version(test_id: int) -> t.Optional[int]:
+    return replica_router.read([test_id], lambda session: session.scalar(
+        select(TestAggregate.version).where(TestAggregate.test_id == test_id)
+    ))
+
+
+def _percentages(scores: np.ndarray, available_marks: np.ndarray) -> np.ndarray:
+    """
+    Converts raw scores to percentages of the matching available marks. 
+    percent() is applied once per distinct (score, available marks) pair, so 
+    the result is identical to converting each score individually.
+    """
+    pairs, inverse = np.unique(np.stack([scores, available_marks]), axis=1, return_inverse=True)
+    lookup = np.array([percent(int(score), int(available)) for score, available in pairs.T])
+    return lookup[inverse.ravel()]
+
+
+def _summary_from_array(dataset: np.ndarray) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Computes the aggregate statistics over an array of percentage scores.
+    """
     return {
-        "mean": round(np.mean(dataset), 2),
-        "median": np.median(dataset),
-        "stddev" : round(np.std(dataset), 2),
+        "mean": round(float(np.mean(dataset)), 2),
+        "median": float(np.median(dataset)),
+        "stddev" : round(float(np.std(dataset)), 2),
         "min" : int(np.min(dataset)),
         "max" : int(np.max(dataset)),
-        "count" : np.size(dataset),
-        "p25": np.percentile(dataset, 25),
-        "p50": np.percentile(dataset, 50),
-        "p95": np.percentile(dataset, 95),
-    }
\ No newline at end of file
+        "count" : int(np.size(dataset)),
+        "p25": float(np.percentile(dataset, 25)),
+        "p50": float(np.percentile(dataset, 50)),
+        "p95": float(np.percentile(dataset, 95)),
+    }
+
+
+def _window_filters(
+    scanned_from: t.Optional[datetime.datetime], scanned_to: t.Optional[datetime.datetime]
+) -> t.List[t.Any]:
+    """
+    WHERE clauses restricting scores to those scanned in [scanned_from, scanned_to).
+    """
+    filters = []
+    if scanned_from is not None:
+        filters.append(TestScore.scanned_on >= scanned_from)
+    if scanned_to is not None:
+        filters.append(TestScore.scanned_on < scanned_to)
+    return filters
+
+
+def _no_scores_message(test_id: int, windowed: bool) -> str:
+    if windowed:
+        return f"No scores found for test ID {test_id} in the given time window"
+    return f"No test found with test ID {test_id}"
+
+
+def _summary_statement(test_id: int, *filters):
+    """
+    Single Postgres statement reducing a test's scores to how often each 
+    distinct score occurs, at most available marks + 1 rows however many 
+    students sat it.
+
+    Percentages are then derived with percent(), as every other summary 
+    does. Postgres can't reproduce Python's rounding of them (round() on 
+    numeric rounds half away from zero, e.g. 0.625 to 0.63 rather than 
+    0.62), so the statistics over them aren't computed in SQL.
+    """
+    return (
+        select(TestScore.score, func.count(), Test.available_marks)
+        .join(Test, Test.id == TestScore.test_id)
+        .where(TestScore.test_id == test_id, *filters)
+        .group_by(TestScore.score, Test.available_marks)
+        .order_by(TestScore.score)
+    )
+
+
+def compute_test_score_summary(
+    test_id: int,
+    scanned_from: t.Optional[datetime.datetime] = None,
+    scanned_to: t.Optional[datetime.datetime] = None,
+) -> t.Dict[str, t.Union[float, int]]:
+    """
+    Computes aggregate statistics for the given test directly from its stored 
+    scores, without loading any ORM objects. 
+
+    Percentages are derived from the raw scores and the test's current 
+    available marks. On Postgres the DB reduces the scores to a histogram in
+    one statement. Other backends fetch just the score column into a numpy 
+    array. Either way the result matches numpy over every percentage.
+
+    Input: 
+    - test_id for the test of interest 
+    - scanned_from, scanned_to: optionally, only include scores scanned in
+      this (half open, UTC) window. Served by the (test_id, scanned_on) index.
+
+    Output: 
+    - Dictionary with various aggregate statistics pertaining to the given test.
+    """
+    return replica_router.read(
+        [test_id], lambda session: _compute_test_score_summary(session, test_id, scanned_from, scanned_to)
+    )
+
+
+def _compute_test_score_summary(
+    session: Session,
+    test_id: int,
+    scanned_from: t.Optional[datetime.datetime] = None,
+    scanned_to: t.Optional[datetime.datetime] = None,
+) -> t.Dict[str, t.Union[float, int]]:
+    filters = _window_filters(scanned_from, scanned_to)
+    start = time.perf_counter()
+    if session.get_bind().dialect.name == "postgresql":
+        rows = session.execute(_summary_statement(test_id, *filters)).all()
+        if not rows:
+            raise RuntimeError(_no_scores_message(test_id, bool(filters)))
+        fetched = time.perf_counter()
+        counts = [count for _, count, _ in rows]
+        summary = _summary_from_histogram([score for score, _, _ in rows], counts, rows[0][2])
+        metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="scores")
+        metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="scores")
+        metrics.rows_scanned_total.inc(sum(counts), source="scores")
+        return summary
+
+    available_marks = session.execute(
+        select(Test.available_marks).where(Test.id == test_id)
+    ).scalar()
+    scores = np.fromiter(
+        session.execute(
+            select(TestScore.score).where(TestScore.test_id == test_id, *filters)
+        ).scalars(),
+        dtype=np.int64,
+    )
+    if scores.size == 0:
+        raise RuntimeError(_no_scores_message(test_id, bool(filters)))
+
+    fetched = time.perf_counter()
+    summary = _summary_from_array(_percentages(scores, np.full_like(scores, available_marks)))
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="scores")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="scores")
+    metrics.rows_scanned_total.inc(scores.size, source="scores")
+    return summary
+
+
+def rebuild_test_aggregates() -> int:
+    """
+    Recomputes every test's running aggregate from the scores table, e.g. for
+    data imported before aggregates were maintained. 
+
+    Existing aggregates are reset in place with their versions bumped, so a 
+    version (and so an ETag) never stands for two different summaries.
+
+    Output: 
+    - Number of tests whose aggregates were rebuilt.
+    """
+    rows = db.session.execute(
+        select(TestScore.test_id, TestScore.score, func.count())
+        .group_by(TestScore.test_id, TestScore.score)
+    ).all()
+    aggregates: t.Dict[int, TestAggregate] = {agg.test_id: agg for agg in TestAggregate.query}
+    for agg in aggregates.values():
+        agg.count = agg.score_sum = agg.score_sum_sq = 0
+        agg.min_score = agg.max_score = None
+        agg.version += 1
+    histograms: t.Dict[int, t.Dict[str, int]] = {test_id: {} for test_id in aggregates}
+    for test_id, score, count in rows:
+        agg = aggregates.get(test_id)
+        if agg is None:
+            agg = aggregates[test_id] = TestAggregate(
+                test_id=test_id, count=0, score_sum=0, score_sum_sq=0, version=1,
+            )
+            db.session.add(agg)
+            histograms[test_id] = {}
+        agg.count += count
+        agg.score_sum += score * count
+        agg.score_sum_sq += score * score * count
+        histograms[test_id][str(score)] = count
+        agg.min_score = score if agg.min_score is None else min(agg.min_score, score)
+        agg.max_score = score if agg.max_score is None else max(agg.max_score, score)
+    available_marks = dict(db.session.execute(select(Test.id, Test.available_marks)).all())
+    for test_id, histogram in histograms.items():
+        aggregates[test_id].histogram = histogram
+        aggregates[test_id].sketch = _sketch_from_histogram(histogram, available_marks[test_id])
+
+    db.session.commit()
+    import_committed.send(test_ids=frozenset(aggregates))
+    return len(aggregates)
+
+
+def _grouped_summaries(keys: np.ndarray, values: np.ndarray) -> t.Dict[int, t.Dict[str, t.Union[float, int]]]:
+    """
+    Computes the aggregate statistics of every group of values sharing a key 
+    in one vectorized pass: values are sorted by (key, value) and each 
+    statistic is a segment reduction or an index lookup into that order. 
+
+    Results match _summary_from_array applied to each group separately.
+    """
+    if keys.size == 0:
+        return {}
+
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    values = values[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    counts = np.diff(np.concatenate((starts, [keys.size])))
+    ends = starts + counts - 1
+
+    means = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(means, counts)
+    stddevs = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+
+    def percentiles(q: float) -> np.ndarray:
+        # Mirrors numpy's linear method (see _percentile), per group.
+        virtual_index = (counts - 1) * (q / 100)
+        lower = np.floor(virtual_index).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        a = values[starts + lower]
+        b = values[starts + upper]
+        gamma = virtual_index - lower
+        return np.where(gamma >= 0.5, b - (b - a) * (1 - gamma), a + (b - a) * gamma)
+
+    middle = starts + (counts - 1) // 2
+    medians = np.where(counts % 2 == 1, values[middle], (values[middle] + values[np.minimum(middle + 1, ends)]) / 2)
+    p25, p50, p95 = percentiles(25), percentiles(50), percentiles(95)
+
+    return {
+        int(keys[start]): {
+            "mean": round(float(means[i]), 2),
+            "median": float(medians[i]),
+            "stddev": round(float(stddevs[i]), 2),
+            "min": int(values[start]),
+            "max": int(values[ends[i]]),
+            "count": int(counts[i]),
+            "p25": float(p25[i]),
+            "p50": float(p50[i]),
+            "p95": float(p95[i]),
+        }
+        for i, start in enumerate(starts)
+    }
+
+
+def compute_test_score_summaries(
+    test_ids: t.Iterable[int],
+) -> t.Tuple[t.Dict[int, t.Dict[str, t.Union[float, int]]], t.Dict[int, str]]:
+    """
+    Computes aggregate statistics for many tests at once, fetching all of 
+    their scores with a single query.
+
+    Input: 
+    - test_ids of the tests of interest
+
+    Output: 
+    - Tuple of a dictionary of statistics by test ID, and a dictionary of
+      error messages by test ID for tests with no scores.
+    """
+    test_ids = list(dict.fromkeys(test_ids))
+    start = time.perf_counter()
+    rows = replica_router.read(test_ids, lambda session: session.execute(
+        select(TestScore.test_id, TestScore.score, Test.available_marks)
+        .join(Test, Test.id == TestScore.test_id)
+        .where(TestScore.test_id.in_(test_ids))
+    ).all())
+    fetched = time.perf_counter()
+    scores = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    summaries = _grouped_summaries(scores[:, 0], _percentages(scores[:, 1], scores[:, 2]))
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="scores_batch")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="scores_batch")
+    metrics.rows_scanned_total.inc(len(rows), source="scores_batch")
+
+    errors = {
+        test_id: f"No test found with test ID {test_id}"
+        for test_id in test_ids if test_id not in summaries
+    }
+    return summaries, errors
+
+
+def iter_score_batches(
+    test_id: t.Optional[int] = None, batch_size: int = 5000
+) -> t.Iterator[t.List[t.Tuple[int, int, str, str, int, int, t.Optional[datetime.datetime]]]]:
+    """
+    Streams every stored score of a test (or of every test), joined with the
+    student's name and the test's available marks, ordered by test and 
+    student. Rows are fetched batch_size at a time through a server side 
+    cursor where the DB supports one, so memory does not grow with the 
+    number of scores.
+
+    Output:
+    - Lists of (test_id, student_id, first name, last name, score, 
+      available marks, scanned on) tuples.
+    """
+    stmt = (
+        select(
+            TestScore.test_id,
+            TestScore.student_id,
+            Student.fname,
+            Student.lname,
+            TestScore.score,
+            Test.available_marks,
+            TestScore.scanned_on,
+        )
+        .join(Student, Student.id == TestScore.student_id)
+        .join(Test, Test.id == TestScore.test_id)
+        .order_by(TestScore.test_id, TestScore.student_id)
+    )
+    if test_id is not None:
+        stmt = stmt.where(TestScore.test_id == test_id)
+
+    with replica_router.streaming_session([test_id] if test_id is not None else []) as session:
+        result = session.execute(stmt, execution_options={"yield_per": batch_size})
+        for partition in result.partitions():
+            metrics.rows_scanned_total.inc(len(partition), source="export")
+            yield [tuple(row) for row in partition]
+
+
+# Units of the time series buckets, as numpy datetime64 units. Weeks are
+# handled separately so that they start on a Monday.
+TIMESERIES_BUCKETS: t.Dict[str, str] = {"hour": "h", "day": "D", "week": "D", "month": "M", "year": "Y"}
+
+
+def _epoch_seconds(session: Session, column):
+    """
+    SQL expression for a timestamp column as seconds since the Unix epoch.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return cast(func.extract("epoch", column), BigInteger)
+    return cast(func.strftime("%s", column), BigInteger)
+
+
+def _bucket_starts(epoch_seconds: np.ndarray, bucket: str) -> np.ndarray:
+    """
+    Maps each timestamp (seconds since the epoch) to the start of its bucket,
+    as datetime64[s].
+    """
+    timestamps = epoch_seconds.astype("datetime64[s]")
+    if bucket == "week":
+        # The epoch was a Thursday, so shift by 3 days to start weeks on Monday.
+        days = timestamps.astype("datetime64[D]").astype(np.int64)
+        return ((days + 3) // 7 * 7 - 3).astype("datetime64[D]").astype("datetime64[s]")
+    return timestamps.astype(f"datetime64[{TIMESERIES_BUCKETS[bucket]}]").astype("datetime64[s]")
+
+
+def compute_test_score_timeseries(
+    test_id: int,
+    bucket: str = "day",
+    scanned_from: t.Optional[datetime.datetime] = None,
+    scanned_to: t.Optional[datetime.datetime] = None,
+) -> t.List[t.Dict[str, t.Union[float, int, str]]]:
+    """
+    Computes aggregate statistics for each hour/day/week/month/year (UTC) in
+    which a test's scores were scanned. Every score is fetched with a single
+    query and the buckets are summarised in one vectorized pass.
+
+    Input: 
+    - test_id for the test of interest 
+    - bucket: one of TIMESERIES_BUCKETS
+    - scanned_from, scanned_to: optionally, only include scores scanned in
+      this (half open, UTC) window.
+
+    Output: 
+    - List of statistics dictionaries, one per bucket with any scores, in 
+      time order. Each has the bucket's start time under "bucket".
+    """
+    if bucket not in TIMESERIES_BUCKETS:
+        raise RuntimeError(f"Unknown bucket {bucket}, must be one of {', '.join(TIMESERIES_BUCKETS)}")
+    filters = _window_filters(scanned_from, scanned_to)
+
+    start = time.perf_counter()
+    rows = replica_router.read([test_id], lambda session: session.execute(
+        select(_epoch_seconds(session, TestScore.scanned_on), TestScore.score, Test.available_marks)
+        .join(Test, Test.id == TestScore.test_id)
+        .where(TestScore.test_id == test_id, TestScore.scanned_on.is_not(None), *filters)
+    ).all())
+    if not rows:
+        raise RuntimeError(_no_scores_message(test_id, True))
+
+    fetched = time.perf_counter()
+    scores = np.array(rows, dtype=np.int64)
+    buckets = _bucket_starts(scores[:, 0], bucket)
+    summaries = _grouped_summaries(buckets.astype(np.int64), _percentages(scores[:, 1], scores[:, 2]))
+    series = [
+        {"bucket": f"{np.datetime64(key, 's')}Z", **summary}
+        for key, summary in sorted(summaries.items())
+    ]
+    metrics.aggregate_stage_seconds.observe(fetched - start, stage="db_fetch", source="timeseries")
+    metrics.aggregate_stage_seconds.observe(time.perf_counter() - fetched, stage="compute", source="timeseries")
+    metrics.rows_scanned_total.inc(len(rows), source="timeseries")
+    return series
+
+
+def get_item_analysis(test_id: int) -> t.Dict[str, t.Any]:
+    """
+    Computes per-question statistics for a test from the answers stored with
+    its scores: facility (mean proportion of marks awarded), the distribution
+    of chosen options, and the point-biserial correlation between marks on
+    the question and the total score.
+
+    All answers are unpacked into a student-by-question matrix and every 
+    statistic is computed over it in one vectorized pass.
+
+    Input: 
+    - test_id for the test of interest 
+
+    Output: 
+    - Dictionary with the number of students and a list of per-question stats.
+    """
+    rows = replica_router.read([test_id], lambda session: session.execute(
+        select(TestScore.score, TestScore.answers)
+        .where(TestScore.test_id == test_id, TestScore.answers.is_not(None))
+    ).all())
+    if not rows:
+        raise RuntimeError(f"No answers found for test ID {test_id}")
+
+    answer_sets = [np.frombuffer(answers, dtype=_answer_dtype()) for _, answers in rows]
+    answers = np.concatenate(answer_sets)
+    totals = np.array([score for score, _ in rows], dtype=np.float64)
+    students = np.repeat(np.arange(len(rows)), [len(a) for a in answer_sets])
+    questions, question_idx = np.unique(answers["question"], return_inverse=True)
+
+    # Unanswered questions count as zero marks awarded.
+    awarded = np.zeros((len(rows), len(questions)))
+    awarded[students, question_idx] = answers["awarded"]
+    available = np.zeros(len(questions))
+    np.maximum.at(available, question_idx, answers["available"])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        facility = awarded.mean(axis=0) / available
+        awarded_dev = awarded - awarded.mean(axis=0)
+        total_dev = totals - totals.mean()
+        point_biserial = (awarded_dev * total_dev[:, None]).sum(axis=0) / np.sqrt(
+            (awarded_dev ** 2).sum(axis=0) * (total_dev ** 2).sum()
+        )
+
+    option_names, option_idx = np.unique(answers["option"], return_inverse=True)
+    option_counts = np.zeros((len(questions), len(option_names)), dtype=np.int64)
+    np.add.at(option_counts, (question_idx, option_idx), 1)
+
+    def finite(value: float) -> t.Optional[float]:
+        # Undefined when nobody or everybody got the question right.
+        return round(float(value), 4) if np.isfinite(value) else None
+
+    return {
+        "count": len(rows),
+        "items": [
+            {
+                "question": int(question),
+                "marks_available": int(available[i]),
+                "facility": finite(facility[i]),
+                "point_biserial": finite(point_biserial[i]),
+                "options": {
+                    option.decode(): int(count)
+                    for option, count in zip(option_names, option_counts[i]) if count
+                },
+            }
+            for i, question in enumerate(questions)
+        ],
+    }
+
+
+def _percentile_rank(histogram: t.Dict[str, int], count: int, score: int) -> float:
+    """
+    Percentage of a test's scores below the given score, counting half of
+    those equal to it, from the test's raw score histogram.
+    """
+    below = equal = 0
+    for value, n in histogram.items():
+        if int(value) < score:
+            below += n
+        elif int(value) == score:
+            equal += n
+    return round((below + equal / 2) / count * 100, 2)
+
+
+def get_student_results(student_id: int) -> t.Dict[str, t.Any]:
+    """
+    Returns a student's score in each test they have sat, with their 
+    percentile rank within the test.
+
+    Scores, tests and running aggregates are read with a single query, 
+    found through the (student_id, test_id) index, and each rank is 
+    computed from the test's score histogram. The cost depends on the 
+    number of tests the student has sat, not on the number of scores.
+
+    Input: 
+    - student_id (student number) of the student of interest
+
+    Output: 
+    - Dictionary with the student's name and a list of their results 
+      ordered by test ID.
+    """
+    # The student's tests aren't known until read, so a replica may serve
+    # them without the read-your-writes window applying.
+    rows = replica_router.read([], lambda session: session.execute(
+        select(
+            Student.fname,
+            Student.lname,
+            TestScore.test_id,
+            TestScore.score,
+            TestScore.scanned_on,
+            Test.available_marks,
+            TestAggregate.count,
+            TestAggregate.histogram,
+        )
+        .select_from(Student)
+        .outerjoin(TestScore, TestScore.student_id == Student.id)
+        .outerjoin(Test, Test.id == TestScore.test_id)
+        .outerjoin(TestAggregate, TestAggregate.test_id == TestScore.test_id)
+        .where(Student.id == student_id)
+        .order_by(TestScore.test_id)
+    ).all())
+    if not rows:
+        raise RuntimeError(f"No student found with student ID {student_id}")
+
+    results = []
+    for _, _, test_id, score, scanned_on, available_marks, count, histogram in rows:
+        if test_id is None:
+            # The student has no scores.
+            continue
+        if scanned_on is not None and scanned_on.tzinfo is None:
+            # Stored in UTC, but SQLite drops the offset.
+            scanned_on = scanned_on.replace(tzinfo=datetime.timezone.utc)
+        results.append({
+            "test_id": test_id,
+            "score": score,
+            "available_marks": available_marks,
+            "percent_score": percent(score, available_marks),
+            # None for scores imported before aggregates were maintained,
+            # until rebuild-aggregates is run.
+            "percentile_rank": _percentile_rank(histogram, count, score) if count else None,
+            "scanned_on": scanned_on.isoformat() if scanned_on is not None else None,
+        })
+    return {
+        "student_id": student_id,
+        "first_name": rows[0][0],
+        "last_name": rows[0][1],
+        "results": results,
+    }
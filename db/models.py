@@ -1,9 +1,14 @@
+import datetime
 import os
+import threading
+import time
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship
 
 db = SQLAlchemy()
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
 
 class Student(db.Model):
     __tablename__ = "students"
@@ -28,6 +33,15 @@ class Test(db.Model):
 
 class TestScore(db.Model):
     __tablename__ = "test_scores"
+    # A student has at most one (their highest) score per test. Imports
+    # upsert against this constraint.
+    __table_args__ = (
+        db.UniqueConstraint("test_id", "student_id", name="uq_test_scores_test_id_student_id"),
+        # Serves aggregates over a date range of one test's scores.
+        db.Index("ix_test_scores_test_id_scanned_on", "test_id", "scanned_on"),
+        # Serves a student's results across tests.
+        db.Index("ix_test_scores_student_id_test_id", "student_id", "test_id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -36,19 +50,134 @@ class TestScore(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey("students.id"), nullable=False)
 
     score = db.Column(db.Integer, nullable=False) # Assume half marks are not given
-    percent_score = db.Column(db.Float, nullable=False)
-    # TODO: potentially record the time the test score was scanned
+    # Per-question answers packed as a numpy record array, see 
+    # db_helpers.ANSWER_DTYPE. One blob per score rather than a row per answer.
+    answers = db.Column(db.LargeBinary)
+    # When the stored (highest) score was scanned, in UTC. Null for scores 
+    # imported before this was recorded.
+    scanned_on = db.Column(db.DateTime(timezone=True))
 
     student = relationship("Student", back_populates="test_scores")
     test = relationship("Test", back_populates="test_scores")
 
+    @property
+    def percent_score(self) -> float:
+        # Derived from the test's current available marks rather than stored,
+        # so raising a test's available marks never rewrites its scores.
+        return round((self.score / self.test.available_marks) * 100, 2)
+
+
+class TestAggregate(db.Model):
+    """
+    Running statistics for a test, maintained by imports so the aggregate 
+    endpoint never has to scan test_scores.
+
+    Moments and the histogram are kept over raw scores, percentages are 
+    derived at read time from the test's current available marks. The 
+    sketch alone is kept over percentages. Summaries are read from the 
+    histogram, approximate ones from the sketch, moments, min and max.
+    """
+    __tablename__ = "test_aggregates"
+
+    test_id = db.Column(db.Integer, db.ForeignKey("tests.id"), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    score_sum_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    min_score = db.Column(db.Integer)
+    max_score = db.Column(db.Integer)
+    # Maps raw score (as a string, since JSON keys must be) -> number of students
+    histogram = db.Column(db.JSON, nullable=False, default=dict)
+    # Maps percentage bin (its index in steps of db_helpers.SKETCH_BIN_WIDTH, as a string)
+    # -> number of students. Rebuilt from the histogram whenever an import 
+    # touches the test. Missing for aggregates written before it was kept.
+    sketch = db.Column(db.JSON)
+    # Bumped by every import touching the test, used to validate cached 
+    # summaries and as the aggregate endpoint's ETag.
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    test = relationship("Test")
+
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ImportFingerprint(db.Model):
+    """
+    SHA-256 of an upload's body, recorded when its import commits so that
+    retried uploads can be answered without being parsed again.
+    """
+    __tablename__ = "import_fingerprints"
+
+    digest = db.Column(db.String(64), primary_key=True)
+    # Number of test results in the upload
+    records = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=_utcnow, index=True)
+
+
+class RecordFingerprint(db.Model):
+    """
+    Hash of a test result's student, test and marks. A result whose
+    fingerprint is already recorded cannot change anything, so is skipped.
+    """
+    __tablename__ = "record_fingerprints"
+
+    digest = db.Column(db.LargeBinary(16), primary_key=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=_utcnow, index=True)
+
+class ImportJobStatus(db.Model):
+    """
+    Status of an asynchronous import (see markr.jobs.ImportJob), shared so 
+    any worker process can report on a job another one is running.
+    """
+    __tablename__ = "import_jobs"
+
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False)
+    records_processed = db.Column(db.Integer, nullable=False, default=0)
+    records_skipped = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    # Seconds since the epoch, as ImportJob keeps them.
+    submitted_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float, index=True)
+
+
+def engine_options(uri: str) -> dict:
+    """
+    Connection pool settings for the engine, tunable from the environment. 
+    SQLite keeps SQLAlchemy's defaults, since its pools are not sized.
+    """
+    if uri.startswith("sqlite"):
+        return {}
+
+    options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        # Test connections on checkout so ones dropped by the DB or a proxy
+        # are replaced rather than failing a request.
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true"),
+    }
+    statement_timeout = os.getenv("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout and uri.startswith("postgresql"):
+        options["connect_args"] = {"options": f"-c statement_timeout={int(statement_timeout)}"}
+    return options
+
 
 def init_db(app):
     """
-    Initialize & migrates the database.
+    Configures the app's database engine from the environment, along with 
+    any read replica binds and Flask-Migrate. Never changes the schema, 
+    except to create it for the in-memory test database.
     """
-    # Use sqlite in memory db for testing 
-    if os.getenv("RUN_ENV") == "TESTING":
+    # An explicit DATABASE_URL takes precedence, e.g. to benchmark against a
+    # local database. Otherwise use sqlite in memory db for testing
+    if os.getenv("DATABASE_URL"):
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
+    elif os.getenv("RUN_ENV") == "TESTING":
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql+psycopg2://{}:{}@{}/{}".format(
@@ -57,9 +186,59 @@ def init_db(app):
             os.getenv("DB_HOST", "db"),
             os.getenv("DB", "markr"),
         )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+    # Optional read replicas, comma separated, registered as binds for 
+    # markr.replicas to route reads to. Models stay bound to the primary.
+    replica_uris = [uri.strip() for uri in os.getenv("DB_REPLICA_URIS", "").split(",") if uri.strip()]
+    app.config["SQLALCHEMY_BINDS"] = {
+        f"replica{i}": {"url": uri, **engine_options(uri)} for i, uri in enumerate(replica_uris)
+    }
     db.app = app
     db.init_app(app)
-    Migrate(app, db)
+    # Migrations live beside the package rather than in the working directory.
+    Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
+
+    # The in-memory test database starts empty every time. Real databases 
+    # are only changed explicitly, by running the migrations in 
+    # MIGRATIONS_DIRECTORY with `flask db upgrade`.
+    if app.config["SQLALCHEMY_DATABASE_URI"] == "sqlite:///:memory:":
+        create_schema(app)
+
 
+def create_schema(app):
+    """
+    Creates any tables (and their indexes) missing from the database, 
+    straight from the models. For test databases; real databases are 
+    migrated instead, so their revision is tracked.
+    """
     with app.app_context():
         db.create_all()
+
+
+def warm_pool(app) -> threading.Thread:
+    """
+    Opens a full pool of connections to each database in a background 
+    thread, retrying every second until the database accepts them, so the
+    first requests don't pay to connect. Sets 
+    app.extensions["markr_pool_warm"] once done.
+    """
+    def run():
+        with app.app_context():
+            engines = list(db.engines.values())
+        for engine in engines:
+            # Pools that aren't sized (e.g. SQLite's) are warmed with one connection.
+            size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+            while True:
+                try:
+                    connections = [engine.connect() for _ in range(size)]
+                    break
+                except OperationalError:
+                    time.sleep(1)
+            # Closing returns the connections to the pool, still open.
+            for connection in connections:
+                connection.close()
+        app.extensions["markr_pool_warm"] = True
+
+    thread = threading.Thread(target=run, name="markr-pool-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,148 @@
+import csv
+import datetime
+import io
+import json
+import typing as t
+
+from markr.db.db_helpers import percent
+
+# Columns of an exported score, in order.
+EXPORT_COLUMNS: t.Tuple[str, ...] = (
+    "test_id",
+    "student_id",
+    "first_name",
+    "last_name",
+    "score",
+    "available_marks",
+    "percent_score",
+    "scanned_on",
+)
+
+# Export formats by mimetype, in order of preference when the client accepts any.
+EXPORT_MIMETYPES: t.Dict[str, str] = {
+    "application/x-ndjson": "ndjson",
+    "text/csv": "csv",
+    "application/vnd.apache.parquet": "parquet",
+}
+
+Row = t.Tuple[int, int, str, str, int, int, t.Optional[datetime.datetime]]
+
+
+class ExportFormatError(RuntimeError):
+    """
+    Raised for an export format that is unknown, or whose library is not installed.
+    """
+
+
+def _records(batch: t.Sequence[Row]) -> t.Iterator[t.Tuple[t.Any, ...]]:
+    for test_id, student_id, fname, lname, score, available_marks, scanned_on in batch:
+        if scanned_on is not None and scanned_on.tzinfo is None:
+            # Stored in UTC, but SQLite drops the offset.
+            scanned_on = scanned_on.replace(tzinfo=datetime.timezone.utc)
+        yield test_id, student_id, fname, lname, score, available_marks, percent(score, available_marks), scanned_on
+
+
+def _ndjson(batches: t.Iterable[t.Sequence[Row]]) -> t.Iterator[bytes]:
+    for batch in batches:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, record)), default=datetime.datetime.isoformat) + "\n"
+            for record in _records(batch)
+        ).encode()
+
+
+def _csv(batches: t.Iterable[t.Sequence[Row]]) -> t.Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows(
+            record[:-1] + (record[-1].isoformat() if record[-1] else "",) for record in _records(batch)
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # An empty export is still a valid CSV file.
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file collecting what is written to it until drained, so a
+    ParquetWriter can be streamed. Reports its position as the total
+    written, since the Parquet footer records absolute offsets.
+    """
+
+    def __init__(self):
+        self._chunks: t.List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _parquet(batches: t.Iterable[t.Sequence[Row]]) -> t.Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("test_id", pa.int64()),
+        ("student_id", pa.int64()),
+        ("first_name", pa.string()),
+        ("last_name", pa.string()),
+        ("score", pa.int32()),
+        ("available_marks", pa.int32()),
+        ("percent_score", pa.float64()),
+        ("scanned_on", pa.timestamp("us", tz="UTC")),
+    ])
+    sink = _ChunkSink()
+    # Each batch becomes a row group, flushed to the client once written.
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            columns = list(zip(*_records(batch)))
+            writer.write_table(pa.table(dict(zip(EXPORT_COLUMNS, columns)), schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+_WRITERS: t.Dict[str, t.Callable[[t.Iterable[t.Sequence[Row]]], t.Iterator[bytes]]] = {
+    "ndjson": _ndjson,
+    "csv": _csv,
+    "parquet": _parquet,
+}
+
+
+def check_format(fmt: str):
+    """
+    Raises ExportFormatError unless scores can be exported as fmt.
+    """
+    if fmt not in _WRITERS:
+        raise ExportFormatError(f"Unknown export format {fmt}, must be one of {', '.join(_WRITERS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ExportFormatError("The pyarrow package is required to export Parquet")
+
+
+def render(batches: t.Iterable[t.Sequence[Row]], fmt: str) -> t.Iterator[bytes]:
+    """
+    Input: batches of (test_id, student_id, first name, last name, score,
+    available marks, scanned on) rows, and an export format (see check_format).
+    Output: the encoded export, one chunk per batch, so only one batch is
+    held in memory at a time.
+    """
+    return _WRITERS[fmt](batches)
@@ -0,0 +1,56 @@
+"""
+Production server configuration: `gunicorn -c gunicorn.conf.py markr.app:app`.
+
+Every setting can be overridden from the environment.
+"""
+import os
+import sys
+
+# The markr package lives in this directory, so its parent must be importable.
+pythonpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, pythonpath)
+
+bind = os.getenv("MARKR_BIND", "0.0.0.0:4567")
+workers = int(os.getenv("MARKR_WORKERS", (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.getenv("MARKR_THREADS", 4))
+worker_class = "gthread"
+# Import requests may legitimately take a while for large batches.
+timeout = int(os.getenv("MARKR_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("MARKR_GRACEFUL_TIMEOUT", 60))
+keepalive = int(os.getenv("MARKR_KEEPALIVE", 5))
+max_requests = int(os.getenv("MARKR_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("MARKR_MAX_REQUESTS_JITTER", 0))
+# Load the app once in the master so workers share its memory.
+preload_app = os.getenv("MARKR_PRELOAD", "true").lower() in ("1", "true")
+# An empty MARKR_ACCESS_LOG disables access logging.
+accesslog = os.getenv("MARKR_ACCESS_LOG", "-") or None
+
+
+def post_fork(server, worker):
+    """
+    Drops any pooled connections inherited from the master, so no DB
+    connection is ever shared between processes, then fills the worker's 
+    own pool and maps the score store's snapshot in the background.
+    """
+    from markr.app import app
+    from markr.db.models import db, warm_pool
+    from markr.scorestore import score_store
+
+    with app.app_context():
+        # close=False leaves the parent's connections open for the parent.
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    warm_pool(app)
+    score_store.start(app, app.config["SCORE_STORE_SNAPSHOT_SECONDS"])
+
+
+def worker_exit(server, worker):
+    """
+    Lets queued and running asynchronous imports finish before the worker 
+    exits, then stops its parse processes.
+    """
+    from markr.jobs import import_jobs
+    from markr.parsing import shutdown_parse_pool
+
+    import_jobs.shutdown(wait=True)
+    shutdown_parse_pool()
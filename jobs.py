@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+import typing as t
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from markr.db.models import ImportJobStatus, db
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised when an import job is submitted while the queue is at capacity.
+    """
+
+
+@dataclass
+class ImportJob:
+    """
+    Status of an asynchronous import, as reported by /import/jobs/<id>.
+    """
+    id: str
+    status: str = "queued"  # queued -> running -> succeeded | failed
+    records_processed: int = 0
+    records_skipped: int = 0
+    error: t.Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: t.Optional[float] = None
+    finished_at: t.Optional[float] = None
+
+    def set_progress(self, records_processed: int):
+        self.records_processed = records_processed
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> t.Dict[str, t.Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "records_processed": self.records_processed,
+            "records_skipped": self.records_skipped,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_seconds": round((self.started_at or time.time()) - self.submitted_at, 3),
+            "run_seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+        }
+
+
+class JobStore:
+    """
+    Where ImportJobQueue records each job's status as it changes, so other
+    processes can report on it. Stores must be safe to use from multiple 
+    threads.
+    """
+
+    def save(self, job: ImportJob):
+        raise NotImplementedError
+
+    def load(self, job_id: str) -> t.Optional[ImportJob]:
+        raise NotImplementedError
+
+
+class DatabaseJobStore(JobStore):
+    """
+    Keeps job statuses in the import_jobs table. Only status changes are
+    written, since progress updates come from inside the import's own 
+    transaction. Finished jobs are deleted after retention seconds.
+    """
+
+    def __init__(self, app, retention: int):
+        self.app = app
+        self.retention = retention
+
+    def save(self, job: ImportJob):
+        # A context of its own, so the job's status is committed apart from
+        # any session the caller has open.
+        with self.app.app_context():
+            db.session.merge(ImportJobStatus(
+                id=job.id,
+                status=job.status,
+                records_processed=job.records_processed,
+                records_skipped=job.records_skipped,
+                error=job.error,
+                submitted_at=job.submitted_at,
+                started_at=job.started_at,
+                finished_at=job.finished_at,
+            ))
+            if job.status == "queued":
+                ImportJobStatus.query.filter(ImportJobStatus.finished_at < time.time() - self.retention).delete()
+            db.session.commit()
+
+    def load(self, job_id: str) -> t.Optional[ImportJob]:
+        with self.app.app_context():
+            row = db.session.get(ImportJobStatus, job_id)
+            if row is None:
+                return None
+            return ImportJob(
+                id=row.id,
+                status=row.status,
+                records_processed=row.records_processed,
+                records_skipped=row.records_skipped,
+                error=row.error,
+                submitted_at=row.submitted_at,
+                started_at=row.started_at,
+                finished_at=row.finished_at,
+            )
+
+
+class ImportJobQueue:
+    """
+    Runs imports on a background thread pool. At most max_pending jobs may be
+    queued or running at once, further submissions are refused so callers can
+    apply backpressure.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8, retention: int = 1000):
+        self._executor: t.Optional[ThreadPoolExecutor] = None
+        self._jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(workers, max_pending, retention)
+
+    def configure(self, workers: int, max_pending: int, retention: int = 1000):
+        """
+        (Re)sizes the pool and queue. Waits for any running jobs to finish.
+        """
+        self.shutdown(wait=True)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, run: t.Callable[[ImportJob], int], store: t.Optional[JobStore] = None) -> ImportJob:
+        """
+        Queues run(job), which performs the import and returns the number of
+        records imported. Any exception it raises marks the job as failed
+        with the exception's message. The job's status is saved to store,
+        if given, whenever it changes.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(f"Import queue is full ({self.max_pending} jobs pending)")
+
+        job = ImportJob(id=uuid.uuid4().hex)
+        if store is not None:
+            try:
+                store.save(job)
+            except Exception:
+                self._slots.release()
+                raise
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="markr-import")
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, run, store)
+        return job
+
+    def get(self, job_id: str, store: t.Optional[JobStore] = None) -> t.Optional[ImportJob]:
+        """
+        Returns the job, with its live progress if it was submitted to this
+        process, or else as last saved to store.
+        """
+        job = self._jobs.get(job_id)
+        if job is None and store is not None:
+            job = store.load(job_id)
+        return job
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run(self, job: ImportJob, run: t.Callable[[ImportJob], int], store: t.Optional[JobStore]):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            if store is not None:
+                store.save(job)
+            job.records_processed = run(job)
+            job.status = "succeeded"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            self._slots.release()
+            if store is not None:
+                try:
+                    store.save(job)
+                except Exception:
+                    # Still reported by this process, which kept the job.
+                    pass
+
+    def _prune(self):
+        # Forget the oldest finished jobs once more than `retention` are held.
+        excess = len(self._jobs) - self.retention
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][:max(excess, 0)]:
+            del self._jobs[job_id]
+
+
+import_jobs = ImportJobQueue()
+
+
+def init_jobs(app):
+    """
+    Configures the asynchronous import queue from the environment.
+    """
+    app.config.setdefault("IMPORT_WORKERS", int(os.getenv("IMPORT_WORKERS", 2)))
+    app.config.setdefault("IMPORT_QUEUE_SIZE", int(os.getenv("IMPORT_QUEUE_SIZE", 8)))
+    # Uploads larger than this are spooled to a temporary file rather than memory.
+    app.config.setdefault("IMPORT_SPOOL_MEMORY", int(os.getenv("IMPORT_SPOOL_MEMORY", 8 * 1024 * 1024)))
+    # Finished jobs' statuses are kept in the database for this long.
+    app.config.setdefault("IMPORT_JOB_RETENTION", int(os.getenv("IMPORT_JOB_RETENTION", 24 * 60 * 60)))
+
+    import_jobs.configure(app.config["IMPORT_WORKERS"], app.config["IMPORT_QUEUE_SIZE"])
+    app.extensions["markr_job_store"] = DatabaseJobStore(app, app.config["IMPORT_JOB_RETENTION"])
@@ -0,0 +1,331 @@
+import asyncio
+import json
+import os
+import typing as t
+
+from flask import Flask, current_app
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from markr import metrics
+from markr.db.db_helpers import get_primary_test_score_summary
+from markr.db.models import TestAggregate, db
+from markr.signals import import_committed
+
+# Postgres channel imports are announced on, with the comma separated IDs of
+# the tests they touched as the payload.
+NOTIFY_CHANNEL = "markr_import_committed"
+# Payloads are limited to 8000 bytes, so long lists of IDs are split.
+_NOTIFY_PAYLOAD_BYTES = 7000
+
+# A pushed event: its name, JSON data and aggregate version (None for errors).
+Event = t.Tuple[str, t.Dict[str, t.Any], t.Optional[int]]
+
+
+def _offer(queue: "asyncio.Queue[Event]", event: Event):
+    # Subscribers only need the latest summary, so a slow client's unsent one is replaced.
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+class AggregateBroadcaster:
+    """
+    Pushes a test's summary to every subscriber of the test after an import
+    touches it.
+
+    Notifications arriving within the debounce window are coalesced, and
+    the touched tests are summarised once per window however many clients
+    subscribe to them. Subscribers are queues on an asyncio event loop, so
+    an idle subscriber costs no thread. Summaries are read off the loop.
+    """
+
+    def __init__(self, debounce: float = 0.5):
+        self.debounce = debounce
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self.recomputations = 0
+        self._load: t.Optional[t.Callable[[t.List[int]], t.Dict[int, Event]]] = None
+        self._subscribers: t.Dict[int, t.Set["asyncio.Queue[Event]"]] = {}
+        self._dirty: t.Set[int] = set()
+        self._flush: t.Optional[asyncio.Task] = None
+        self._flush_lock: t.Optional[asyncio.Lock] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop, load: t.Callable[[t.List[int]], t.Dict[int, Event]]):
+        """
+        Starts broadcasting on the given loop. load(test_ids) returns the
+        event to push for each test, and is run in the loop's executor.
+        """
+        self.loop = loop
+        self._load = load
+        self._flush_lock = asyncio.Lock()
+
+    def stop(self):
+        if self._flush is not None:
+            self._flush.cancel()
+        self.loop = None
+        self._subscribers.clear()
+        self._dirty.clear()
+        self._flush = None
+
+    def subscribed(self) -> t.List[int]:
+        return list(self._subscribers)
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def subscribe(self, test_id: int) -> "asyncio.Queue[Event]":
+        """
+        Must be called on the loop. The returned queue holds at most the
+        latest event for the test.
+        """
+        queue: "asyncio.Queue[Event]" = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(test_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, test_id: int, queue: "asyncio.Queue[Event]"):
+        queues = self._subscribers.get(test_id, set())
+        queues.discard(queue)
+        if not queues:
+            self._subscribers.pop(test_id, None)
+
+    def notify(self, test_ids: t.Iterable[int]):
+        """
+        Marks tests as changed. Safe to call from any thread.
+        """
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._mark_dirty, frozenset(test_ids))
+
+    def _mark_dirty(self, test_ids: t.FrozenSet[int]):
+        self._dirty |= {test_id for test_id in test_ids if test_id in self._subscribers}
+        if self._dirty and self._flush is None:
+            self._flush = self.loop.create_task(self._flush_after_debounce())
+
+    async def _flush_after_debounce(self):
+        await asyncio.sleep(self.debounce)
+        # Flushes run one at a time, so events are pushed in the order they were read.
+        async with self._flush_lock:
+            test_ids, self._dirty, self._flush = sorted(self._dirty), set(), None
+            test_ids = [test_id for test_id in test_ids if test_id in self._subscribers]
+            if not test_ids:
+                return
+            events = await self.loop.run_in_executor(None, self._load, test_ids)
+            self.recomputations += 1
+            for test_id, event in events.items():
+                for queue in self._subscribers.get(test_id, ()):
+                    _offer(queue, event)
+
+
+aggregate_broadcaster = AggregateBroadcaster()
+metrics.register_gauge(
+    "markr_aggregate_stream_subscribers",
+    "Clients subscribed to live aggregate updates.",
+    aggregate_broadcaster.subscriber_count,
+)
+
+
+def load_events(app: Flask, test_ids: t.List[int]) -> t.Dict[int, Event]:
+    """
+    Reads the current summary of each test, as the event to push for it.
+    """
+    events: t.Dict[int, Event] = {}
+    with app.app_context():
+        for test_id in test_ids:
+            try:
+                summary, version = get_primary_test_score_summary(test_id)
+                events[test_id] = ("aggregate", summary, version)
+            except RuntimeError as e:
+                events[test_id] = ("error", {"error": str(e)}, None)
+    return events
+
+
+@import_committed.connect
+def _announce_import(sender, test_ids: t.FrozenSet[int]):
+    aggregate_broadcaster.notify(test_ids)
+    if not test_ids or db.session.get_bind().dialect.name != "postgresql":
+        return
+
+    # Tell stream servers in other processes, see _listen.
+    payloads, payload = [], ""
+    for test_id in sorted(test_ids):
+        if len(payload) > _NOTIFY_PAYLOAD_BYTES:
+            payloads.append(payload)
+            payload = ""
+        payload += f"{',' if payload else ''}{test_id}"
+    payloads.append(payload)
+    try:
+        for payload in payloads:
+            db.session.execute(select(func.pg_notify(NOTIFY_CHANNEL, payload)))
+        db.session.commit()
+    except SQLAlchemyError as e:
+        # The import itself has committed, so don't fail it. Stream servers
+        # polling for changes will still pick it up.
+        db.session.rollback()
+        current_app.logger.warning("Unable to announce import of tests %s: %s", sorted(test_ids), e)
+
+
+def _format_event(event: Event) -> bytes:
+    name, data, version = event
+    lines = [f"event: {name}"]
+    if version is not None:
+        lines.append(f"id: {version}")
+    lines.append(f"data: {json.dumps(data)}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def _listen(app: Flask, broadcaster: AggregateBroadcaster):
+    """
+    Notifies the broadcaster of imports committed by other processes, as
+    announced on NOTIFY_CHANNEL. Needs Postgres and psycopg2. Otherwise
+    subscribed tests' aggregate versions are polled.
+    """
+    loop = asyncio.get_running_loop()
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2":
+        connection = engine.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+            def on_notify():
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    payload = dbapi_connection.notifies.pop(0).payload
+                    broadcaster.notify(int(test_id) for test_id in payload.split(",") if test_id)
+
+            loop.add_reader(dbapi_connection.fileno(), on_notify)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                loop.remove_reader(dbapi_connection.fileno())
+        finally:
+            # The connection's state was changed, so don't return it to the pool.
+            connection.invalidate()
+            connection.close()
+        return
+
+    versions: t.Dict[int, t.Optional[int]] = {}
+
+    def read_versions(test_ids: t.List[int]) -> t.Dict[int, int]:
+        with app.app_context():
+            return dict(db.session.execute(
+                select(TestAggregate.test_id, TestAggregate.version).where(TestAggregate.test_id.in_(test_ids))
+            ).all())
+
+    while True:
+        await asyncio.sleep(app.config["AGGREGATE_STREAM_POLL_SECONDS"])
+        test_ids = broadcaster.subscribed()
+        if not test_ids:
+            continue
+        try:
+            current = await loop.run_in_executor(None, read_versions, test_ids)
+        except SQLAlchemyError:
+            continue
+        # Tests seen for the first time are refreshed too, in case an import
+        # landed between a client's initial summary and this poll. Streams 
+        # skip updates they have already sent.
+        broadcaster.notify(
+            test_id for test_id in test_ids
+            if test_id not in versions or current.get(test_id) != versions[test_id]
+        )
+        versions = {test_id: current.get(test_id) for test_id in test_ids}
+
+
+def init_live(app: Flask):
+    """
+    Configures live aggregate updates from the environment.
+    """
+    # Imports within this many seconds of each other are pushed as one update.
+    app.config.setdefault(
+        "AGGREGATE_STREAM_DEBOUNCE_SECONDS", float(os.getenv("AGGREGATE_STREAM_DEBOUNCE_SECONDS", 0.5))
+    )
+    # Idle streams are sent a comment this often, so proxies keep them open
+    # and disconnected clients are noticed.
+    app.config.setdefault(
+        "AGGREGATE_STREAM_KEEPALIVE_SECONDS", float(os.getenv("AGGREGATE_STREAM_KEEPALIVE_SECONDS", 15))
+    )
+    # How often versions are polled when Postgres notifications aren't available.
+    app.config.setdefault("AGGREGATE_STREAM_POLL_SECONDS", float(os.getenv("AGGREGATE_STREAM_POLL_SECONDS", 1)))
+
+
+def create_stream_app(app: Flask, broadcaster: AggregateBroadcaster = aggregate_broadcaster):
+    """
+    Builds the aiohttp application serving /results/<test_id>/aggregate/stream
+    as Server-Sent Events, for the markr app's database.
+
+    Each stream starts with the test's current summary, followed by the new
+    summary whenever an import touches the test. Events are named
+    `aggregate` (data: the statistics, id: the aggregate version) or
+    `error` (e.g. while the test has no scores).
+    """
+    from aiohttp import web
+
+    routes = web.RouteTableDef()
+    listener_key = web.AppKey("listener", asyncio.Task)
+
+    @routes.get("/results/{test_id}/aggregate/stream")
+    async def stream(request: web.Request) -> web.StreamResponse:
+        try:
+            test_id = int(request.match_info["test_id"])
+        except ValueError:
+            raise web.HTTPBadRequest(text="Invalid test id supplied. Must be an integer")
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            # Stop reverse proxies buffering the stream.
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+        queue = broadcaster.subscribe(test_id)
+        try:
+            initial = await asyncio.get_running_loop().run_in_executor(None, load_events, app, [test_id])
+            event = initial[test_id]
+            last_version = event[2]
+            await response.write(_format_event(event))
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), app.config["AGGREGATE_STREAM_KEEPALIVE_SECONDS"])
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+                    continue
+                # Skip an update already covered by the initial summary.
+                if event[2] is not None and last_version is not None and event[2] <= last_version:
+                    continue
+                last_version = event[2]
+                await response.write(_format_event(event))
+        except ConnectionResetError:
+            pass
+        finally:
+            broadcaster.unsubscribe(test_id, queue)
+        return response
+
+    async def start(stream_app: web.Application):
+        broadcaster.debounce = app.config["AGGREGATE_STREAM_DEBOUNCE_SECONDS"]
+        broadcaster.start(asyncio.get_running_loop(), lambda test_ids: load_events(app, test_ids))
+        stream_app[listener_key] = asyncio.create_task(_listen(app, broadcaster))
+
+    async def stop(stream_app: web.Application):
+        stream_app[listener_key].cancel()
+        broadcaster.stop()
+
+    stream_app = web.Application()
+    stream_app.add_routes(routes)
+    stream_app.on_startup.append(start)
+    stream_app.on_cleanup.append(stop)
+    return stream_app
+
+
+def main():
+    from aiohttp import web
+    from markr.app import app
+
+    host, _, port = os.getenv("MARKR_STREAM_BIND", "0.0.0.0:4568").rpartition(":")
+    web.run_app(create_stream_app(app), host=host, port=int(port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import contextlib
+import contextvars
+import cProfile
+import os
+import tempfile
+import threading
+import time
+import typing as t
+import uuid
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_COUNT_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+
+def _format_labels(labels: t.Tuple[t.Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: t.Dict[t.Tuple[t.Tuple[str, str], ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self, process: t.Tuple[t.Tuple[str, str], ...] = ()) -> t.List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(process + labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: t.Sequence[float] = _DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> (per bucket counts, sum, count)
+        self._values: t.Dict[t.Tuple[t.Tuple[str, str], ...], t.List[t.Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels: str) -> int:
+        series = self._values.get(tuple(sorted(labels.items())))
+        return series[2] if series else 0
+
+    def render(self, process: t.Tuple[t.Tuple[str, str], ...] = ()) -> t.List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (bucket_counts, total, count) in sorted(self._values.items()):
+            labels = process + labels
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', repr(float(bound))),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    A value read from a callback each time the metrics are rendered.
+    """
+
+    def __init__(self, name: str, help: str, read: t.Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self, process: t.Tuple[t.Tuple[str, str], ...] = ()) -> t.List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name}{_format_labels(process)} {self.read()}"]
+
+
+_metrics: t.List[t.Union[Counter, Histogram, Gauge]] = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+import_stage_seconds = _register(Histogram(
+    "markr_import_stage_seconds",
+    "Time spent in each import stage: parse (XML), validate (ScoreData), upsert (DB writes) and commit.",
+))
+import_records = _register(Histogram("markr_import_records", "Test results per import.", _COUNT_BUCKETS))
+import_queries = _register(Histogram("markr_import_queries", "SQL statements executed per import.", _COUNT_BUCKETS))
+imports_total = _register(Counter("markr_imports_total", "Imports by outcome."))
+import_duplicates_total = _register(Counter(
+    "markr_import_duplicates_total",
+    "Test results skipped as duplicates, by whether the whole upload (payload) or just the result (record) was seen before.",
+))
+import_retries_total = _register(Counter(
+    "markr_import_retries_total",
+    "Parallel import transactions retried after the database aborted them to resolve a deadlock or serialization conflict.",
+))
+aggregate_stage_seconds = _register(Histogram(
+    "markr_aggregate_stage_seconds",
+    "Time spent computing aggregates, split into DB fetch and compute.",
+))
+rows_scanned_total = _register(Counter("markr_rows_scanned_total", "Score rows read to compute aggregates."))
+db_reads_total = _register(Counter("markr_db_reads_total", "Aggregate reads by the database they were routed to (primary or replica)."))
+replica_failovers_total = _register(Counter("markr_replica_failovers_total", "Reads retried elsewhere after a replica connection failed."))
+request_seconds = _register(Histogram("markr_request_seconds", "Request latency by endpoint."))
+
+
+def register_gauge(name: str, help: str, read: t.Callable[[], float]):
+    _register(Gauge(name, help, read))
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    Metrics are kept per process, so every series is labelled with this 
+    process's pid. Under several gunicorn workers each scrape is answered 
+    by one of them, and their series are told apart rather than appearing
+    to reset whenever a different worker answers. Sum over pid to total 
+    them.
+    """
+    process = (("pid", str(os.getpid())),)
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render(process))
+    return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """
+    Accumulates time per named stage, for stages interleaved in a loop.
+    """
+
+    def __init__(self):
+        self.totals: t.Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+
+# Statement counters and traces for the current context (request or job).
+_query_count: contextvars.ContextVar[t.Optional[t.List[int]]] = contextvars.ContextVar("markr_query_count", default=None)
+_sql_trace: contextvars.ContextVar[t.Optional[t.List[t.Tuple[str, float]]]] = contextvars.ContextVar("markr_sql_trace", default=None)
+
+
+@contextlib.contextmanager
+def count_queries() -> t.Iterator[t.List[int]]:
+    """
+    Counts the SQL statements executed within the block. The count is the
+    first element of the yielded list.
+    """
+    counter = [0]
+    token = _query_count.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_count.reset(token)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    if _sql_trace.get() is not None:
+        conn.info.setdefault("markr_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _sql_trace.get()
+    if trace is not None and conn.info.get("markr_query_start"):
+        trace.append((statement, time.perf_counter() - conn.info["markr_query_start"].pop()))
+
+
+def init_metrics(app):
+    """
+    Records request latency, and if PROFILE_SLOW_REQUESTS_MS is set, profiles
+    every request and writes a cProfile dump and SQL statement trace to
+    PROFILE_DIR for each one slower than that threshold.
+    """
+    app.config.setdefault("PROFILE_SLOW_REQUESTS_MS", float(os.getenv("PROFILE_SLOW_REQUESTS_MS", 0)))
+    app.config.setdefault("PROFILE_DIR", os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "markr-profiles")))
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_start = time.perf_counter()
+        if app.config["PROFILE_SLOW_REQUESTS_MS"]:
+            g.profiler = cProfile.Profile()
+            g.sql_trace = []
+            g.sql_trace_token = _sql_trace.set(g.sql_trace)
+            g.profiler.enable()
+
+    @app.after_request
+    def _record_request(response):
+        elapsed = time.perf_counter() - g.pop("request_start", time.perf_counter())
+        request_seconds.observe(elapsed, endpoint=request.endpoint or "unknown")
+
+        profiler = g.get("profiler")
+        if profiler is not None:
+            profiler.disable()
+            if elapsed * 1000 >= app.config["PROFILE_SLOW_REQUESTS_MS"]:
+                _dump_profile(app.config["PROFILE_DIR"], elapsed, profiler, g.sql_trace)
+        return response
+
+    @app.teardown_request
+    def _stop_profiler(exc):
+        # Runs even when the request raised and after_request was skipped, 
+        # so the profiler never outlives its request.
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            _sql_trace.reset(g.pop("sql_trace_token"))
+            g.pop("sql_trace", None)
+
+
+def _dump_profile(directory: str, elapsed: float, profiler: cProfile.Profile, sql_trace: t.List[t.Tuple[str, float]]):
+    os.makedirs(directory, exist_ok=True)
+    name = f"{int(time.time())}-{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+    with open(os.path.join(directory, f"{name}.sql.txt"), "w") as f:
+        f.write(f"{request.method} {request.full_path} took {elapsed * 1000:.1f}ms, {len(sql_trace)} statements\n\n")
+        for statement, seconds in sql_trace:
+            f.write(f"-- {seconds * 1000:.2f}ms\n{statement}\n\n")
@@ -0,0 +1,30 @@
+"""Version test aggregates
+
+Revision ID: 0b167d33dd11
+Revises: 8f17463fc73c
+Create Date: 2026-10-16 23:37:04.701592
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b167d33dd11'
+down_revision = '8f17463fc73c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing aggregates start at version 0, the model's default. The server
+    # default only fills them in, so it's dropped again afterwards.
+    with op.batch_alter_table('test_aggregates', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+    with op.batch_alter_table('test_aggregates', schema=None) as batch_op:
+        batch_op.alter_column('version', server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('test_aggregates', schema=None) as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,46 @@
+"""Import fingerprints
+
+Revision ID: 20994451ec9f
+Revises: b1d061445c70
+Create Date: 2026-10-16 23:37:08.264810
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '20994451ec9f'
+down_revision = 'b1d061445c70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_fingerprints',
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('records', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    with op.batch_alter_table('import_fingerprints', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_import_fingerprints_created_at'), ['created_at'], unique=False)
+
+    op.create_table('record_fingerprints',
+    sa.Column('digest', sa.LargeBinary(length=16), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    with op.batch_alter_table('record_fingerprints', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_record_fingerprints_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('record_fingerprints', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_record_fingerprints_created_at'))
+
+    op.drop_table('record_fingerprints')
+    with op.batch_alter_table('import_fingerprints', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_import_fingerprints_created_at'))
+
+    op.drop_table('import_fingerprints')
@@ -0,0 +1,28 @@
+"""Sketch test aggregates
+
+Revision ID: 261bbaa3654b
+Revises: 0fbb7ec667da
+Create Date: 2026-10-17 00:18:36.890952
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '261bbaa3654b'
+down_revision = '0fbb7ec667da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Left empty; approximate summaries sketch such aggregates from their 
+    # histograms until the next import or `rebuild-aggregates` stores one.
+    with op.batch_alter_table('test_aggregates', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sketch', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('test_aggregates', schema=None) as batch_op:
+        batch_op.drop_column('sketch')
@@ -0,0 +1,38 @@
+"""Unique score per student and test
+
+Revision ID: 451d3235c8a8
+Revises: f359ab9a4ef3
+Create Date: 2026-10-16 23:37:02.318840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '451d3235c8a8'
+down_revision = 'f359ab9a4ef3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rescans imported before the constraint left several rows per student 
+    # and test. Keep the highest score, as imports now do, and of equal 
+    # scores the latest row.
+    op.execute(
+        "DELETE FROM test_scores WHERE EXISTS ("
+        " SELECT 1 FROM test_scores AS other"
+        " WHERE other.test_id = test_scores.test_id"
+        " AND other.student_id = test_scores.student_id"
+        " AND (other.score > test_scores.score"
+        " OR (other.score = test_scores.score AND other.id > test_scores.id)))"
+    )
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_test_scores_test_id_student_id', ['test_id', 'student_id'])
+
+
+def downgrade():
+    # The removed duplicates are not restored.
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_test_scores_test_id_student_id', type_='unique')
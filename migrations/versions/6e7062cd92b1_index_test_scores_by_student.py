@@ -0,0 +1,35 @@
+"""Index test scores by student
+
+Revision ID: 6e7062cd92b1
+Revises: ec25900958dd
+Create Date: 2026-10-16 23:37:13.938418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e7062cd92b1'
+down_revision = 'ec25900958dd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().dialect.name == "postgresql":
+        # Built concurrently, so imports keep writing scores meanwhile.
+        with op.get_context().autocommit_block():
+            op.create_index(
+                'ix_test_scores_student_id_test_id', 'test_scores', ['student_id', 'test_id'],
+                unique=False, postgresql_concurrently=True,
+            )
+        return
+
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.create_index('ix_test_scores_student_id_test_id', ['student_id', 'test_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_index('ix_test_scores_student_id_test_id')
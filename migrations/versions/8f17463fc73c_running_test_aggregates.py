@@ -0,0 +1,60 @@
+"""Running test aggregates
+
+Revision ID: 8f17463fc73c
+Revises: 451d3235c8a8
+Create Date: 2026-10-16 23:37:03.527113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f17463fc73c'
+down_revision = '451d3235c8a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    aggregates = op.create_table('test_aggregates',
+    sa.Column('test_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('score_sum', sa.BigInteger(), nullable=False),
+    sa.Column('score_sum_sq', sa.BigInteger(), nullable=False),
+    sa.Column('min_score', sa.Integer(), nullable=True),
+    sa.Column('max_score', sa.Integer(), nullable=True),
+    sa.Column('histogram', sa.JSON(), nullable=False),
+    sa.ForeignKeyConstraint(['test_id'], ['tests.id'], ),
+    sa.PrimaryKeyConstraint('test_id')
+    )
+
+    if op.get_context().as_sql:
+        # Offline SQL can't read the scores back, so backfill afterwards 
+        # with `flask --app markr.app rebuild-aggregates`.
+        return
+
+    # Backfill from the scores already imported, as rebuild-aggregates does.
+    scores = sa.table('test_scores', sa.column('test_id'), sa.column('score'))
+    rows = op.get_bind().execute(
+        sa.select(scores.c.test_id, scores.c.score, sa.func.count())
+        .group_by(scores.c.test_id, scores.c.score)
+    )
+    backfill = {}
+    for test_id, score, count in rows:
+        agg = backfill.setdefault(test_id, {
+            "test_id": test_id, "count": 0, "score_sum": 0, "score_sum_sq": 0,
+            "min_score": score, "max_score": score, "histogram": {},
+        })
+        agg["count"] += count
+        agg["score_sum"] += score * count
+        agg["score_sum_sq"] += score * score * count
+        agg["histogram"][str(score)] = count
+        agg["min_score"] = min(agg["min_score"], score)
+        agg["max_score"] = max(agg["max_score"], score)
+    if backfill:
+        op.bulk_insert(aggregates, list(backfill.values()))
+
+
+def downgrade():
+    op.drop_table('test_aggregates')
@@ -0,0 +1,34 @@
+"""Drop stored percent scores
+
+Revision ID: b1d061445c70
+Revises: fda4c1a78329
+Create Date: 2026-10-16 23:37:07.092265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1d061445c70'
+down_revision = 'fda4c1a78329'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Percentages are derived from the score and the test's available marks.
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_column('percent_score')
+
+
+def downgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('percent_score', sa.Float(), nullable=True))
+    op.execute(
+        "UPDATE test_scores SET percent_score = ("
+        " SELECT ROUND(100.0 * test_scores.score / tests.available_marks, 2)"
+        " FROM tests WHERE tests.id = test_scores.test_id)"
+    )
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.alter_column('percent_score', existing_type=sa.Float(), nullable=False)
@@ -0,0 +1,30 @@
+"""Record when scores were scanned
+
+Revision ID: ec25900958dd
+Revises: 20994451ec9f
+Create Date: 2026-10-16 23:37:09.418977
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ec25900958dd'
+down_revision = '20994451ec9f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Scores imported before this are left without a scan time, and so are 
+    # only counted by unwindowed summaries.
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('scanned_on', sa.DateTime(timezone=True), nullable=True))
+        batch_op.create_index('ix_test_scores_test_id_scanned_on', ['test_id', 'scanned_on'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_index('ix_test_scores_test_id_scanned_on')
+        batch_op.drop_column('scanned_on')
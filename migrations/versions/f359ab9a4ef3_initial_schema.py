@@ -0,0 +1,51 @@
+"""Initial schema
+
+Revision ID: f359ab9a4ef3
+Revises: 
+Create Date: 2026-10-16 23:37:01.105252
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f359ab9a4ef3'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('students',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('fname', sa.String(length=80), nullable=False),
+    sa.Column('lname', sa.String(length=80), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('tests',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('available_marks', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('test_scores',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('test_id', sa.Integer(), nullable=False),
+    sa.Column('student_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=False),
+    sa.Column('percent_score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['student_id'], ['students.id'], ),
+    sa.ForeignKeyConstraint(['test_id'], ['tests.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_test_scores_test_id'), ['test_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_test_scores_test_id'))
+
+    op.drop_table('test_scores')
+    op.drop_table('tests')
+    op.drop_table('students')
@@ -0,0 +1,26 @@
+"""Store answers with scores
+
+Revision ID: fda4c1a78329
+Revises: 0b167d33dd11
+Create Date: 2026-10-16 23:37:05.880341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fda4c1a78329'
+down_revision = '0b167d33dd11'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('answers', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('test_scores', schema=None) as batch_op:
+        batch_op.drop_column('answers')
@@ -0,0 +1,324 @@
+import bisect
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import datetime
+import multiprocessing
+import re
+import threading
+import typing as t
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+from markr.db.db_helpers import (
+    _EXPECTED_DOC_TAG,
+    _RESULT_TAG,
+    InvalidRecordError,
+    ScoreData,
+    UnexpectedDocumentError,
+    np,
+)
+
+# Bytes read from the upload at a time while splitting it.
+_READ_SIZE = 64 * 1024
+_RESULT_END = f"</{_RESULT_TAG}>".encode()
+_DOC_START = re.compile(rb"<" + re.escape(_EXPECTED_DOC_TAG.encode()) + rb"[\s/>]")
+_DOC_END = f"</{_EXPECTED_DOC_TAG}".encode()
+# Comments, CDATA sections and processing instructions, whose text may look
+# like tags, or the start of one not yet closed.
+_MARKUP = re.compile(rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|(<!--|<!\[CDATA\[|<\?)", re.S)
+# The root's end tag, and the whitespace, comments and processing
+# instructions XML allows after it, up to the end of the document.
+_DOC_TAIL = re.compile(rb"</" + re.escape(_EXPECTED_DOC_TAG.encode()) + rb"\s*>(?:\s+|<!--.*?-->|<\?.*?\?>)*\Z", re.S)
+# Stands in for a missing scanned-on time in ScoreBatch.scanned_on.
+_NO_TIMESTAMP = -(2 ** 63)
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@dataclass
+class ScoreBatch:
+    """
+    Validated test results stored as columns, so a batch pickles to a few
+    buffers rather than an object per result.
+    """
+    first_names: t.List[t.Optional[str]]
+    last_names: t.List[t.Optional[str]]
+    student_numbers: "np.ndarray"
+    test_ids: "np.ndarray"
+    obtained_marks: "np.ndarray"
+    available_marks: "np.ndarray"
+    # Microseconds since the epoch in UTC, or _NO_TIMESTAMP.
+    scanned_on: "np.ndarray"
+    # Every result's packed answers concatenated. Result i's are
+    # answers[answer_offsets[i]:answer_offsets[i + 1]].
+    answers: bytes
+    answer_offsets: "np.ndarray"
+
+    def __len__(self) -> int:
+        return len(self.first_names)
+
+    @classmethod
+    def from_records(cls, records: t.List[ScoreData]) -> "ScoreBatch":
+        offsets = [0]
+        for sd in records:
+            offsets.append(offsets[-1] + len(sd.answers or b""))
+        return cls(
+            first_names=[sd.first_name for sd in records],
+            last_names=[sd.last_name for sd in records],
+            student_numbers=np.array([sd.student_number for sd in records], dtype=np.int64),
+            test_ids=np.array([sd.test_id for sd in records], dtype=np.int64),
+            obtained_marks=np.array([sd.obtained_marks for sd in records], dtype=np.int64),
+            available_marks=np.array([sd.available_marks for sd in records], dtype=np.int64),
+            scanned_on=np.array([
+                _NO_TIMESTAMP if sd.scanned_on is None else (sd.scanned_on - _EPOCH) // datetime.timedelta(microseconds=1)
+                for sd in records
+            ], dtype=np.int64),
+            answers=b"".join(sd.answers or b"" for sd in records),
+            answer_offsets=np.array(offsets, dtype=np.int64),
+        )
+
+    def records(self) -> t.Iterator[ScoreData]:
+        offsets = self.answer_offsets.tolist()
+        for i, (student_number, test_id, obtained, available, scanned_on) in enumerate(zip(
+            self.student_numbers.tolist(),
+            self.test_ids.tolist(),
+            self.obtained_marks.tolist(),
+            self.available_marks.tolist(),
+            self.scanned_on.tolist(),
+        )):
+            yield ScoreData.from_values(
+                first_name=self.first_names[i],
+                last_name=self.last_names[i],
+                student_number=student_number,
+                test_id=test_id,
+                obtained_marks=obtained,
+                available_marks=available,
+                answers=self.answers[offsets[i]:offsets[i + 1]] or None,
+                scanned_on=None if scanned_on == _NO_TIMESTAMP else _EPOCH + datetime.timedelta(microseconds=scanned_on),
+            )
+
+
+def _find_tags(buffer: bytes, tag: bytes) -> t.Iterator[int]:
+    """
+    Yields the offset of each occurrence of tag in buffer, which must start
+    outside any markup, skipping those within comments, CDATA sections and
+    processing instructions. Stops at any such section left open.
+    """
+    tags = re.compile(_MARKUP.pattern + b"|" + re.escape(tag), re.S)
+    for match in tags.finditer(buffer):
+        if match.group(1):
+            return
+        if match.group() == tag:
+            yield match.start()
+
+
+def _has_markup(buffer: bytes, end: int) -> bool:
+    return buffer.find(b"<!", 0, end) != -1 or buffer.find(b"<?", 0, end) != -1
+
+
+def _cut_point(buffer: bytes, chunk_bytes: int) -> int:
+    """
+    Where to cut buffer: after the last result ending within chunk_bytes, 
+    or else the first result, if that alone is larger. -1 if no result has
+    ended yet.
+    """
+    cut = buffer.rfind(_RESULT_END, 0, chunk_bytes)
+    if cut == -1:
+        cut = buffer.find(_RESULT_END)
+    # Usually nothing before the end tag could hide it, so it is the cut.
+    if cut != -1 and not _has_markup(buffer, cut):
+        return cut + len(_RESULT_END)
+
+    cut = -1
+    for start in _find_tags(buffer, _RESULT_END):
+        end = start + len(_RESULT_END)
+        if end > chunk_bytes:
+            return end if cut == -1 else cut
+        cut = end
+    return cut
+
+
+def split_test_results(source: t.BinaryIO, chunk_bytes: int) -> t.Iterator[bytes]:
+    """
+    Splits a mcq-test-results document into chunks of about chunk_bytes,
+    cut just after a </mcq-test-result> end tag, without parsing it. End 
+    tags within comments and CDATA sections are not cut at.
+
+    Output: the document's opening tags (everything up to and including
+    the root element's start tag), once, then each chunk of results.
+
+    Raises UnexpectedDocumentError if the root element is not
+    <mcq-test-results>, and ET.ParseError if the document ends before it
+    is closed or has anything but whitespace, comments and processing
+    instructions after it. Anything else malformed is found when the 
+    chunks are parsed.
+    """
+    buffer = b""
+    while True:
+        match = _DOC_START.search(buffer)
+        if match is not None and b">" in buffer[match.start():]:
+            break
+        data = source.read(_READ_SIZE)
+        if not data:
+            break
+        buffer += data
+    # The first element must be the root. Anything before it (a declaration,
+    # comments) has no elements.
+    first = re.search(rb"<[^?!]", buffer)
+    if first is None:
+        raise ET.ParseError("no element found")
+    if match is None or first.start() != match.start():
+        raise UnexpectedDocumentError("Unexpected root element")
+    if b">" not in buffer[match.start():]:
+        raise ET.ParseError("unclosed token")
+
+    header_end = buffer.index(b">", match.start()) + 1
+    header, buffer = buffer[:header_end], buffer[header_end:]
+    yield header
+    if header.endswith(b"/>"):
+        # An empty document: <mcq-test-results/>
+        return
+
+    while True:
+        while len(buffer) >= chunk_bytes:
+            cut = _cut_point(buffer, chunk_bytes)
+            if cut == -1:
+                break
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+        data = source.read(_READ_SIZE)
+        if data:
+            buffer += data
+            continue
+
+        # Everything after the last result, up to the root's end tag.
+        end = buffer.find(_DOC_END)
+        if _has_markup(buffer, end):
+            end = next(_find_tags(buffer, _DOC_END), -1)
+        if end == -1:
+            raise ET.ParseError("no element found")
+        if not _DOC_TAIL.match(buffer, end):
+            raise ET.ParseError("junk after document element")
+        if buffer[:end].strip():
+            yield buffer[:end]
+        return
+
+
+def _parse_chunk(header: bytes, chunk: bytes, first_record: int) -> t.Tuple[str, t.Any, t.Any]:
+    """
+    Parses and validates one chunk of results in a worker process.
+
+    Output: ("ok", ScoreBatch, None), or ("invalid", position, reason) for
+    the first invalid result, or ("malformed", position, message) if the
+    chunk isn't well formed XML.
+    """
+    document = header + chunk + _DOC_END + b">"
+    try:
+        root = ET.fromstring(document)
+    except ET.ParseError as e:
+        # Find the result holding the error from its line and column.
+        line, column = e.position
+        line_starts = [0] + [m.end() for m in re.finditer(rb"\n", document)]
+        offset = line_starts[min(line, len(line_starts)) - 1] + column - len(header)
+        ends = [start + len(_RESULT_END) for start in _find_tags(chunk, _RESULT_END)]
+        return "malformed", first_record + bisect.bisect_right(ends, offset), str(e)
+
+    records = []
+    for elem in root:
+        if elem.tag != _RESULT_TAG:
+            continue
+        try:
+            records.append(ScoreData(elem))
+        except RuntimeError as e:
+            return "invalid", first_record + len(records), str(e)
+    return "ok", ScoreBatch.from_records(records), None
+
+
+class ParsePoolError(Exception):
+    """
+    Raised when a parse worker process dies mid-import, e.g. killed for
+    using too much memory. The pool is replaced for later imports.
+    """
+
+
+_pool: t.Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _parse_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    # Created on first use, so each gunicorn worker has a pool of its own
+    # rather than inheriting the master's.
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # Forking a threaded server is unsafe, so workers are spawned.
+            _pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _discard_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    # Once a worker has died the pool refuses new work, so the next import
+    # creates another.
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_parse_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def parse_in_parallel(source: t.BinaryIO, workers: int, chunk_bytes: int = 1024 * 1024) -> t.Iterator[ScoreData]:
+    """
+    Parses and validates a mcq-test-results document in a pool of worker
+    processes, one chunk (see split_test_results) at a time each.
+
+    Yields the validated results in document order. At most two chunks per
+    worker are in flight, so memory stays bounded for large uploads.
+
+    Raises InvalidRecordError for the first invalid result, and
+    ET.ParseError (with the position of the result holding the error as
+    `record`) if the document is malformed, as iter_test_results and
+    extract_data would. Raises ParsePoolError if a worker process dies.
+    """
+    pool = _parse_pool(workers)
+    chunks = split_test_results(source, chunk_bytes)
+    header = next(chunks)
+    pending: t.Deque[concurrent.futures.Future] = collections.deque()
+    next_record = 1
+    try:
+        for chunk in chunks:
+            pending.append(pool.submit(_parse_chunk, header, chunk, next_record))
+            next_record += chunk.count(_RESULT_END)
+            if len(pending) >= 2 * workers:
+                yield from _batch_records(pending.popleft().result())
+        while pending:
+            yield from _batch_records(pending.popleft().result())
+    except concurrent.futures.process.BrokenProcessPool as e:
+        _discard_pool(pool)
+        raise ParsePoolError("A parse worker exited unexpectedly") from e
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _batch_records(outcome: t.Tuple[str, t.Any, t.Any]) -> t.Iterator[ScoreData]:
+    status, value, detail = outcome
+    if status == "invalid":
+        raise InvalidRecordError(value, detail)
+    if status == "malformed":
+        error = ET.ParseError(detail)
+        error.record = value
+        raise error
+    return value.records()
@@ -0,0 +1,145 @@
+import contextlib
+import itertools
+import os
+import threading
+import time
+import typing as t
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from markr import metrics
+from markr.db.models import db
+from markr.signals import import_committed
+
+T = t.TypeVar("T")
+
+
+class ReplicaRouter:
+    """
+    Routes read queries to read replicas, round-robin. A replica whose
+    connection fails is skipped for retry_after seconds, and reads fall back
+    to the primary when no replica is available.
+
+    Tests written by an import are read from the primary for read_your_writes
+    seconds afterwards, so a lagging replica can't serve results older than
+    an import that has already been acknowledged. The window is tracked per
+    process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure([])
+
+    def configure(self, engines: t.List[Engine], read_your_writes: float = 5.0, retry_after: float = 30.0):
+        with self._lock:
+            self.engines = list(engines)
+            self.read_your_writes = read_your_writes
+            self.retry_after = retry_after
+            self._next = itertools.count()
+            # engine -> time.monotonic() before which it is skipped
+            self._failed_until: t.Dict[Engine, float] = {}
+            # test_id -> time.monotonic() until which it is read from the primary
+            self._recent_writes: t.Dict[int, float] = {}
+
+    def record_writes(self, test_ids: t.Iterable[int]):
+        if not self.engines or not self.read_your_writes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for test_id in test_ids:
+                self._recent_writes[test_id] = now + self.read_your_writes
+            if len(self._recent_writes) > 10_000:
+                self._recent_writes = {
+                    test_id: until for test_id, until in self._recent_writes.items() if until > now
+                }
+
+    def healthy(self, engine: Engine) -> bool:
+        return self._failed_until.get(engine, 0.0) <= time.monotonic()
+
+    def _candidates(self, test_ids: t.Iterable[int]) -> t.List[Engine]:
+        if not self.engines:
+            return []
+        now = time.monotonic()
+        if any(self._recent_writes.get(test_id, 0.0) > now for test_id in test_ids):
+            return []
+        start = next(self._next) % len(self.engines)
+        rotated = self.engines[start:] + self.engines[:start]
+        return [engine for engine in rotated if self.healthy(engine)]
+
+    def read(self, test_ids: t.Iterable[int], query: t.Callable[[Session], T]) -> T:
+        """
+        Runs query(session) against a replica, failing over to the next
+        replica and finally to the primary's session if connecting fails.
+
+        Input:
+        - test_ids the query reads, to check against the read-your-writes window
+        - query: function performing the read with the session it is given
+        """
+        for engine in self._candidates(test_ids):
+            try:
+                with Session(engine) as session:
+                    result = query(session)
+            except OperationalError:
+                self._failed_until[engine] = time.monotonic() + self.retry_after
+                metrics.replica_failovers_total.inc()
+                continue
+            metrics.db_reads_total.inc(target="replica")
+            return result
+
+        metrics.db_reads_total.inc(target="primary")
+        return query(db.session)
+
+    @contextlib.contextmanager
+    def streaming_session(self, test_ids: t.Iterable[int]) -> t.Iterator[Session]:
+        """
+        Session for a read whose results are consumed lazily, e.g. streamed 
+        to the client. The first replica that accepts a connection is used, 
+        or else the primary. There is no failover once results are flowing.
+        """
+        for engine in self._candidates(test_ids):
+            session = Session(engine)
+            try:
+                session.connection()
+            except OperationalError:
+                session.close()
+                self._failed_until[engine] = time.monotonic() + self.retry_after
+                metrics.replica_failovers_total.inc()
+                continue
+            metrics.db_reads_total.inc(target="replica")
+            try:
+                yield session
+            finally:
+                session.close()
+            return
+
+        metrics.db_reads_total.inc(target="primary")
+        yield db.session
+
+
+replica_router = ReplicaRouter()
+
+
+@import_committed.connect
+def _record_imported_tests(sender, test_ids: t.FrozenSet[int]):
+    replica_router.record_writes(test_ids)
+
+
+def init_replicas(app):
+    """
+    Routes reads to the replicas listed in DB_REPLICA_URIS (registered as
+    SQLAlchemy binds by init_db), if any.
+    """
+    app.config.setdefault(
+        "DB_REPLICA_READ_YOUR_WRITES_SECONDS", float(os.getenv("DB_REPLICA_READ_YOUR_WRITES_SECONDS", 5))
+    )
+    app.config.setdefault("DB_REPLICA_RETRY_SECONDS", float(os.getenv("DB_REPLICA_RETRY_SECONDS", 30)))
+
+    with app.app_context():
+        engines = [db.engines[key] for key in app.config.get("SQLALCHEMY_BINDS", {}) if key.startswith("replica")]
+    replica_router.configure(
+        engines,
+        read_your_writes=app.config["DB_REPLICA_READ_YOUR_WRITES_SECONDS"],
+        retry_after=app.config["DB_REPLICA_RETRY_SECONDS"],
+    )
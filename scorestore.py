@@ -0,0 +1,393 @@
+import os
+import re
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from flask import Flask
+from sqlalchemy import select
+
+from markr import metrics
+from markr.cache import aggregate_cache
+from markr.db.models import Test, TestAggregate, TestScore
+from markr.replicas import replica_router
+from markr.signals import import_committed
+
+# Snapshot files are named for the test, aggregate version and available
+# marks they hold, so they can be written by several workers without a
+# shared index.
+_SNAPSHOT_NAME = re.compile(r"^test-(\d+)-v(\d+)-m(\d+)\.npy$")
+
+
+@dataclass
+class StoredScores:
+    """
+    A test's scores as of an aggregate version, sorted ascending so any
+    percentile is an index into the array. Scores mapped from a snapshot
+    are read-only views of the file.
+    """
+    scores: "np.ndarray"
+    available_marks: int
+    version: int
+    # The distinct scores, ascending, and how often each occurs.
+    distinct: "np.ndarray"
+    counts: "np.ndarray"
+    # time.monotonic() at which the version was last confirmed current.
+    checked_at: float
+
+    @classmethod
+    def from_sorted(cls, scores: "np.ndarray", available_marks: int, version: int) -> "StoredScores":
+        import numpy as np
+
+        distinct, counts = np.unique(scores, return_counts=True)
+        return cls(
+            scores=scores,
+            available_marks=available_marks,
+            version=version,
+            distinct=distinct,
+            counts=counts,
+            checked_at=time.monotonic(),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.scores.nbytes
+
+
+def _read_tests(session, test_ids: t.List[int]) -> t.Dict[int, StoredScores]:
+    """
+    Reads the sorted scores, available marks and aggregate version of each
+    test with at least one score, in two queries however many tests.
+    """
+    import numpy as np
+
+    # Versions are read first, so scores are never older than the version
+    # they are stored under. Newer scores are refreshed on the next check.
+    versions = {
+        test_id: (version, available_marks)
+        for test_id, version, available_marks in session.execute(
+            select(TestAggregate.test_id, TestAggregate.version, Test.available_marks)
+            .join(Test, Test.id == TestAggregate.test_id)
+            .where(TestAggregate.test_id.in_(test_ids), TestAggregate.count > 0)
+        )
+    }
+    if not versions:
+        return {}
+    rows = session.execute(
+        select(TestScore.test_id, TestScore.score)
+        .where(TestScore.test_id.in_(list(versions)))
+        .order_by(TestScore.test_id, TestScore.score)
+    ).all()
+    metrics.rows_scanned_total.inc(len(rows), source="score_store")
+
+    table = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    starts = np.flatnonzero(np.r_[True, table[1:, 0] != table[:-1, 0]])
+    stored = {}
+    for test_id, scores in zip(table[starts, 0].tolist(), np.split(table[:, 1].astype(np.int32), starts[1:])):
+        version, available_marks = versions[test_id]
+        stored[test_id] = StoredScores.from_sorted(scores, available_marks, version)
+    return stored
+
+
+class ScoreStore:
+    """
+    Keeps the scores of hot tests in memory as sorted numpy arrays, so their
+    aggregates are computed without a database round trip.
+
+    A test is loaded once it has been read min_reads times, and the least
+    recently used tests are evicted to keep the arrays within max_bytes.
+    Imports committed by this process reload the tests they touch.
+    Imports by other processes are noticed by checking a test's aggregate
+    version once it was last confirmed more than verify_after seconds ago.
+
+    The arrays are snapshotted to snapshot_dir, one .npy file per test.
+    A restarted worker maps the snapshot instead of reading every score
+    again, and reloads only the tests imported to since.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure(0)
+
+    def configure(
+        self,
+        max_bytes: int,
+        snapshot_dir: t.Optional[str] = None,
+        verify_after: float = 5.0,
+        min_reads: int = 2,
+    ):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.snapshot_dir = snapshot_dir
+            self.verify_after = verify_after
+            self.min_reads = min_reads
+            self._entries: "OrderedDict[int, StoredScores]" = OrderedDict()
+            self._bytes = 0
+            # test_id -> reads while not stored, for deciding what to load.
+            self._reads: t.Dict[int, int] = {}
+            # test_id -> version of its latest snapshot file.
+            self._snapshotted: t.Dict[int, int] = {}
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._reads.clear()
+
+    def get(self, test_id: int, version: t.Optional[int] = None) -> t.Optional[StoredScores]:
+        """
+        Returns the test's stored scores if they are up to date, loading them
+        if the test has become hot. None if the test isn't stored, and
+        should be read from the database as usual. Needs an app context.
+
+        Input:
+        - version: the test's current aggregate version, if the caller has 
+          just read it. Stored scores of any other version are reloaded.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(test_id)
+            if entry is None:
+                self._reads[test_id] = self._reads.get(test_id, 0) + 1
+                admit = self._reads[test_id] >= self.min_reads
+                if len(self._reads) > 100_000:
+                    self._reads.clear()
+            else:
+                self._entries.move_to_end(test_id)
+
+        if entry is not None and version is not None:
+            if version == entry.version:
+                entry.checked_at = time.monotonic()
+            else:
+                entry = self.load([test_id]).get(test_id)
+        elif entry is not None and time.monotonic() - entry.checked_at > self.verify_after:
+            entry = self._verify(test_id, entry)
+        elif entry is None and admit:
+            entry = self.load([test_id]).get(test_id)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _verify(self, test_id: int, entry: StoredScores) -> t.Optional[StoredScores]:
+        version = replica_router.read([test_id], lambda session: session.scalar(
+            select(TestAggregate.version).where(TestAggregate.test_id == test_id)
+        ))
+        if version == entry.version:
+            entry.checked_at = time.monotonic()
+            return entry
+        return self.load([test_id]).get(test_id)
+
+    def load(self, test_ids: t.Iterable[int]) -> t.Dict[int, StoredScores]:
+        """
+        Reads the given tests' scores from the database and stores them,
+        replacing any stored already. Tests without scores are dropped.
+        """
+        test_ids = list(test_ids)
+        if not test_ids:
+            return {}
+        loaded = replica_router.read(test_ids, lambda session: _read_tests(session, test_ids))
+        with self._lock:
+            for test_id in test_ids:
+                self._remove(test_id)
+            for test_id, entry in loaded.items():
+                self._put(test_id, entry)
+        return loaded
+
+    def _remove(self, test_id: int):
+        entry = self._entries.pop(test_id, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+
+    def _put(self, test_id: int, entry: StoredScores):
+        # A test too large to ever fit is left to the database.
+        if entry.nbytes > self.max_bytes:
+            return
+        self._reads.pop(test_id, None)
+        self._entries[test_id] = entry
+        self._bytes += entry.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def refresh(self, test_ids: t.Iterable[int]):
+        """
+        Reloads the stored tests among those given, after an import touching
+        them has committed. They are dropped first, so nothing reads the
+        outdated scores meanwhile.
+        """
+        with self._lock:
+            stored = [test_id for test_id in test_ids if test_id in self._entries]
+            for test_id in stored:
+                self._remove(test_id)
+        if stored:
+            self.load(stored)
+            # A summary computed from the outdated scores may have been
+            # cached since the cache was invalidated.
+            aggregate_cache.invalidate(stored)
+
+    def snapshot(self) -> int:
+        """
+        Writes each stored test not yet snapshotted at its current version
+        to snapshot_dir, replacing its older files. Files are written under
+        a temporary name and renamed, so readers never see a partial one.
+
+        Output:
+        - Number of files written.
+        """
+        import numpy as np
+
+        if not self.snapshot_dir:
+            return 0
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with self._lock:
+            pending = [
+                (test_id, entry) for test_id, entry in self._entries.items()
+                if self._snapshotted.get(test_id) != entry.version
+            ]
+
+        existing = os.listdir(self.snapshot_dir)
+        for test_id, entry in pending:
+            name = f"test-{test_id}-v{entry.version}-m{entry.available_marks}.npy"
+            path = os.path.join(self.snapshot_dir, name)
+            partial = os.path.join(self.snapshot_dir, f".{name}.{os.getpid()}.tmp")
+            with open(partial, "wb") as f:
+                np.save(f, entry.scores)
+            os.replace(partial, path)
+            for other in existing:
+                match = _SNAPSHOT_NAME.match(other)
+                if match and int(match.group(1)) == test_id and other != name:
+                    try:
+                        os.remove(os.path.join(self.snapshot_dir, other))
+                    except FileNotFoundError:
+                        # Already replaced by another worker.
+                        pass
+            self._snapshotted[test_id] = entry.version
+        return len(pending)
+
+    def load_snapshot(self) -> int:
+        """
+        Maps the latest snapshot file of each test, without copying it, then
+        checks every mapped test's version in one query and reloads the
+        tests imported to since the snapshot was written. Needs an app
+        context.
+
+        Output:
+        - Number of tests stored from the snapshot as they were.
+        """
+        import numpy as np
+
+        if not self.snapshot_dir or not os.path.isdir(self.snapshot_dir):
+            return 0
+        latest: t.Dict[int, t.Tuple[int, int, str]] = {}
+        for name in os.listdir(self.snapshot_dir):
+            match = _SNAPSHOT_NAME.match(name)
+            if match is None:
+                continue
+            test_id, version, available_marks = map(int, match.groups())
+            if test_id not in latest or version > latest[test_id][0]:
+                latest[test_id] = (version, available_marks, name)
+
+        mapped: t.Dict[int, StoredScores] = {}
+        for test_id, (version, available_marks, name) in latest.items():
+            try:
+                scores = np.load(os.path.join(self.snapshot_dir, name), mmap_mode="r")
+            except (OSError, ValueError):
+                # Replaced by a newer snapshot since it was listed.
+                continue
+            mapped[test_id] = StoredScores.from_sorted(scores, available_marks, version)
+        if not mapped:
+            return 0
+
+        current = dict(replica_router.read(mapped, lambda session: session.execute(
+            select(TestAggregate.test_id, TestAggregate.version).where(TestAggregate.test_id.in_(list(mapped)))
+        ).all()))
+        unchanged = [test_id for test_id, entry in mapped.items() if current.get(test_id) == entry.version]
+        with self._lock:
+            for test_id in unchanged:
+                self._remove(test_id)
+                self._put(test_id, mapped[test_id])
+                self._snapshotted[test_id] = mapped[test_id].version
+        self.load(test_id for test_id in mapped if test_id in current and test_id not in unchanged)
+        return len(unchanged)
+
+    def start(self, app: Flask, interval: float) -> t.Optional[threading.Thread]:
+        """
+        Maps the snapshot in a background thread, then snapshots the store
+        every interval seconds. Does nothing while the store is disabled.
+        """
+        if not self.enabled:
+            return None
+
+        def run():
+            try:
+                with app.app_context():
+                    self.load_snapshot()
+            except Exception:
+                app.logger.exception("Unable to load the score store snapshot")
+            while self.snapshot_dir and interval > 0:
+                time.sleep(interval)
+                try:
+                    self.snapshot()
+                except OSError:
+                    app.logger.exception("Unable to snapshot the score store")
+
+        thread = threading.Thread(target=run, name="markr-score-store", daemon=True)
+        thread.start()
+        return thread
+
+
+score_store = ScoreStore()
+metrics.register_gauge("markr_score_store_tests", "Tests held in the score store.", score_store.size)
+metrics.register_gauge("markr_score_store_bytes", "Bytes of scores held in the score store.", score_store.nbytes)
+metrics.register_gauge("markr_score_store_hits", "Summaries served from the score store since startup.", lambda: score_store.hits)
+metrics.register_gauge("markr_score_store_misses", "Summaries read from the database since startup.", lambda: score_store.misses)
+
+
+@import_committed.connect
+def _refresh_imported_tests(sender, test_ids: t.FrozenSet[int]):
+    if score_store.enabled:
+        score_store.refresh(test_ids)
+
+
+def init_score_store(app: Flask):
+    """
+    Configures the score store from the environment. It is disabled unless
+    SCORE_STORE_MAX_BYTES is set.
+    """
+    # Memory the stored scores may use (0 disables the store).
+    app.config.setdefault("SCORE_STORE_MAX_BYTES", int(os.getenv("SCORE_STORE_MAX_BYTES", 0)))
+    # Where snapshots are written, shared by the workers on a host (unset disables snapshots).
+    app.config.setdefault("SCORE_STORE_DIR", os.getenv("SCORE_STORE_DIR"))
+    app.config.setdefault("SCORE_STORE_SNAPSHOT_SECONDS", float(os.getenv("SCORE_STORE_SNAPSHOT_SECONDS", 60)))
+    # How stale a stored test may be before its version is checked, to
+    # catch imports by other processes.
+    app.config.setdefault("SCORE_STORE_VERIFY_SECONDS", float(os.getenv("SCORE_STORE_VERIFY_SECONDS", 5)))
+    # Reads of a test, while not stored, after which it is loaded.
+    app.config.setdefault("SCORE_STORE_MIN_READS", int(os.getenv("SCORE_STORE_MIN_READS", 2)))
+
+    score_store.configure(
+        app.config["SCORE_STORE_MAX_BYTES"],
+        snapshot_dir=app.config["SCORE_STORE_DIR"],
+        verify_after=app.config["SCORE_STORE_VERIFY_SECONDS"],
+        min_reads=app.config["SCORE_STORE_MIN_READS"],
+    )
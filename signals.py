@@ -0,0 +1,7 @@
+from blinker import Namespace
+
+_signals = Namespace()
+
+# Sent once an import has been committed, with the IDs of the tests it
+# touched as the `test_ids` keyword argument.
+import_committed = _signals.signal("import-committed")
@@ -1,8 +1,48 @@
 import os 
+import datetime
 import json
-from unittest import TestCase
-from markr.db.models import TestScore, Student, Test, db
+import random
+from unittest import TestCase, skipUnless
+import pytest
+import numpy as np
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from markr.db.db_helpers import (
+    _grouped_summaries,
+    _summary_from_array,
+    _summary_from_histogram,
+    _summary_statement,
+    compute_rollup_summary,
+    compute_test_score_summaries,
+    compute_test_score_summary,
+    compute_test_score_timeseries,
+    get_test_score_summary,
+    percent,
+    rebuild_test_aggregates,
+)
+from markr.tests.test_import import MockData, gen_input
 from markr.app import app
+from markr.cache import AggregateCache, MemoryCacheBackend, aggregate_cache
+
+
+def numpy_summary(scores, available_marks):
+    """
+    Reference implementation: the statistics computed directly over every 
+    percentage with numpy.
+    """
+    dataset = np.array([percent(score, available_marks) for score in scores])
+    return {
+        "mean": round(np.mean(dataset), 2),
+        "median": np.median(dataset),
+        "stddev" : round(np.std(dataset), 2),
+        "min" : int(np.min(dataset)),
+        "max" : int(np.max(dataset)),
+        "count" : np.size(dataset),
+        "p25": np.percentile(dataset, 25),
+        "p50": np.percentile(dataset, 50),
+        "p95": np.percentile(dataset, 95),
+    }
 
 class TestImport(TestCase):
     def setUp(self) -> None:
@@ -19,10 +59,14 @@ class TestImport(TestCase):
     def tearDown(self) -> None:
         # Ensure DB is cleared after each test
         with app.app_context():
+            TestAggregate.query.delete()
             Student.query.delete()
             Test.query.delete()
             TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
             db.session.commit()
+        aggregate_cache.clear()
 
     def test_aggregate(self):
         """
@@ -59,6 +103,573 @@ class TestImport(TestCase):
             resp = client.get("/results/111111/aggregate")
         
         self.assertEqual(resp.status_code, 400)
-        
-        
 
+
+class TestAggregateMaintenance(TestCase):
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def import_mocks(self, mocks):
+        with app.test_client() as client: 
+            resp = client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_aggregate__matches_numpy(self):
+        """
+        Statistics derived from the running aggregate match numpy over every score,
+        across imports that add, upgrade and ignore scores.
+        """
+        rng = random.Random(42)
+        best = {}
+        for _ in range(4):
+            mocks = [
+                MockData(student_number=rng.randrange(150), available_marks=37, obtained_marks=rng.randrange(38))
+                for _ in range(120)
+            ]
+            for mock in mocks:
+                best[mock.student_number] = max(best.get(mock.student_number, 0), mock.obtained_marks)
+            self.import_mocks(mocks)
+
+        with app.app_context():
+            summary = get_test_score_summary(MockData.test_id)
+        expected = numpy_summary(list(best.values()), 37)
+        self.assertEqual(summary, expected)
+
+    def test_aggregate__available_marks_grows(self):
+        """
+        Percentages reflect the test's current available marks after it grows.
+        """
+        self.import_mocks([MockData(student_number=1, obtained_marks=5), MockData(student_number=2, obtained_marks=10)])
+        self.import_mocks([MockData(student_number=3, obtained_marks=10, available_marks=20)])
+
+        with app.app_context():
+            summary = get_test_score_summary(MockData.test_id)
+        self.assertEqual(summary, numpy_summary([5, 10, 10], 20))
+
+    def test_aggregate__rebuild_matches_incremental(self):
+        """
+        Rebuilding aggregates from the scores table gives the same result as 
+        maintaining them during import.
+        """
+        self.import_mocks([MockData(student_number=i, obtained_marks=i % 11) for i in range(30)])
+        self.import_mocks([MockData(student_number=i, obtained_marks=10) for i in range(5)])
+
+        with app.app_context():
+            incremental = get_test_score_summary(MockData.test_id)
+            self.assertEqual(rebuild_test_aggregates(), 1)
+            rebuilt = get_test_score_summary(MockData.test_id)
+        self.assertEqual(incremental, rebuilt)
+
+    def test_aggregate__import_rebuilds_missing_aggregate(self):
+        """
+        A test whose aggregate was lost is rebuilt from its scores by the 
+        next import, even one upgrading a score the aggregate never counted.
+        """
+        self.import_mocks([MockData(student_number=i, obtained_marks=i) for i in range(5)])
+        with app.app_context():
+            TestAggregate.query.delete()
+            db.session.commit()
+        self.import_mocks([MockData(student_number=2, obtained_marks=9), MockData(student_number=7, obtained_marks=8)])
+
+        with app.app_context():
+            agg = db.session.get(TestAggregate, MockData.test_id)
+            self.assertEqual(agg.histogram, {"0": 1, "1": 1, "3": 1, "4": 1, "8": 1, "9": 1})
+            self.assertEqual((agg.count, agg.score_sum, agg.min_score, agg.max_score), (6, 25, 0, 9))
+            self.assertEqual(get_test_score_summary(MockData.test_id), numpy_summary([0, 1, 3, 4, 8, 9], 10))
+
+    def test_aggregate__rebuild_bumps_version(self):
+        """
+        Rebuilt aggregates get a new version, so a version seen before the 
+        rebuild (e.g. as an ETag) is never reused for different scores.
+        """
+        self.import_mocks([MockData(student_number=i, obtained_marks=i) for i in range(3)])
+        self.import_mocks([MockData(student_number=3, obtained_marks=3)])
+        with app.test_client() as client:
+            etag = client.get(f"/results/{MockData.test_id}/aggregate").headers["ETag"]
+            with app.app_context():
+                before = db.session.get(TestAggregate, MockData.test_id).version
+                rebuild_test_aggregates()
+                after = db.session.get(TestAggregate, MockData.test_id).version
+            resp = client.get(f"/results/{MockData.test_id}/aggregate", headers={"If-None-Match": etag})
+
+        self.assertEqual(after, before + 1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_aggregate__db_backend_matches_numpy(self):
+        """
+        Computing statistics directly from the scores table matches numpy over 
+        every score, and the running aggregate.
+        """
+        rng = random.Random(7)
+        mocks = [
+            MockData(student_number=i, available_marks=23, obtained_marks=rng.randrange(24))
+            for i in range(101)
+        ]
+        self.import_mocks(mocks)
+
+        with app.app_context():
+            computed = compute_test_score_summary(MockData.test_id)
+            summary = get_test_score_summary(MockData.test_id)
+        expected = numpy_summary([mock.obtained_marks for mock in mocks], 23)
+        self.assertEqual(computed, expected)
+        self.assertEqual(summary, expected)
+
+    def test_aggregate__falls_back_without_running_aggregate(self):
+        """
+        Tests with scores but no running aggregate are summarised from their scores.
+        """
+        self.import_mocks([MockData(student_number=i, obtained_marks=i) for i in range(6)])
+        with app.app_context():
+            TestAggregate.query.delete()
+            db.session.commit()
+            summary = get_test_score_summary(MockData.test_id)
+        self.assertEqual(summary, numpy_summary(range(6), MockData.available_marks))
+
+    def test_aggregate__postgres_single_statement(self):
+        """
+        The Postgres backend reduces the scores to a histogram in one statement.
+        """
+        sql = str(_summary_statement(1).compile(dialect=postgresql.dialect()))
+        self.assertEqual(sql.count("SELECT"), 1)
+        self.assertIn("GROUP BY test_scores.score", sql)
+
+    def test_aggregate__histogram_matches_numpy_rounding(self):
+        """
+        Summaries from a histogram of scores round percentages as percent() 
+        does, e.g. 1/160 to 0.62 where Postgres' round() gives 0.63.
+        """
+        scores = [0, 1, 1, 3, 5, 159]
+        self.import_mocks([
+            MockData(student_number=i, available_marks=160, obtained_marks=score) for i, score in enumerate(scores)
+        ])
+        with app.app_context():
+            rows = db.session.execute(_summary_statement(MockData.test_id)).all()
+        summary = _summary_from_histogram([row[0] for row in rows], [row[1] for row in rows], rows[0][2])
+        self.assertEqual(summary, numpy_summary(scores, 160))
+        self.assertEqual(summary["p25"], 0.62)
+
+    @pytest.mark.postgres
+    @skipUnless(os.getenv("DATABASE_URL", "").startswith("postgresql"), "DATABASE_URL is not a Postgres database")
+    def test_aggregate__postgres_matches_numpy(self):
+        """
+        Run with DATABASE_URL pointing at a migrated Postgres database: the 
+        Postgres backend matches numpy over every percentage, including 
+        ones Postgres would round differently.
+        """
+        mocks = [
+            MockData(student_number=i, available_marks=160, obtained_marks=score)
+            for i, score in enumerate([0, 1, 1, 3, 5, 7, 9, 159, 160])
+        ]
+        self.import_mocks(mocks)
+        with app.app_context():
+            self.assertEqual(db.engine.dialect.name, "postgresql")
+            computed = compute_test_score_summary(MockData.test_id)
+        self.assertEqual(computed, numpy_summary([mock.obtained_marks for mock in mocks], 160))
+
+    def test_aggregate__etag_not_modified(self):
+        """
+        Polling with the last ETag returns 304 until an import touches the test.
+        """
+        self.import_mocks([MockData(student_number=1)])
+        with app.test_client() as client: 
+            first = client.get(f"/results/{MockData.test_id}/aggregate")
+            etag = first.headers["ETag"]
+            unchanged = client.get(f"/results/{MockData.test_id}/aggregate", headers={"If-None-Match": etag})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.data, b"")
+
+        self.import_mocks([MockData(student_number=2, obtained_marks=9)])
+        with app.test_client() as client: 
+            changed = client.get(f"/results/{MockData.test_id}/aggregate", headers={"If-None-Match": etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers["ETag"], etag)
+        self.assertEqual(json.loads(changed.text)["count"], 2)
+
+    def test_aggregate__cache_invalidated_by_import(self):
+        """
+        Repeated reads are served from the cache, and only imports of the same test
+        invalidate it.
+        """
+        self.import_mocks([MockData(student_number=1), MockData(student_number=1, test_id=5)])
+        aggregate_cache.clear()
+        with app.test_client() as client: 
+            client.get(f"/results/{MockData.test_id}/aggregate")
+            client.get("/results/5/aggregate")
+            hits_before = aggregate_cache.hits
+            client.get(f"/results/{MockData.test_id}/aggregate")
+            self.assertEqual(aggregate_cache.hits, hits_before + 1)
+
+            self.import_mocks([MockData(student_number=2, test_id=5)])
+            self.assertIsNotNone(aggregate_cache.backend.get(MockData.test_id))
+            self.assertIsNone(aggregate_cache.backend.get(5))
+            self.assertEqual(json.loads(client.get("/results/5/aggregate").text)["count"], 2)
+
+            stats = json.loads(client.get("/cache/stats").text)
+        self.assertEqual(stats["size"], 2)
+        self.assertGreater(stats["hit_rate"], 0)
+
+    def test_aggregate__cache_notices_imports_by_other_processes(self):
+        """
+        A cached summary whose test was imported to by another process, so 
+        that no invalidation reached this one, is recomputed once its 
+        aggregate version no longer matches.
+        """
+        self.import_mocks([MockData(student_number=1, obtained_marks=5)])
+        stale_before = aggregate_cache.stale
+        with app.test_client() as client:
+            etag = client.get(f"/results/{MockData.test_id}/aggregate").headers["ETag"]
+            with app.app_context():
+                db.session.add(Student(id=2, fname="Jane", lname="Austen"))
+                db.session.add(TestScore(test_id=MockData.test_id, student_id=2, score=10))
+                agg = db.session.get(TestAggregate, MockData.test_id)
+                agg.count += 1
+                agg.histogram = {**agg.histogram, "10": 1}
+                agg.max_score = 10
+                agg.version += 1
+                db.session.commit()
+            resp = client.get(f"/results/{MockData.test_id}/aggregate", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.text)["count"], 2)
+        self.assertEqual(aggregate_cache.stale, stale_before + 1)
+
+    def test_aggregate__cache_lru_bound(self):
+        """
+        The in-process backend evicts the least recently used entries beyond its size.
+        """
+        cache = AggregateCache(MemoryCacheBackend(max_size=2))
+        compute = lambda test_id, version: ({"count": test_id}, 1)
+        for test_id in (1, 2, 1, 3):
+            cache.get_or_compute(test_id, compute)
+
+        self.assertIsNone(cache.backend.get(2))
+        self.assertIsNotNone(cache.backend.get(1))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_aggregate__shared_cache_hits_skip_version_check(self):
+        """
+        A shared backend sees every process' invalidations, so its hits 
+        don't look the version up. Misses still do, to compute the entry.
+        """
+        class SharedBackend(MemoryCacheBackend):
+            shared = True
+
+        lookups = []
+
+        def current_version(test_id):
+            lookups.append(test_id)
+            return 1
+
+        for backend, expected in ((MemoryCacheBackend(max_size=2), [1, 1]), (SharedBackend(max_size=2), [1])):
+            lookups.clear()
+            cache = AggregateCache(backend)
+            for _ in range(2):
+                cache.get_or_compute(1, lambda test_id, version: ({"count": 1}, version), current_version)
+            self.assertEqual(lookups, expected)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_aggregate__grouped_summaries_match_numpy(self):
+        """
+        The vectorized grouped pass gives the same statistics as summarising each 
+        group on its own.
+        """
+        rng = np.random.default_rng(3)
+        keys = rng.integers(0, 40, size=2000)
+        values = np.round(rng.integers(0, 31, size=2000) / 30 * 100, 2)
+
+        summaries = _grouped_summaries(keys, values)
+        self.assertEqual(sorted(summaries), sorted(set(keys.tolist())))
+        for key, summary in summaries.items():
+            self.assertEqual(summary, _summary_from_array(values[keys == key]), f"Mismatch for group {key}")
+
+    def test_aggregate__batch_endpoint(self):
+        """
+        The batch endpoint returns the same statistics as the single test endpoint,
+        and reports missing tests as errors.
+        """
+        rng = random.Random(11)
+        self.import_mocks([
+            MockData(student_number=i, test_id=test_id, obtained_marks=rng.randrange(11))
+            for test_id in (1, 2, 4) for i in range(25)
+        ])
+
+        with app.test_client() as client: 
+            resp = client.get("/results/aggregate?test_ids=1-3,4")
+            singles = {
+                test_id: json.loads(client.get(f"/results/{test_id}/aggregate").text)
+                for test_id in (1, 2, 4)
+            }
+            posted = client.post("/results/aggregate", json={"test_ids": [4, 2]})
+        body = json.loads(resp.text)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(body["results"], {str(k): v for k, v in singles.items()})
+        self.assertEqual(list(body["errors"]), ["3"])
+        self.assertEqual(sorted(json.loads(posted.text)["results"]), ["2", "4"])
+
+    def test_aggregate__batch_endpoint_invalid_ranges(self):
+        """
+        Oversized ranges are refused before being expanded, and reversed 
+        ranges are refused rather than silently matching nothing.
+        """
+        with app.test_client() as client:
+            huge = client.get("/results/aggregate?test_ids=0-1000000000")
+            over_budget = client.post("/results/aggregate", json={"test_ids": [1, 2, "3-100001"]})
+            reversed_range = client.get("/results/aggregate?test_ids=10-1")
+
+        self.assertEqual(huge.status_code, 400)
+        self.assertIn("At most 100000 test ids may be requested", huge.text)
+        self.assertEqual(over_budget.status_code, 400)
+        self.assertEqual(reversed_range.status_code, 400)
+        self.assertIn("Range 10-1 ends before it starts", reversed_range.text)
+
+    def test_aggregate__endpoints_agree_on_rounded_percentages(self):
+        """
+        The mean and stddev are taken over rounded percentages by every 
+        endpoint, so they agree even when percentages don't divide evenly.
+        """
+        self.import_mocks([
+            MockData(student_number=1, available_marks=3, obtained_marks=0),
+            MockData(student_number=2, available_marks=3, obtained_marks=1),
+        ])
+
+        with app.test_client() as client:
+            single = json.loads(client.get(f"/results/{MockData.test_id}/aggregate").text)
+            batch = json.loads(client.get(f"/results/aggregate?test_ids={MockData.test_id}").text)
+        self.assertEqual(single, batch["results"][str(MockData.test_id)])
+        self.assertEqual((single["mean"], single["stddev"]), (16.66, 16.66))
+        self.assertEqual(single, numpy_summary([0, 1], 3))
+
+    def test_aggregate__batch_endpoint_streams_ndjson(self):
+        """
+        Clients accepting NDJSON get one line per requested test, in request order.
+        """
+        self.import_mocks([MockData(student_number=i, test_id=test_id) for test_id in (1, 2) for i in range(3)])
+        app.config["BATCH_AGGREGATE_BLOCK_SIZE"] = 2
+        try:
+            with app.test_client() as client: 
+                resp = client.get("/results/aggregate?test_ids=2,3,1", headers={"Accept": "application/x-ndjson"})
+                lines = [json.loads(line) for line in resp.text.splitlines()]
+        finally:
+            app.config["BATCH_AGGREGATE_BLOCK_SIZE"] = 1000
+
+        self.assertEqual([line["test_id"] for line in lines], [2, 3, 1])
+        self.assertEqual(lines[0]["summary"]["count"], 3)
+        self.assertIn("error", lines[1])
+
+    def test_aggregate__batch_endpoint_bad_ids(self):
+        """
+        Malformed or missing test ID lists are rejected.
+        """
+        with app.test_client() as client: 
+            self.assertEqual(client.get("/results/aggregate?test_ids=1,abc").status_code, 400)
+            self.assertEqual(client.get("/results/aggregate").status_code, 400)
+            for spec in ("-5", "1,5-,7", "5-"):
+                resp = client.get(f"/results/aggregate?test_ids={spec}")
+                self.assertEqual(resp.status_code, 400, spec)
+            self.assertIn("Range 5- needs both a start and an end", resp.text)
+            for body in ([1, 2], "1,2", 5):
+                resp = client.post("/results/aggregate", json=body)
+                self.assertEqual(resp.status_code, 400, body)
+            self.assertIn("Expected a JSON object", resp.text)
+
+    def test_aggregate__percentages_derived_from_current_available_marks(self):
+        """
+        Raising a test's available marks changes every percentage without the 
+        stored score rows being rewritten.
+        """
+        self.import_mocks([MockData(student_number=i, obtained_marks=i + 4) for i in range(3)])
+        self.import_mocks([MockData(student_number=9, obtained_marks=16, available_marks=20)])
+
+        expected = numpy_summary([4, 5, 6, 16], 20)
+        with app.app_context():
+            self.assertEqual(compute_test_score_summary(MockData.test_id), expected)
+            self.assertEqual(compute_test_score_summaries([MockData.test_id])[0][MockData.test_id], expected)
+            self.assertEqual(get_test_score_summary(MockData.test_id), expected)
+            score = TestScore.query.filter_by(student_id=0).one()
+            self.assertEqual(score.percent_score, 20.0)
+
+    def rollup_mocks(self):
+        """
+        Imports three tests with different available marks, returning every
+        percentage score imported.
+        """
+        rng = random.Random(7)
+        percents = []
+        for test_id, available_marks in ((1, 20), (2, 37), (3, 150)):
+            mocks = [
+                MockData(student_number=i, test_id=test_id, available_marks=available_marks, obtained_marks=rng.randrange(available_marks + 1))
+                for i in range(300)
+            ]
+            self.import_mocks(mocks)
+            percents += [percent(mock.obtained_marks, available_marks) for mock in mocks]
+        return np.array(percents)
+
+    def test_aggregate__rollup_matches_numpy(self):
+        """
+        The exact rollup matches numpy over the scores of every test combined.
+        """
+        dataset = self.rollup_mocks()
+        with app.test_client() as client: 
+            resp = json.loads(client.get("/results/rollup?test_ids=1-3,99").text)
+
+        self.assertEqual(resp["missing"], [99])
+        expected = _summary_from_array(dataset)
+        for stat in ("median", "min", "max", "count", "p25", "p50", "p95"):
+            self.assertEqual(resp["summary"][stat], expected[stat])
+        self.assertAlmostEqual(resp["summary"]["mean"], expected["mean"], places=2)
+        self.assertAlmostEqual(resp["summary"]["stddev"], expected["stddev"], places=2)
+
+    def test_aggregate__rollup_bad_ids(self):
+        with app.test_client() as client: 
+            for body in ([1, 2], "1,2"):
+                resp = client.post("/results/rollup", json=body)
+                self.assertEqual(resp.status_code, 400, body)
+            self.assertEqual(client.get("/results/rollup?test_ids=1-").status_code, 400)
+
+    def test_aggregate__approx_rollup_within_error_bound(self):
+        """
+        Approximate percentiles are within the reported error of numpy's.
+        """
+        dataset = self.rollup_mocks()
+        with app.test_client() as client: 
+            resp = json.loads(client.post("/results/rollup?approx=1", json={"test_ids": [1, 2, 3]}).text)
+            single = json.loads(client.get("/results/2/aggregate?approx=1").text)
+
+        expected = _summary_from_array(dataset)
+        for stat in ("median", "p25", "p50", "p95"):
+            self.assertLessEqual(abs(resp["summary"][stat] - expected[stat]), resp["quantile_error"] + 1e-9)
+        for stat in ("min", "max", "count"):
+            self.assertEqual(resp["summary"][stat], expected[stat])
+
+        for stat in ("mean", "stddev"):
+            self.assertLessEqual(abs(resp["summary"][stat] - expected[stat]), 0.01 + 1e-9)
+
+        with app.app_context():
+            exact = get_test_score_summary(2)
+        for stat in ("median", "p25", "p50", "p95"):
+            self.assertLessEqual(abs(single[stat] - exact[stat]), single["quantile_error"] + 1e-9)
+        self.assertLessEqual(abs(single["mean"] - exact["mean"]), 0.01 + 1e-9)
+
+    def test_aggregate__approx_rollup_reads_maintained_sketches(self):
+        """
+        Imports keep each test's sketch, following changes to its available 
+        marks. Percentages above 100% get bins of their own rather than 
+        sharing the top one, and aggregates without a sketch yet are 
+        sketched from their histograms.
+        """
+        self.import_mocks([MockData(student_number=i, test_id=1, available_marks=10, obtained_marks=10 + i) for i in range(4)])
+        self.import_mocks([MockData(student_number=i, test_id=2, available_marks=10, obtained_marks=i) for i in range(4)])
+        self.import_mocks([MockData(student_number=9, test_id=2, available_marks=20, obtained_marks=2)])
+        with app.app_context():
+            self.assertEqual(db.session.get(TestAggregate, 1).sketch, {"1000": 1, "1100": 1, "1200": 1, "1300": 1})
+            self.assertEqual(db.session.get(TestAggregate, 2).sketch, {"0": 1, "50": 1, "100": 2, "150": 1})
+            with app.test_client() as client:
+                resp = client.get("/results/rollup?approx=1&test_ids=1,2").json
+            exact = compute_rollup_summary([1, 2])[0]
+            for agg in TestAggregate.query:
+                agg.sketch = None
+            db.session.commit()
+            with app.test_client() as client:
+                self.assertEqual(client.get("/results/rollup?approx=1&test_ids=1,2").json, resp)
+
+        for stat in ("median", "p25", "p50", "p95"):
+            self.assertLessEqual(abs(resp["summary"][stat] - exact[stat]), resp["quantile_error"] + 1e-9)
+        self.assertEqual(resp["summary"]["max"], 130)
+
+
+class TestTimeWindows(TestCase):
+    def setUp(self) -> None:
+        # Four scores per day over ten days, all at 23:00 in UTC+11.
+        self.scores = {}
+        mocks = []
+        for i in range(40):
+            day = datetime.date(2017, 12, 1) + datetime.timedelta(days=i // 4)
+            mocks.append(MockData(student_number=i, obtained_marks=i % 11, scanned_on=f"{day}T23:00:00+11:00"))
+            self.scores[i] = (day, i % 11)
+        with app.test_client() as client: 
+            client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def test_aggregate__time_window(self):
+        """
+        ?from=&to= restricts the statistics to scores scanned in that window.
+        """
+        with app.test_client() as client: 
+            resp = client.get(f"/results/{MockData.test_id}/aggregate?from=2017-12-03T00:00:00%2B11:00&to=2017-12-06T00:00:00%2B11:00")
+            empty = client.get(f"/results/{MockData.test_id}/aggregate?from=2018-01-01")
+            invalid = client.get(f"/results/{MockData.test_id}/aggregate?from=soon")
+
+        expected = [score for day, score in self.scores.values() if datetime.date(2017, 12, 3) <= day < datetime.date(2017, 12, 6)]
+        self.assertEqual(json.loads(resp.text), numpy_summary(expected, MockData.available_marks))
+        self.assertEqual(empty.status_code, 400)
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_aggregate__timeseries_by_day(self):
+        """
+        Each UTC day's bucket matches numpy over that day's scores.
+        """
+        with app.test_client() as client: 
+            resp = client.get(f"/results/{MockData.test_id}/timeseries?bucket=day")
+        series = json.loads(resp.text)["series"]
+
+        self.assertEqual(len(series), 10)
+        for i, point in enumerate(series):
+            # 23:00 in UTC+11 is 12:00 UTC on the same day.
+            day = datetime.date(2017, 12, 1) + datetime.timedelta(days=i)
+            self.assertEqual(point.pop("bucket"), f"{day}T00:00:00Z")
+            expected = [score for d, score in self.scores.values() if d == day]
+            self.assertEqual(point, numpy_summary(expected, MockData.available_marks))
+
+    def test_aggregate__timeseries_by_week(self):
+        """
+        Weeks start on Monday, and the window applies to the series.
+        """
+        with app.test_client() as client: 
+            resp = client.get(f"/results/{MockData.test_id}/timeseries?bucket=week&to=2017-12-10T00:00:00Z")
+            bad_bucket = client.get(f"/results/{MockData.test_id}/timeseries?bucket=fortnight")
+        series = json.loads(resp.text)["series"]
+
+        # 1-3 Dec 2017 fall in the week of Monday 27 Nov, 4-9 Dec in the week of the 4th.
+        self.assertEqual([point["bucket"] for point in series], ["2017-11-27T00:00:00Z", "2017-12-04T00:00:00Z"])
+        self.assertEqual([point["count"] for point in series], [12, 24])
+        self.assertEqual(bad_bucket.status_code, 400)
+
+    def test_aggregate__timeseries_single_query(self):
+        """
+        The series costs one query however many buckets it has.
+        """
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+            event.listen(engine, "before_cursor_execute", count_statement)
+            try:
+                compute_test_score_timeseries(MockData.test_id, "day")
+            finally:
+                event.remove(engine, "before_cursor_execute", count_statement)
+        self.assertEqual(len(statements), 1)
@@ -0,0 +1,158 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, mock
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import inspect, text
+from markr.db.models import db, engine_options
+from markr.tests.test_import import database_app
+
+
+class TestEngineOptions(TestCase):
+    def test_engine_options__from_env(self):
+        """
+        Pool sizing, pre-ping and statement timeouts are read from the environment.
+        """
+        env = {
+            "DB_POOL_SIZE": "20",
+            "DB_MAX_OVERFLOW": "5",
+            "DB_POOL_PRE_PING": "false",
+            "DB_STATEMENT_TIMEOUT_MS": "1500",
+        }
+        with mock.patch.dict(os.environ, env):
+            options = engine_options("postgresql+psycopg2://u:p@db/markr")
+
+        self.assertEqual(options["pool_size"], 20)
+        self.assertEqual(options["max_overflow"], 5)
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=1500"})
+
+    def test_engine_options__sqlite_defaults(self):
+        """
+        SQLite engines keep SQLAlchemy's default pooling.
+        """
+        self.assertEqual(engine_options("sqlite:///:memory:"), {})
+
+
+class TestStartup(TestCase):
+    """
+    Markr runs one app per process, so each test starts the app in a 
+    process of its own.
+    """
+
+    def run_app(self, code: str, **env: str):
+        env = {**os.environ, "RUN_ENV": "TESTING", "PYTHONPATH": os.pathsep.join(sys.path), **env}
+        result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_startup__numpy_imported_lazily(self):
+        """
+        Importing the app doesn't import numpy, only the first request that needs it does.
+        """
+        self.run_app(
+            "import sys\n"
+            "from markr.app import app\n"
+            "assert 'numpy' not in sys.modules\n"
+            "from markr.db.db_helpers import ANSWER_DTYPE\n"
+            "assert 'numpy' in sys.modules and ANSWER_DTYPE.itemsize == 8\n"
+        )
+
+    def test_startup__schema_created_explicitly(self):
+        """
+        Creating the app leaves a real database untouched until its 
+        migrations are run, even once its worker has warmed up. /readyz 
+        reports whether the database answers.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.run_app(
+            "from sqlalchemy import inspect\n"
+            "from markr.app import app\n"
+            "from markr.db.models import db, warm_pool\n"
+            "from markr.scorestore import score_store\n"
+            "warm_pool(app)\n"
+            "score_store.start(app, app.config['SCORE_STORE_SNAPSHOT_SECONDS'])\n"
+            "with app.app_context():\n"
+            "    assert inspect(db.engine).get_table_names() == []\n"
+            "result = app.test_cli_runner().invoke(args=['db', 'upgrade'])\n"
+            "assert result.exit_code == 0, result.output\n"
+            "with app.app_context():\n"
+            "    assert 'test_scores' in inspect(db.engine).get_table_names()\n"
+            "with app.test_client() as client:\n"
+            "    assert client.get('/healthz').json == {'status': 'ok'}\n"
+            "    resp = client.get('/readyz')\n"
+            "assert resp.status_code == 200 and resp.json['status'] == 'ready', resp.json\n"
+            "assert 'pool_warm' in resp.json\n",
+            DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'markr.db')}",
+        )
+
+    def test_startup__not_ready_without_database(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.run_app(
+            "from markr.app import app\n"
+            "with app.test_client() as client:\n"
+            "    assert client.get('/healthz').status_code == 200\n"
+            "    resp = client.get('/readyz')\n"
+            "assert resp.status_code == 503 and resp.json['status'] == 'unavailable', resp.json\n",
+            DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'missing', 'markr.db')}",
+        )
+
+
+class TestMigrations(TestCase):
+    def setUp(self) -> None:
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.app = database_app(f"sqlite:///{os.path.join(tmpdir, 'markr.db')}")
+        self.addCleanup(self.dispose_engines)
+
+    def dispose_engines(self):
+        with self.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+    def test_migrations__match_models(self):
+        """
+        Upgrading an empty database gives exactly the schema the models 
+        declare, including the index serving student lookups.
+        """
+        with self.app.app_context():
+            upgrade()
+            with db.engine.connect() as connection:
+                diff = compare_metadata(MigrationContext.configure(connection), db.metadata)
+            indexes = {index["name"] for index in inspect(db.engine).get_indexes("test_scores")}
+        self.assertEqual(diff, [])
+        self.assertIn("ix_test_scores_student_id_test_id", indexes)
+
+    def test_migrations__downgrade(self):
+        with self.app.app_context():
+            upgrade()
+            downgrade(revision="base")
+            self.assertEqual(inspect(db.engine).get_table_names(), ["alembic_version"])
+
+    def test_migrations__upgrade_existing_data(self):
+        """
+        Scores imported under the initial schema are deduplicated, keeping 
+        the highest, and their tests' aggregates backfilled.
+        """
+        with self.app.app_context():
+            upgrade(revision="f359ab9a4ef3")
+            with db.engine.begin() as connection:
+                connection.execute(text("INSERT INTO students VALUES (1, 'Jane', 'Austen'), (2, 'John', 'Keats')"))
+                connection.execute(text("INSERT INTO tests VALUES (7, 20)"))
+                connection.execute(text(
+                    "INSERT INTO test_scores (test_id, student_id, score, percent_score) "
+                    "VALUES (7, 1, 5, 25), (7, 1, 9, 45), (7, 2, 3, 15)"
+                ))
+            upgrade()
+            with db.engine.connect() as connection:
+                scores = connection.execute(text("SELECT student_id, score FROM test_scores ORDER BY student_id")).all()
+                aggregate = connection.execute(text(
+                    "SELECT count, score_sum, score_sum_sq, min_score, max_score, version FROM test_aggregates WHERE test_id = 7"
+                )).one()
+        self.assertEqual([tuple(row) for row in scores], [(1, 9), (2, 3)])
+        self.assertEqual(tuple(aggregate), (2, 12, 90, 3, 9, 0))
@@ -0,0 +1,93 @@
+import csv
+import io
+import json
+from unittest import TestCase
+import pytest
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.tests.test_import import MockData, gen_input
+
+
+class TestExport(TestCase):
+    def setUp(self) -> None:
+        mocks = [
+            MockData(student_number=i, test_id=i % 2, fname=f"First{i}", obtained_marks=i % 11)
+            for i in range(25)
+        ]
+        with app.test_client() as client:
+            client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+        app.config["EXPORT_BATCH_SIZE"] = 4
+
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+        app.config["EXPORT_BATCH_SIZE"] = 5000
+
+    def expected_rows(self, test_id):
+        return [
+            {
+                "test_id": test_id,
+                "student_id": i,
+                "first_name": f"First{i}",
+                "last_name": MockData.lname,
+                "score": i % 11,
+                "available_marks": MockData.available_marks,
+                "percent_score": round((i % 11) / MockData.available_marks * 100, 2),
+                "scanned_on": "2017-12-04T01:12:10+00:00",
+            }
+            for i in range(25) if i % 2 == test_id
+        ]
+
+    def test_export__ndjson(self):
+        """
+        Scores are exported as NDJSON by default, in batches, ordered by student.
+        """
+        with app.test_client() as client:
+            resp = client.get("/results/1/scores")
+
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertTrue(resp.is_streamed)
+        rows = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual(rows, self.expected_rows(1))
+
+    def test_export__csv_all_tests(self):
+        with app.test_client() as client:
+            resp = client.get("/results/scores", headers={"Accept": "text/csv"})
+
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(resp.text)))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]["test_id"], "0")
+        self.assertEqual(rows[-1]["test_id"], "1")
+        self.assertEqual(rows[0]["scanned_on"], "2017-12-04T01:12:10+00:00")
+
+    def test_export__parquet(self):
+        pq = pytest.importorskip("pyarrow.parquet")
+        with app.test_client() as client:
+            resp = client.get("/results/0/scores?format=parquet")
+
+        self.assertEqual(resp.mimetype, "application/vnd.apache.parquet")
+        parquet = pq.ParquetFile(io.BytesIO(resp.data))
+        # One row group per fetched batch.
+        self.assertEqual(parquet.metadata.num_row_groups, 4)
+        table = parquet.read().to_pylist()
+        expected = self.expected_rows(0)
+        self.assertEqual([row["student_id"] for row in table], [row["student_id"] for row in expected])
+        self.assertEqual(table[0]["percent_score"], expected[0]["percent_score"])
+
+    def test_export__unacceptable(self):
+        """
+        Formats that can't be produced get a 406, unknown tests a 400.
+        """
+        with app.test_client() as client:
+            self.assertEqual(client.get("/results/1/scores", headers={"Accept": "application/xml"}).status_code, 406)
+            self.assertEqual(client.get("/results/1/scores?format=xlsx").status_code, 406)
+            self.assertEqual(client.get("/results/99/scores").status_code, 400)
@@ -1,10 +1,25 @@
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import typing as t
-from unittest import TestCase
-from markr.app import app
-from markr.db.models import TestScore, Student, Test, db
+import zlib
+from unittest import TestCase, mock
+from markr import metrics
+from markr.app import app, bp
+from markr.cache import aggregate_cache
+from markr.jobs import DatabaseJobStore, import_jobs
+from markr.db.models import ImportFingerprint, ImportJobStatus, RecordFingerprint, TestAggregate, TestScore, Student, Test, create_schema, db, init_db
+from markr.db.db_helpers import DEFAULT_CHUNK_SIZE, get_test_score_summary, prune_fingerprints
 from dataclasses import dataclass 
+from sqlalchemy import event
 from sqlalchemy.orm import joinedload
-from flask import abort
+from flask import Flask, abort
 import pytest
 from werkzeug.exceptions import HTTPException
 
@@ -16,13 +31,37 @@ class MockData:
     test_id: int = 1234
     available_marks: int = 10
     obtained_marks: int = 5
+    # Number of <answer> elements to include, the first `obtained_marks` of
+    # which are marked correct.
+    answers: int = 0
+    scanned_on: str = "2017-12-04T12:12:10+11:00"
+
+def database_app(url: str) -> Flask:
+    """
+    Builds a copy of the markr app, serving the same routes and config from 
+    the database at url. Unlike create_app(), it leaves the process-wide 
+    services configured for markr.app.app, which it shares.
+    """
+    copy = Flask(app.import_name)
+    copy.config.from_mapping({key: value for key, value in app.config.items() if not key.startswith("SQLALCHEMY_")})
+    with mock.patch.dict(os.environ, {"DATABASE_URL": url}):
+        init_db(copy)
+    copy.extensions["markr_job_store"] = DatabaseJobStore(copy, copy.config["IMPORT_JOB_RETENTION"])
+    metrics.init_metrics(copy)
+    copy.register_blueprint(bp)
+    return copy
 
 def gen_test_result_xml(mock_data: MockData) -> str:
-    xml = f"""<mcq-test-result scanned-on="2017-12-04T12:12:10+11:00">
+    answers = "".join(
+        f"""<answer question="{q}" marks-available="1" marks-awarded="{int(q < mock_data.obtained_marks)}">{"ABCD"[q % 4]}</answer>"""
+        for q in range(mock_data.answers)
+    )
+    xml = f"""<mcq-test-result scanned-on="{mock_data.scanned_on}">
             <first-name>{mock_data.fname}</first-name>
             <last-name>{mock_data.lname}</last-name>
             <student-number>{mock_data.student_number}</student-number>
             <test-id>{mock_data.test_id}</test-id>
+            {answers}
             <summary-marks available="{mock_data.available_marks}" obtained="{mock_data.obtained_marks}" />
         </mcq-test-result>"""
     return xml
@@ -98,14 +137,27 @@ incomplete_data_test_cases = {
 }
 
 
+def wait_for_job(client, location: str) -> dict:
+    for _ in range(200):
+        job = json.loads(client.get(location).text)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Import job did not finish")
+
+
 class TestImport(TestCase):
     def tearDown(self) -> None:
         # Ensure DB is cleared after each test
         with app.app_context():
+            TestAggregate.query.delete()
             Student.query.delete()
             Test.query.delete()
             TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
             db.session.commit()
+        aggregate_cache.clear()
 
     def test_import__success(self):
         """
@@ -155,6 +207,19 @@ class TestImport(TestCase):
 
         self.assertEqual(score.student.fname, mock_data.fname)
 
+    def test_import__scanned_on_stored_in_utc(self):
+        """
+        The scanned-on timestamp is stored in UTC, and rejected if malformed.
+        """
+        with app.test_client() as client: 
+            client.post("/import", data=gen_input([MockData()]), content_type='text/xml+markr')
+            resp = client.post("/import", data=gen_input([MockData(student_number=1, scanned_on="yesterday")]), content_type='text/xml+markr')
+
+        self.assertEqual(resp.status_code, 400)
+        with app.app_context():
+            score = TestScore.query.one()
+        self.assertEqual(score.scanned_on.replace(tzinfo=None), datetime.datetime(2017, 12, 4, 1, 12, 10))
+
     def test_import__pick_student_highest_score(self):
         """
         If a test score is sent multiple times for the same student, then pick the highest result.
@@ -279,14 +344,476 @@ class TestImport(TestCase):
             resp = client.post("/import", data="{}", content_type='application/json')
         
         self.assertEqual(resp.status_code, 400)
-    
 
-        
-        
+    def test_import__streamed_in_chunks(self):
+        """
+        Documents larger than the flush chunk size should be imported in full.
+        """
+        app.config["IMPORT_CHUNK_SIZE"] = 3
+        try:
+            mock_data = [MockData(student_number=i) for i in range(10)]
+            with app.test_client() as client: 
+                resp = client.post("/import", data=gen_input(mock_data), content_type='text/xml+markr')
+        finally:
+            app.config["IMPORT_CHUNK_SIZE"] = DEFAULT_CHUNK_SIZE
+
+        self.assertEqual(resp.status_code, 200)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 10)
 
+    def test_import__late_error_rolls_back_flushed_chunks(self):
+        """
+        An invalid result after earlier chunks were flushed must still reject the 
+        whole document.
+        """
+        app.config["IMPORT_CHUNK_SIZE"] = 2
+        try:
+            valid = "".join(gen_test_result_xml(MockData(student_number=i)) for i in range(6))
+            xml = f"""<mcq-test-results>{valid}{incomplete_data_test_cases["no_summary_marks"]}</mcq-test-results>"""
+            with app.test_client() as client: 
+                resp = client.post("/import", data=xml, content_type='text/xml+markr')
+        finally:
+            app.config["IMPORT_CHUNK_SIZE"] = DEFAULT_CHUNK_SIZE
+
+        self.assertEqual(resp.status_code, 400)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+            self.assertEqual(Student.query.count(), 0)
+
+    def test_import__truncated_xml(self):
+        """
+        A document cut off part way through is rejected, even though the leading 
+        results were already parsed.
+        """
+        xml = gen_input([MockData(student_number=i) for i in range(5)])[:-30]
+        with app.test_client() as client: 
+            resp = client.post("/import", data=xml, content_type='text/xml+markr')
+
+        self.assertEqual(resp.status_code, 400)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+
+    def test_import__highest_score_across_chunks(self):
+        """
+        Duplicate student/test pairs split across flush chunks should still resolve
+        to the highest score.
+        """
+        app.config["IMPORT_CHUNK_SIZE"] = 2
+        try:
+            mock_data = [
+                MockData(obtained_marks=3), MockData(student_number=1),
+                MockData(obtained_marks=8), MockData(student_number=2),
+                MockData(obtained_marks=6, available_marks=12),
+            ]
+            with app.test_client() as client: 
+                resp = client.post("/import", data=gen_input(mock_data), content_type='text/xml+markr')
+        finally:
+            app.config["IMPORT_CHUNK_SIZE"] = DEFAULT_CHUNK_SIZE
+
+        self.assertEqual(resp.status_code, 200)
+        with app.app_context():
+            score = TestScore.query.filter_by(student_id=MockData.student_number).one()
+            self.assertEqual(score.score, 8)
+            self.assertEqual(TestScore.query.count(), 3)
+            self.assertEqual(db.session.get(Test, MockData.test_id).available_marks, 12)
+
+    def test_import__statement_count_independent_of_rows(self):
+        """
+        Importing a batch should cost a fixed number of statements, not several
+        per record.
+        """
+        statements = []
 
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
 
+        mock_data = [MockData(student_number=i, test_id=i % 3) for i in range(200)]
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_statement)
+        try:
+            with app.test_client() as client: 
+                resp = client.post("/import", data=gen_input(mock_data), content_type='text/xml+markr')
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(statements), 10)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 200)
+
+
+class TestParallelImport(TestCase):
+    """
+    Runs against a SQLite file, since every session shares the one 
+    connection to the in-memory test database.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = database_app(f"sqlite:///{os.path.join(self.tmpdir, 'markr.db')}")
+        self.app.config["IMPORT_PARALLELISM"] = 4
+        self.app.config["IMPORT_CHUNK_SIZE"] = 20
+        create_schema(self.app)
+
+    def tearDown(self) -> None:
+        with self.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+        shutil.rmtree(self.tmpdir)
+        aggregate_cache.clear()
+
+    def post(self, mocks: t.List[MockData]):
+        with self.app.test_client() as client:
+            return client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+
+    def assert_matches_best_scores(self, mocks: t.List[MockData]):
+        best: t.Dict[t.Tuple[int, int], int] = {}
+        for mock_data in mocks:
+            key = (mock_data.test_id, mock_data.student_number)
+            best[key] = max(best.get(key, 0), mock_data.obtained_marks)
+        with self.app.app_context():
+            stored = {(score.test_id, score.student_id): score.score for score in TestScore.query}
+            self.assertEqual(stored, best)
+            for agg in TestAggregate.query:
+                scores = [score for (test_id, _), score in best.items() if test_id == agg.test_id]
+                self.assertEqual(agg.count, len(scores))
+                self.assertEqual(agg.score_sum, sum(scores))
+                self.assertEqual(agg.histogram, {str(score): scores.count(score) for score in set(scores)})
+
+    def test_import__parallel_partitions(self):
+        """
+        Results written by concurrent partitions keep each student's highest
+        score, whichever partition commits first.
+        """
+        rng = random.Random(0)
+        mocks = [
+            MockData(student_number=rng.randrange(60), test_id=rng.randrange(7), obtained_marks=rng.randrange(21))
+            for _ in range(300)
+        ]
+        resp = self.post(mocks)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assert_matches_best_scores(mocks)
+        with self.app.app_context():
+            self.assertEqual(Student.query.count(), len({mock_data.student_number for mock_data in mocks}))
+            summary = get_test_score_summary(0)
+        self.assertEqual(summary["count"], len({m.student_number for m in mocks if m.test_id == 0}))
+
+    def test_import__parallel_large_test(self):
+        """
+        A test with more results than IMPORT_CHUNK_SIZE is split over 
+        partitions written concurrently, with rescans of a student landing
+        in different partitions, and still keeps each student's highest 
+        score and an exact aggregate.
+        """
+        rng = random.Random(2)
+        mocks = [MockData(student_number=i % 50, obtained_marks=rng.randrange(21)) for i in range(150)]
+        self.assertGreater(len(mocks), 4 * self.app.config["IMPORT_CHUNK_SIZE"])
+        resp = self.post(mocks)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assert_matches_best_scores(mocks)
+        with self.app.app_context():
+            self.assertEqual(get_test_score_summary(MockData.test_id)["count"], 50)
+
+    def test_import__concurrent_overlapping_imports(self):
+        """
+        Imports of overlapping students and tests running at the same time 
+        all succeed, and the highest score wins.
+        """
+        rng = random.Random(1)
+        uploads = [
+            [
+                MockData(student_number=rng.randrange(40), test_id=rng.randrange(4), obtained_marks=rng.randrange(21))
+                for _ in range(100)
+            ]
+            for _ in range(4)
+        ]
+        statuses = []
+        threads = [threading.Thread(target=lambda mocks=mocks: statuses.append(self.post(mocks).status_code)) for mocks in uploads]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 4)
+        self.assert_matches_best_scores([mock_data for mocks in uploads for mock_data in mocks])
+
+    def test_import__parallel_validates_before_writing(self):
+        valid = "".join(gen_test_result_xml(MockData(student_number=i)) for i in range(50))
+        xml = f"""<mcq-test-results>{valid}{incomplete_data_test_cases["no_summary_marks"]}</mcq-test-results>"""
+        with self.app.test_client() as client:
+            resp = client.post("/import", data=xml, content_type='text/xml+markr')
+
+        self.assertEqual(resp.status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+            self.assertEqual(Student.query.count(), 0)
+
+
+class TestImportDeduplication(TestCase):
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+        app.config["IMPORT_FINGERPRINT_RETENTION"] = 7 * 24 * 3600
+
+    def post(self, mocks: t.List[MockData]):
+        with app.test_client() as client: 
+            return client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+
+    def test_import__replayed_payload_skipped(self):
+        """
+        A retried upload is answered from its fingerprint with a single lookup.
+        """
+        mock_data = [MockData(student_number=i) for i in range(20)]
+        self.assertEqual(json.loads(self.post(mock_data).text), "Added/modified 20 test scores")
 
+        statements = []
 
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
 
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_statement)
+        try:
+            resp = self.post(mock_data)
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
+        self.assertEqual(json.loads(resp.text), "Added/modified 0 test scores, skipped 20 duplicates")
+        self.assertEqual(len(statements), 1)
+
+    def test_import__seen_records_skipped(self):
+        """
+        Results already imported, or repeated within the upload, are skipped;
+        results whose marks changed are not.
+        """
+        self.post([MockData(student_number=i) for i in range(5)])
+        mock_data = (
+            [MockData(student_number=i) for i in range(10)]
+            + [MockData(student_number=9)]
+            + [MockData(student_number=0, obtained_marks=MockData.obtained_marks + 1)]
+        )
+        resp = self.post(mock_data)
+
+        self.assertEqual(json.loads(resp.text), "Added/modified 6 test scores, skipped 6 duplicates")
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 10)
+            self.assertEqual(TestScore.query.filter_by(student_id=0).one().score, MockData.obtained_marks + 1)
+
+    def test_import__async_reports_skipped(self):
+        self.post([MockData(student_number=i) for i in range(2)])
+        with app.test_client() as client: 
+            resp = client.post("/import?async=1", data=gen_input([MockData(student_number=i) for i in range(3)]), content_type='text/xml+markr')
+            job = wait_for_job(client, resp.headers["Location"])
+
+        self.assertEqual(job["records_processed"], 1)
+        self.assertEqual(job["records_skipped"], 2)
+
+    def test_import__fingerprints_pruned(self):
+        """
+        Fingerprints older than the retention period are deleted, after which
+        the same results are imported again.
+        """
+        mock_data = [MockData(student_number=i) for i in range(3)]
+        self.post(mock_data)
+        with app.app_context():
+            old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2)
+            ImportFingerprint.query.update({"created_at": old})
+            RecordFingerprint.query.update({"created_at": old})
+            self.assertEqual(prune_fingerprints(3600), 4)
+            db.session.commit()
+
+        self.assertEqual(json.loads(self.post(mock_data).text), "Added/modified 3 test scores")
+
+    def test_import__deduplication_disabled(self):
+        app.config["IMPORT_FINGERPRINT_RETENTION"] = 0
+        mock_data = [MockData(student_number=i) for i in range(3)]
+        self.post(mock_data)
+
+        self.assertEqual(json.loads(self.post(mock_data).text), "Added/modified 3 test scores")
+        with app.app_context():
+            self.assertEqual(ImportFingerprint.query.count() + RecordFingerprint.query.count(), 0)
+
+
+class TestAsyncImport(TestCase):
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            ImportJobStatus.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+        import_jobs.configure(app.config["IMPORT_WORKERS"], app.config["IMPORT_QUEUE_SIZE"])
+
+    def test_import__async_success(self):
+        """
+        An async import returns 202 straight away and its job reports the result.
+        """
+        mock_data = [MockData(student_number=i) for i in range(7)]
+        with app.test_client() as client: 
+            resp = client.post("/import?async=1", data=gen_input(mock_data), content_type='text/xml+markr')
+            self.assertEqual(resp.status_code, 202)
+            job = wait_for_job(client, resp.headers["Location"])
+
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["records_processed"], 7)
+        self.assertIsNotNone(job["run_seconds"])
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 7)
+
+    def test_import__async_all_or_nothing(self):
+        """
+        A failing async import reports the error and adds nothing to the db.
+        """
+        xml = f"""<mcq-test-results>{gen_test_result_xml(MockData())}{incomplete_data_test_cases["test_id_missing"]}</mcq-test-results>"""
+        with app.test_client() as client: 
+            resp = client.post("/import", data=xml, content_type='text/xml+markr', headers={"Prefer": "respond-async"})
+            job = wait_for_job(client, resp.headers["Location"])
+
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "Error extracting test data: Test result 2: No test ID given")
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+
+    def test_import__async_status_shared(self):
+        """
+        A job's status is saved to the database, so it can be reported by
+        worker processes other than the one running it.
+        """
+        with app.test_client() as client:
+            resp = client.post("/import?async=1", data=gen_input([MockData(student_number=i) for i in range(4)]), content_type='text/xml+markr')
+            wait_for_job(client, resp.headers["Location"])
+            # Waits for the job's final status to be saved.
+            import_jobs.configure(app.config["IMPORT_WORKERS"], app.config["IMPORT_QUEUE_SIZE"])
+            local = json.loads(client.get(resp.headers["Location"]).text)
+            # As seen by another process, which never ran the job.
+            import_jobs._jobs.clear()
+            shared = client.get(resp.headers["Location"])
+
+        self.assertEqual(shared.status_code, 200)
+        self.assertEqual(json.loads(shared.text), local)
+        self.assertEqual(local["records_processed"], 4)
+
+    def test_import__async_queue_full(self):
+        """
+        Async imports are refused with a 429 while the queue is full.
+        """
+        import_jobs.configure(workers=1, max_pending=1)
+        release = threading.Event()
+        import_jobs.submit(lambda job: release.wait(5) and 0)
+        try:
+            with app.test_client() as client: 
+                resp = client.post("/import?async=1", data=gen_input([MockData()]), content_type='text/xml+markr')
+        finally:
+            release.set()
+        self.assertEqual(resp.status_code, 429)
+
+    def test_import__async_gzip(self):
+        """
+        Async imports spool the compressed body and decompress it in the job.
+        """
+        body = gzip.compress(gen_input([MockData(student_number=i) for i in range(3)]).encode())
+        with app.test_client() as client: 
+            resp = client.post("/import?async=1", data=body, content_type='text/xml+markr', headers={"Content-Encoding": "gzip"})
+            self.assertEqual(resp.status_code, 202)
+            job = wait_for_job(client, resp.headers["Location"])
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["records_processed"], 3)
+
+    def test_import__unknown_job(self):
+        """
+        Unknown job IDs are reported as not found.
+        """
+        with app.test_client() as client: 
+            self.assertEqual(client.get("/import/jobs/nope").status_code, 404)
+
+
+class TestCompressedImport(TestCase):
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+        app.config["IMPORT_MAX_DECOMPRESSION_RATIO"] = 200
+
+    def post(self, body: bytes, encoding: str, path: str = "/import"):
+        with app.test_client() as client: 
+            return client.post(path, data=body, content_type='text/xml+markr', headers={"Content-Encoding": encoding})
+
+    def test_import__gzip(self):
+        """
+        gzip bodies, including multi-member ones, are decompressed as they are parsed.
+        """
+        first = gzip.compress(gen_input([MockData(student_number=i) for i in range(5)]).encode())
+        resp = self.post(first, "gzip")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.text), "Added/modified 5 test scores")
+
+        xml = gen_input([MockData(student_number=i) for i in range(5, 10)]).encode()
+        resp = self.post(gzip.compress(xml[:100]) + gzip.compress(xml[100:]), "gzip")
+        self.assertEqual(resp.status_code, 200)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 10)
+
+    def test_import__deflate(self):
+        resp = self.post(zlib.compress(gen_input([MockData()]).encode()), "deflate")
+        self.assertEqual(resp.status_code, 200)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 1)
+
+    def test_import__zstd(self):
+        zstandard = pytest.importorskip("zstandard")
+        resp = self.post(zstandard.ZstdCompressor().compress(gen_input([MockData()]).encode()), "zstd")
+        self.assertEqual(resp.status_code, 200)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 1)
+
+    def test_import__unsupported_encoding(self):
+        resp = self.post(b"...", "br")
+        self.assertEqual(resp.status_code, 415)
+
+    def test_import__corrupt_body(self):
+        """
+        A body that isn't valid for its encoding, or is cut short, is rejected and nothing is added.
+        """
+        body = gzip.compress(gen_input([MockData(student_number=i) for i in range(50)]).encode())
+        for corrupt in (b"not gzip at all", body[:len(body) // 2]):
+            resp = self.post(corrupt, "gzip")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("Unable to decompress body", resp.text)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+
+    def test_import__decompression_bomb(self):
+        """
+        Bodies expanding by more than IMPORT_MAX_DECOMPRESSION_RATIO are refused with a 413.
+        """
+        padding = " " * (8 * 1024 * 1024)
+        bomb = gzip.compress(f"<mcq-test-results>{padding}{gen_test_result_xml(MockData())}</mcq-test-results>".encode())
+        app.config["IMPORT_MAX_DECOMPRESSION_RATIO"] = 50
+        resp = self.post(bomb, "gzip")
+        self.assertEqual(resp.status_code, 413)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
 
+        app.config["IMPORT_MAX_DECOMPRESSION_RATIO"] = 0
+        self.assertEqual(self.post(bomb, "gzip").status_code, 200)
@@ -0,0 +1,131 @@
+import os 
+import json
+import xml.etree.ElementTree as ET
+from unittest import TestCase
+import numpy as np
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.db.db_helpers import ANSWER_DTYPE
+from markr.cache import aggregate_cache
+from markr.tests.test_import import incomplete_data_test_cases
+from markr.app import app
+
+
+class TestItemAnalysis(TestCase):
+    def setUp(self) -> None:
+        current_directory = os.path.dirname(os.path.abspath(__file__))
+        self.file_path = os.path.join(current_directory, 'sample_data.xml')
+        with open(self.file_path, 'r') as file:
+            file_content = file.read()
+        with app.test_client() as client: 
+            client.post("/import", data=file_content, content_type='text/xml+markr')
+
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def expected_items(self):
+        """
+        Reference item statistics computed question by question from the best 
+        result for each student in the sample data.
+        """
+        best = {}
+        for result in ET.parse(self.file_path).getroot().findall("mcq-test-result"):
+            student = int(result.find("student-number").text)
+            obtained = int(result.find("summary-marks").attrib["obtained"])
+            if student not in best or best[student][0] < obtained:
+                best[student] = (obtained, result.findall("answer"))
+
+        totals = np.array([obtained for obtained, _ in best.values()])
+        expected = {}
+        for question in range(20):
+            marks = np.array([
+                int(answers[question].attrib["marks-awarded"]) for _, answers in best.values()
+            ])
+            options = {}
+            for _, answers in best.values():
+                options[answers[question].text] = options.get(answers[question].text, 0) + 1
+            expected[question] = {
+                "facility": round(marks.mean(), 4),
+                "point_biserial": round(np.corrcoef(marks, totals)[0, 1], 4),
+                "options": options,
+            }
+        return len(best), expected
+
+    def test_items(self):
+        """
+        Per-question statistics match a question by question computation.
+        """
+        with app.test_client() as client: 
+            resp = client.get("/results/9863/items")
+        body = json.loads(resp.text)
+        count, expected = self.expected_items()
+
+        self.assertEqual(body["count"], count)
+        self.assertEqual(len(body["items"]), 20)
+        for item in body["items"]:
+            reference = expected[item["question"]]
+            self.assertEqual(item["marks_available"], 1)
+            self.assertEqual(item["facility"], reference["facility"])
+            self.assertAlmostEqual(item["point_biserial"], reference["point_biserial"], places=3)
+            self.assertEqual(item["options"], reference["options"])
+
+    def test_items__answers_stored_compactly(self):
+        """
+        Answers are stored as one packed blob per score.
+        """
+        with app.app_context():
+            score = TestScore.query.filter_by(student_id=2299).one()
+        answers = np.frombuffer(score.answers, dtype=ANSWER_DTYPE)
+        self.assertEqual(len(score.answers), 20 * ANSWER_DTYPE.itemsize)
+        self.assertEqual(answers["question"].tolist(), list(range(20)))
+        self.assertEqual(answers[0]["option"], b"D")
+
+    def test_items__no_answers(self):
+        """
+        Tests without stored answers are rejected.
+        """
+        with app.test_client() as client: 
+            self.assertEqual(client.get("/results/1111/items").status_code, 400)
+            self.assertEqual(client.get("/results/abc/items").status_code, 400)
+
+    def test_items__malformed_answer_rejected(self):
+        """
+        A result with a malformed answer rejects the whole document.
+        """
+        xml = incomplete_data_test_cases["student_number_missing"].replace(
+            "<test-id>78763</test-id>", "<student-number>5</student-number><test-id>78763</test-id>"
+        ).replace('question="2"', 'question="two"')
+        with app.test_client() as client: 
+            resp = client.post("/import", data=f"<mcq-test-results>{xml}</mcq-test-results>", content_type='text/xml+markr')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_items__unstorable_answer_rejected(self):
+        """
+        Answers that don't fit their packed layout are rejected by position 
+        rather than wrapped, truncated or failing the request.
+        """
+        result = incomplete_data_test_cases["student_number_missing"].replace(
+            "<test-id>78763</test-id>", "<student-number>5</student-number><test-id>78763</test-id>"
+        )
+        cases = {
+            "question too large": ('question="2"', 'question="70000"'),
+            "negative question": ('question="2"', 'question="-1"'),
+            "marks too large": ('marks-available="1" marks-awarded="0"', 'marks-available="40000" marks-awarded="0"'),
+            "non-ASCII option": (">B</answer>", ">é</answer>"),
+            "option too long": (">B</answer>", ">ABCD</answer>"),
+        }
+        for name, (old, new) in cases.items():
+            with self.subTest(name):
+                xml = result.replace(old, new)
+                self.assertNotEqual(xml, result)
+                with app.test_client() as client:
+                    resp = client.post("/import", data=f"<mcq-test-results>{xml}</mcq-test-results>".encode(), content_type='text/xml+markr')
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn("Test result 1: Invalid answer", resp.text)
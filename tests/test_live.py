@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import typing as t
+from unittest import IsolatedAsyncioTestCase
+import pytest
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, create_schema, db
+from markr.live import AggregateBroadcaster, aggregate_broadcaster, create_stream_app
+from markr.tests.test_import import MockData, database_app, gen_input
+
+test_utils = pytest.importorskip("aiohttp.test_utils")
+# State kept on the stream app must be declared with web.AppKey.
+pytestmark = pytest.mark.filterwarnings("error::aiohttp.web_exceptions.NotAppKeyWarning")
+
+
+async def read_event(resp) -> t.Tuple[str, t.Dict[str, t.Any], t.Optional[str]]:
+    """
+    Reads the next event from a Server-Sent Events response.
+    """
+    block = await asyncio.wait_for(resp.content.readuntil(b"\n\n"), 5)
+    fields = dict(line.split(": ", 1) for line in block.decode().strip().splitlines())
+    return fields["event"], json.loads(fields["data"]), fields.get("id")
+
+
+class TestAggregateStream(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        app.config["AGGREGATE_STREAM_DEBOUNCE_SECONDS"] = 0.2
+        # Updates come from the import signal, not polling.
+        app.config["AGGREGATE_STREAM_POLL_SECONDS"] = 60
+        self.client = test_utils.TestClient(test_utils.TestServer(create_stream_app(app)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        app.config["AGGREGATE_STREAM_DEBOUNCE_SECONDS"] = 0.5
+        app.config["AGGREGATE_STREAM_POLL_SECONDS"] = 1
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def post(self, mocks: t.List[MockData]):
+        with app.test_client() as client:
+            resp = client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+        self.assertEqual(resp.status_code, 200)
+
+    async def test_stream__pushes_updates(self):
+        """
+        Each stream starts with the current summary. A burst of imports is
+        summarised once and pushed to every subscriber.
+        """
+        self.post([MockData(student_number=0, obtained_marks=10)])
+        streams = [await self.client.get(f"/results/{MockData.test_id}/aggregate/stream") for _ in range(2)]
+        for resp in streams:
+            self.assertEqual(resp.headers["Content-Type"], "text/event-stream")
+            name, summary, version = await read_event(resp)
+            self.assertEqual((name, summary["count"]), ("aggregate", 1))
+
+        recomputations = aggregate_broadcaster.recomputations
+        for i in range(1, 4):
+            self.post([MockData(student_number=i)])
+
+        for resp in streams:
+            name, summary, version = await read_event(resp)
+            self.assertEqual((name, summary["count"]), ("aggregate", 4))
+        self.assertEqual(aggregate_broadcaster.recomputations, recomputations + 1)
+
+    async def test_stream__test_without_scores(self):
+        """
+        A test with no scores yet streams an error, then its first summary.
+        """
+        resp = await self.client.get("/results/42/aggregate/stream")
+        name, data, version = await read_event(resp)
+        self.assertEqual(name, "error")
+        self.assertIsNone(version)
+
+        self.post([MockData(test_id=42)])
+        name, summary, version = await read_event(resp)
+        self.assertEqual((name, summary["count"]), ("aggregate", 1))
+
+    async def test_stream__invalid_test_id(self):
+        resp = await self.client.get("/results/abc/aggregate/stream")
+        self.assertEqual(resp.status, 400)
+
+
+class TestAggregateStreamPolling(IsolatedAsyncioTestCase):
+    """
+    Imports by another process aren't signalled, so the stream server polls
+    aggregate versions when Postgres notifications aren't available.
+    """
+
+    async def asyncSetUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = database_app(f"sqlite:///{os.path.join(self.tmpdir, 'markr.db')}")
+        create_schema(self.app)
+        self.app.config["AGGREGATE_STREAM_DEBOUNCE_SECONDS"] = 0.05
+        self.app.config["AGGREGATE_STREAM_POLL_SECONDS"] = 0.05
+        # A broadcaster of its own, so the import signal doesn't reach it.
+        self.client = test_utils.TestClient(test_utils.TestServer(create_stream_app(self.app, AggregateBroadcaster())))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        with self.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+        shutil.rmtree(self.tmpdir)
+        aggregate_cache.clear()
+
+    async def test_stream__polls_versions(self):
+        with self.app.test_client() as client:
+            client.post("/import", data=gen_input([MockData(student_number=0)]), content_type='text/xml+markr')
+        resp = await self.client.get(f"/results/{MockData.test_id}/aggregate/stream")
+        _, summary, version = await read_event(resp)
+        self.assertEqual(summary["count"], 1)
+
+        with self.app.test_client() as client:
+            client.post("/import", data=gen_input([MockData(student_number=1)]), content_type='text/xml+markr')
+        _, summary, next_version = await read_event(resp)
+        self.assertEqual(summary["count"], 2)
+        self.assertGreater(int(next_version), int(version))
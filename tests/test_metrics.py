@@ -0,0 +1,96 @@
+import contextlib
+import os
+import sys
+import tempfile
+from unittest import TestCase, mock
+from markr import metrics
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.tests.test_import import MockData, gen_input
+
+
+class TestMetrics(TestCase):
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def test_metrics__import_stages(self):
+        """
+        Each import records timings for every stage along with its record and 
+        query counts.
+        """
+        before = {stage: metrics.import_stage_seconds.count(stage=stage) for stage in ("parse", "validate", "upsert", "commit")}
+        records_before = metrics.import_records.count()
+        with app.test_client() as client: 
+            client.post("/import", data=gen_input([MockData(student_number=i) for i in range(5)]), content_type='text/xml+markr')
+            client.get(f"/results/{MockData.test_id}/aggregate")
+            resp = client.get("/metrics")
+
+        for stage, count in before.items():
+            self.assertEqual(metrics.import_stage_seconds.count(stage=stage), count + 1, stage)
+        self.assertEqual(metrics.import_records.count(), records_before + 1)
+        pid = os.getpid()
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f'markr_import_stage_seconds_count{{pid="{pid}",stage="upsert"}}', resp.text)
+        self.assertIn(f'markr_import_queries_bucket{{pid="{pid}",le="10.0"}}', resp.text)
+        self.assertIn(f'markr_aggregate_stage_seconds_count{{pid="{pid}",source="running_aggregate",stage="compute"}}', resp.text)
+        self.assertIn(f'markr_aggregate_cache_misses{{pid="{pid}"}}', resp.text)
+
+    def test_metrics__count_queries(self):
+        """
+        Only statements executed inside the block are counted.
+        """
+        with app.app_context():
+            with metrics.count_queries() as queries:
+                TestScore.query.count()
+                TestScore.query.count()
+            TestScore.query.count()
+        self.assertEqual(queries[0], 2)
+
+    def test_metrics__slow_request_profile(self):
+        """
+        With profiling enabled, requests over the threshold dump a cProfile and 
+        SQL trace.
+        """
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app.config["PROFILE_SLOW_REQUESTS_MS"] = 0.0001
+            app.config["PROFILE_DIR"] = profile_dir
+            try:
+                with app.test_client() as client: 
+                    client.post("/import", data=gen_input([MockData()]), content_type='text/xml+markr')
+            finally:
+                app.config["PROFILE_SLOW_REQUESTS_MS"] = 0
+
+            files = sorted(os.listdir(profile_dir))
+            self.assertEqual(len(files), 2)
+            self.assertTrue(files[0].endswith(".prof"))
+            with open(os.path.join(profile_dir, files[1])) as f:
+                trace = f.read()
+        self.assertIn("POST /import", trace)
+        self.assertIn("INSERT INTO test_scores", trace)
+
+    def test_metrics__profiler_stopped_after_error(self):
+        """
+        A request that raises still has its profiler stopped and its SQL 
+        trace detached, so later statements aren't traced.
+        """
+        app.config["PROFILE_SLOW_REQUESTS_MS"] = 1e9
+        # Re-raised out of the app, so after_request never runs.
+        app.config["PROPAGATE_EXCEPTIONS"] = True
+        try:
+            with mock.patch("markr.app.get_cached_test_score_summary", side_effect=ValueError("boom")):
+                with app.test_client() as client, contextlib.suppress(ValueError):
+                    client.get(f"/results/{MockData.test_id}/aggregate")
+        finally:
+            app.config["PROFILE_SLOW_REQUESTS_MS"] = 0
+            app.config["PROPAGATE_EXCEPTIONS"] = None
+        self.assertIsNone(metrics._sql_trace.get())
+        self.assertIsNone(sys.getprofile())
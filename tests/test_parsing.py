@@ -0,0 +1,183 @@
+import io
+import os
+import json
+import xml.etree.ElementTree as ET
+from unittest import TestCase
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.db.db_helpers import InvalidRecordError, ScoreData, UnexpectedDocumentError, iter_test_results
+from markr.parsing import ParsePoolError, _parse_pool, parse_in_parallel, shutdown_parse_pool, split_test_results
+from markr.tests.test_import import MockData, gen_input, gen_test_result_xml, incomplete_data_test_cases
+
+
+def document(results: str) -> bytes:
+    return f"""<?xml version="1.0" encoding="UTF-8"?>\n<mcq-test-results>{results}</mcq-test-results>""".encode()
+
+
+class TestSplitTestResults(TestCase):
+    def test_split__at_result_boundaries(self):
+        body = gen_input([MockData(student_number=i, answers=3) for i in range(50)]).encode()
+        header, *chunks = split_test_results(io.BytesIO(body), chunk_bytes=1000)
+
+        self.assertEqual(header, b"<mcq-test-results>")
+        self.assertGreater(len(chunks), 5)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith(b"</mcq-test-result>"))
+        self.assertEqual(header + b"".join(chunks) + b"</mcq-test-results>", body)
+
+    def test_split__unexpected_root(self):
+        with self.assertRaises(UnexpectedDocumentError):
+            list(split_test_results(io.BytesIO(b"<results><a/></results>"), 1000))
+
+    def test_split__truncated(self):
+        body = gen_input([MockData(student_number=i) for i in range(5)]).encode()[:-30]
+        with self.assertRaises(ET.ParseError):
+            list(split_test_results(io.BytesIO(body), 1000))
+
+    def test_split__junk_after_root(self):
+        """
+        The document must end with the root's end tag, as when it is parsed
+        on the current thread, though comments and whitespace may follow.
+        """
+        body = gen_input([MockData(student_number=i) for i in range(5)]).encode()
+        for malformed in (body + b"<junk>", body[:-1] + b"XYZ>"):
+            with self.subTest(tail=malformed[-25:]):
+                with self.assertRaises(ET.ParseError):
+                    list(split_test_results(io.BytesIO(malformed), 1000))
+                with self.assertRaises(ET.ParseError):
+                    list(iter_test_results(io.BytesIO(malformed)))
+
+        header, *chunks = split_test_results(io.BytesIO(body + b"\n<!-- end -->\n"), 1000)
+        self.assertEqual(header + b"".join(chunks) + b"</mcq-test-results>", body)
+
+
+class TestParseInParallel(TestCase):
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutdown_parse_pool()
+
+    def test_parallel__matches_serial(self):
+        """
+        Results come back validated and in document order, identical to
+        parsing them on the current thread.
+        """
+        without_timestamp = gen_test_result_xml(MockData(student_number=1000)).replace(
+            f' scanned-on="{MockData.scanned_on}"', ""
+        )
+        body = document(
+            "".join(gen_test_result_xml(MockData(student_number=i, test_id=i % 7, answers=i % 4)) for i in range(200))
+            + without_timestamp
+        )
+        expected = [vars(ScoreData(elem)) for elem in iter_test_results(io.BytesIO(body))]
+        parsed = [vars(sd) for sd in parse_in_parallel(io.BytesIO(body), workers=2, chunk_bytes=4096)]
+
+        self.assertEqual(parsed, expected)
+        self.assertIsNone(parsed[-1]["scanned_on"])
+
+    def test_parallel__end_tags_in_comments_and_cdata(self):
+        """
+        An end tag within a comment, CDATA section or processing 
+        instruction is text, so the upload isn't cut there.
+        """
+        results = []
+        for i in range(60):
+            xml = gen_test_result_xml(MockData(student_number=i, fname=f"<![CDATA[Jane</mcq-test-result>{i}]]>"))
+            results.append(xml.replace("<last-name>", "<!-- </mcq-test-result> --><?note </mcq-test-result> ?><last-name>"))
+        body = document("".join(results) + "<!-- </mcq-test-results> -->")
+        expected = [vars(ScoreData(elem)) for elem in iter_test_results(io.BytesIO(body))]
+        self.assertEqual(expected[7]["first_name"], "Jane</mcq-test-result>7")
+        # Chunk sizes ending within each kind of section.
+        for chunk_bytes in range(200, 700, 50):
+            with self.subTest(chunk_bytes=chunk_bytes):
+                parsed = [vars(sd) for sd in parse_in_parallel(io.BytesIO(body), workers=2, chunk_bytes=chunk_bytes)]
+                self.assertEqual(parsed, expected)
+
+    def test_parallel__first_invalid_result(self):
+        results = [gen_test_result_xml(MockData(student_number=i)) for i in range(100)]
+        results[29] = incomplete_data_test_cases["test_id_missing"]
+        results[69] = incomplete_data_test_cases["no_summary_marks"]
+
+        with self.assertRaises(InvalidRecordError) as cm:
+            list(parse_in_parallel(io.BytesIO(document("".join(results))), workers=2, chunk_bytes=2048))
+        self.assertEqual(cm.exception.record, 30)
+        self.assertEqual(str(cm.exception), "Test result 30: No test ID given")
+
+    def test_parallel__malformed_result(self):
+        results = [gen_test_result_xml(MockData(student_number=i)) for i in range(40)]
+        results[11] = results[11].replace("</last-name>", "</lastname>")
+
+        with self.assertRaises(ET.ParseError) as cm:
+            list(parse_in_parallel(io.BytesIO(document("".join(results))), workers=2, chunk_bytes=2048))
+        self.assertEqual(cm.exception.record, 12)
+
+    def test_parallel__worker_died(self):
+        _parse_pool(2).submit(os._exit, 1).exception()
+        body = document("".join(gen_test_result_xml(MockData(student_number=i)) for i in range(10)))
+        with self.assertRaises(ParsePoolError):
+            list(parse_in_parallel(io.BytesIO(body), workers=2, chunk_bytes=2048))
+        self.assertEqual(len(list(parse_in_parallel(io.BytesIO(body), workers=2, chunk_bytes=2048))), 10)
+
+
+class TestParallelParseImport(TestCase):
+    def setUp(self) -> None:
+        app.config["IMPORT_PARSE_WORKERS"] = 2
+        app.config["IMPORT_PARSE_MIN_BYTES"] = 0
+        app.config["IMPORT_PARSE_CHUNK_BYTES"] = 2048
+
+    def tearDown(self) -> None:
+        app.config["IMPORT_PARSE_WORKERS"] = 0
+        app.config["IMPORT_PARSE_MIN_BYTES"] = 4 * 1024 * 1024
+        app.config["IMPORT_PARSE_CHUNK_BYTES"] = 1024 * 1024
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutdown_parse_pool()
+
+    def test_import__parallel_parse(self):
+        with app.test_client() as client:
+            resp = client.post("/import", data=gen_input([MockData(student_number=i) for i in range(60)]), content_type='text/xml+markr')
+
+        self.assertEqual(json.loads(resp.text), "Added/modified 60 test scores")
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 60)
+
+    def test_import__parallel_parse_all_or_nothing(self):
+        """
+        An invalid result rejects the whole document, even with earlier
+        chunks parsed and written, and is reported by its position.
+        """
+        results = [gen_test_result_xml(MockData(student_number=i)) for i in range(60)]
+        results[49] = incomplete_data_test_cases["available_marks_missing"]
+        with app.test_client() as client:
+            resp = client.post("/import", data=document("".join(results)), content_type='text/xml+markr')
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("Error extracting test data: Test result 50: Available marks not set", resp.text)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 0)
+
+    def test_import__parse_worker_died(self):
+        """
+        A dead parse worker fails only the import it was parsing, with a 
+        503, and the pool is replaced for the next one.
+        """
+        _parse_pool(2).submit(os._exit, 1).exception()
+        body = gen_input([MockData(student_number=i) for i in range(60)])
+        with app.test_client() as client:
+            failed = client.post("/import", data=body, content_type='text/xml+markr')
+            retried = client.post("/import", data=body, content_type='text/xml+markr')
+
+        self.assertEqual(failed.status_code, 503)
+        self.assertEqual(retried.status_code, 200, retried.text)
+        with app.app_context():
+            self.assertEqual(TestScore.query.count(), 60)
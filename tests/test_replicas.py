@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from sqlalchemy import create_engine, delete, insert, select
+from markr import metrics
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.db.db_helpers import compute_test_score_summaries, get_item_analysis, get_test_score_summary
+from markr.replicas import replica_router
+from markr.tests.test_import import MockData, gen_input
+
+
+class TestReplicaRouting(TestCase):
+    """
+    A SQLite file stands in for each replica. Replication is simulated by
+    copying every table across from the primary.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.replicas = [
+            create_engine(f"sqlite:///{os.path.join(self.tmpdir, f'replica{i}.db')}") for i in range(2)
+        ]
+        for engine in self.replicas:
+            db.metadata.create_all(engine)
+
+    def tearDown(self) -> None:
+        replica_router.configure([])
+        for engine in self.replicas:
+            engine.dispose()
+        shutil.rmtree(self.tmpdir)
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def import_mocks(self, mocks):
+        with app.test_client() as client:
+            resp = client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+        self.assertEqual(resp.status_code, 200)
+
+    def replicate(self, replica):
+        with app.app_context():
+            tables = {table: db.session.execute(select(table)).mappings().all() for table in db.metadata.sorted_tables}
+        with replica.begin() as conn:
+            for table in reversed(db.metadata.sorted_tables):
+                conn.execute(delete(table))
+            for table, rows in tables.items():
+                if rows:
+                    conn.execute(insert(table), [dict(row) for row in rows])
+
+    def test_replicas__reads_routed_to_replica(self):
+        """
+        Reads are served by the replica, even while it lags the primary.
+        """
+        replica_router.configure(self.replicas[:1], read_your_writes=0)
+        self.import_mocks([MockData(student_number=i, answers=2) for i in range(3)])
+        self.replicate(self.replicas[0])
+        self.import_mocks([MockData(student_number=i, answers=2) for i in range(3, 5)])
+
+        with app.app_context():
+            self.assertEqual(get_test_score_summary(MockData.test_id)["count"], 3)
+            summaries, _ = compute_test_score_summaries([MockData.test_id])
+            self.assertEqual(summaries[MockData.test_id]["count"], 3)
+            self.assertEqual(get_item_analysis(MockData.test_id)["count"], 3)
+
+    def test_replicas__read_your_writes(self):
+        """
+        Tests written by a recent import are read from the primary, others
+        from the replica.
+        """
+        replica_router.configure(self.replicas[:1], read_your_writes=60)
+        self.import_mocks([MockData(student_number=i, test_id=2) for i in range(4)])
+        self.replicate(self.replicas[0])
+        # Reconfiguring forgets recent writes, as if test 2's window had passed.
+        replica_router.configure(self.replicas[:1], read_your_writes=60)
+        self.import_mocks([MockData(student_number=i) for i in range(3)])
+
+        with app.app_context():
+            # The replica has no scores for this test yet.
+            self.assertEqual(get_test_score_summary(MockData.test_id)["count"], 3)
+            replica_reads = metrics.db_reads_total.value(target="replica")
+            self.assertEqual(get_test_score_summary(2)["count"], 4)
+            self.assertEqual(metrics.db_reads_total.value(target="replica"), replica_reads + 1)
+
+    def test_replicas__round_robin(self):
+        replica_router.configure(self.replicas, read_your_writes=0)
+        self.import_mocks([MockData(student_number=0)])
+        self.replicate(self.replicas[0])
+        self.import_mocks([MockData(student_number=1)])
+        self.replicate(self.replicas[1])
+
+        with app.app_context():
+            counts = [get_test_score_summary(MockData.test_id)["count"] for _ in range(4)]
+        self.assertEqual(counts, [1, 2, 1, 2])
+
+    def test_replicas__failover(self):
+        """
+        A replica that can't be reached is skipped, falling back to the
+        primary when no replica is left.
+        """
+        unreachable = create_engine(f"sqlite:///{os.path.join(self.tmpdir, 'missing', 'replica.db')}")
+        replica_router.configure([unreachable, self.replicas[0]], read_your_writes=0, retry_after=60)
+        self.import_mocks([MockData(student_number=0)])
+        self.replicate(self.replicas[0])
+        self.import_mocks([MockData(student_number=1)])
+
+        with app.app_context():
+            self.assertEqual(get_test_score_summary(MockData.test_id)["count"], 1)
+            self.assertFalse(replica_router.healthy(unreachable))
+
+            replica_router.configure([unreachable], read_your_writes=0)
+            self.assertEqual(get_test_score_summary(MockData.test_id)["count"], 2)
@@ -0,0 +1,186 @@
+import os
+import random
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+from sqlalchemy import event
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.db.db_helpers import _read_test_score_summary, get_test_score_summary
+from markr.scorestore import ScoreStore, score_store
+from markr.tests.test_import import MockData, gen_input
+
+
+def post(mocks):
+    with app.test_client() as client:
+        resp = client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+    assert resp.status_code == 200, resp.text
+
+
+class TestScoreStore(TestCase):
+    def setUp(self) -> None:
+        rng = random.Random(0)
+        post([
+            MockData(student_number=i, test_id=test_id, available_marks=40, obtained_marks=rng.randrange(41))
+            for test_id in (1, 2, 3)
+            for i in range(200)
+        ])
+        score_store.configure(1024 * 1024, verify_after=60, min_reads=1)
+
+    def tearDown(self) -> None:
+        score_store.configure(0)
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def count_statements(self, read) -> int:
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+            event.listen(engine, "before_cursor_execute", count_statement)
+            try:
+                read()
+            finally:
+                event.remove(engine, "before_cursor_execute", count_statement)
+        return len(statements)
+
+    def assert_matches_aggregate(self, test_id: int):
+        with app.app_context():
+            stored = get_test_score_summary(test_id)
+            expected, _ = _read_test_score_summary(db.session, test_id)
+        self.assertEqual(stored, expected)
+
+    def test_store__serves_hot_tests_from_memory(self):
+        """
+        Once loaded, a test is summarised without touching the database,
+        exactly as from its running aggregate.
+        """
+        self.count_statements(lambda: get_test_score_summary(1))
+        self.assertEqual(score_store.size(), 1)
+        self.assertEqual(self.count_statements(lambda: get_test_score_summary(1)), 0)
+        self.assert_matches_aggregate(1)
+
+        with app.app_context():
+            stored = score_store.get(1)
+        self.assertEqual(stored.scores.dtype, np.int32)
+        self.assertTrue(np.all(np.diff(stored.scores) >= 0))
+
+    def test_store__waits_for_hot_tests(self):
+        score_store.configure(1024 * 1024, min_reads=3)
+        with app.app_context():
+            self.assertIsNone(score_store.get(1))
+            self.assertIsNone(score_store.get(1))
+            self.assertIsNotNone(score_store.get(1))
+
+    def test_store__kept_in_sync_by_imports(self):
+        with app.app_context():
+            get_test_score_summary(2)
+        post([MockData(student_number=i, test_id=2, available_marks=40, obtained_marks=40) for i in range(190, 210)])
+
+        with app.app_context():
+            version = db.session.get(TestAggregate, 2).version
+        self.assertEqual(score_store.get(2).version, version)
+        self.assertEqual(self.count_statements(lambda: get_test_score_summary(2)), 0)
+        self.assert_matches_aggregate(2)
+        self.assertEqual(get_test_score_summary(2)["count"], 210)
+
+    def test_store__notices_imports_by_other_processes(self):
+        """
+        A test whose aggregate version has changed without this process
+        hearing of it is reloaded once its version is checked.
+        """
+        score_store.configure(1024 * 1024, verify_after=0, min_reads=1)
+        with app.app_context():
+            get_test_score_summary(3)
+            db.session.add(Student(id=1000, fname="Jane", lname="Austen"))
+            db.session.add(TestScore(test_id=3, student_id=1000, score=0))
+            agg = db.session.get(TestAggregate, 3)
+            agg.count += 1
+            agg.histogram = {**agg.histogram, "0": agg.histogram.get("0", 0) + 1}
+            agg.min_score = 0
+            agg.version += 1
+            db.session.commit()
+
+            self.assertEqual(get_test_score_summary(3)["count"], 201)
+            self.assertEqual(score_store.get(3).version, agg.version)
+        self.assert_matches_aggregate(3)
+
+    def test_store__conditional_get_sees_other_processes(self):
+        """
+        A stored test imported to by another process isn't served at its 
+        old version, even before it is next verified, once the aggregate 
+        cache has read its new version.
+        """
+        with app.test_client() as client:
+            etag = client.get("/results/3/aggregate").headers["ETag"]
+            with app.app_context():
+                db.session.add(Student(id=1000, fname="Jane", lname="Austen"))
+                db.session.add(TestScore(test_id=3, student_id=1000, score=0))
+                agg = db.session.get(TestAggregate, 3)
+                agg.count += 1
+                agg.histogram = {**agg.histogram, "0": agg.histogram.get("0", 0) + 1}
+                agg.min_score = 0
+                agg.version += 1
+                db.session.commit()
+                version = agg.version
+            resp = client.get("/results/3/aggregate", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["ETag"], f'"3-{version}"')
+        self.assertEqual(resp.json["count"], 201)
+        with app.app_context():
+            self.assertEqual(score_store.get(3).version, version)
+
+    def test_store__evicts_cold_tests(self):
+        # Room for two tests of 200 scores.
+        score_store.configure(2 * 200 * 4, min_reads=1)
+        with app.app_context():
+            for test_id in (1, 2, 1, 3):
+                get_test_score_summary(test_id)
+        self.assertEqual(score_store.size(), 2)
+        self.assertEqual(score_store.evictions, 1)
+        self.assertLessEqual(score_store.nbytes(), 2 * 200 * 4)
+        with app.app_context():
+            self.assertIsNotNone(score_store.get(1))
+            self.assertIsNotNone(score_store.get(3))
+
+    def test_store__warm_restart_from_snapshot(self):
+        """
+        A restarted worker maps the snapshot, and only reloads tests
+        imported to since it was written.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        score_store.configure(1024 * 1024, snapshot_dir=tmpdir, min_reads=1)
+        with app.app_context():
+            for test_id in (1, 2, 3):
+                get_test_score_summary(test_id)
+        self.assertEqual(score_store.snapshot(), 3)
+        self.assertEqual(score_store.snapshot(), 0)
+        post([MockData(student_number=500, test_id=2, available_marks=40, obtained_marks=1)])
+
+        restarted = ScoreStore()
+        restarted.configure(1024 * 1024, snapshot_dir=tmpdir, min_reads=1)
+        with app.app_context():
+            self.assertEqual(restarted.load_snapshot(), 2)
+            self.assertIsInstance(restarted.get(1).scores, np.memmap)
+            self.assertNotIsInstance(restarted.get(2).scores, np.memmap)
+            self.assertEqual(len(restarted.get(2).scores), 201)
+            for test_id in (1, 2, 3):
+                self.assertEqual(restarted.get(test_id).version, db.session.get(TestAggregate, test_id).version)
+
+        # The refreshed test's newer snapshot replaces its old one.
+        score_store.snapshot()
+        self.assertEqual(len([name for name in os.listdir(tmpdir) if name.startswith("test-2-")]), 1)
@@ -0,0 +1,90 @@
+import json
+from unittest import TestCase
+from sqlalchemy import event
+from markr.app import app
+from markr.cache import aggregate_cache
+from markr.db.db_helpers import get_student_results
+from markr.db.models import ImportFingerprint, RecordFingerprint, TestAggregate, TestScore, Student, Test, db
+from markr.tests.test_import import MockData, gen_input
+
+
+class TestStudentResults(TestCase):
+    def setUp(self) -> None:
+        # Test 1: scores of 5, 10, 10, 15 and 20 out of 20. Test 2: 10 and 16 out of 20.
+        mocks = [
+            MockData(student_number=i, test_id=1, available_marks=20, obtained_marks=marks)
+            for i, marks in enumerate([5, 10, 10, 15, 20])
+        ] + [
+            MockData(student_number=1, test_id=2, available_marks=20, obtained_marks=16),
+            MockData(student_number=2, test_id=2, available_marks=20, obtained_marks=10),
+        ]
+        with app.test_client() as client:
+            client.post("/import", data=gen_input(mocks), content_type='text/xml+markr')
+
+    def tearDown(self) -> None:
+        with app.app_context():
+            TestAggregate.query.delete()
+            Student.query.delete()
+            Test.query.delete()
+            TestScore.query.delete()
+            ImportFingerprint.query.delete()
+            RecordFingerprint.query.delete()
+            db.session.commit()
+        aggregate_cache.clear()
+
+    def get(self, student_id):
+        with app.test_client() as client:
+            return client.get(f"/students/{student_id}/results")
+
+    def test_student_results(self):
+        resp = self.get(1)
+
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.text)
+        self.assertEqual(data["student_id"], 1)
+        self.assertEqual((data["first_name"], data["last_name"]), (MockData.fname, MockData.lname))
+        self.assertEqual(
+            [(r["test_id"], r["score"], r["available_marks"], r["percent_score"]) for r in data["results"]],
+            [(1, 10, 20, 50.0), (2, 16, 20, 80.0)],
+        )
+        # One score below and two (including their own) equal out of five, then one below out of two.
+        self.assertEqual([r["percentile_rank"] for r in data["results"]], [40.0, 75.0])
+        self.assertTrue(data["results"][0]["scanned_on"].endswith("+00:00"))
+
+    def test_student_results__ranks_follow_imports(self):
+        with app.test_client() as client:
+            client.post(
+                "/import",
+                data=gen_input([MockData(student_number=9, test_id=2, available_marks=20, obtained_marks=18)]),
+                content_type='text/xml+markr',
+            )
+        data = json.loads(self.get(1).text)
+        self.assertEqual(data["results"][1]["percentile_rank"], round(1.5 / 3 * 100, 2))
+
+    def test_student_results__single_query(self):
+        """
+        Ranks for all of the student's tests are read in one statement.
+        """
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+            event.listen(engine, "before_cursor_execute", count_statement)
+            try:
+                get_student_results(2)
+            finally:
+                event.remove(engine, "before_cursor_execute", count_statement)
+        self.assertEqual(len(statements), 1)
+
+    def test_student_results__unknown_student(self):
+        resp = self.get(12345)
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("No student found with student ID 12345", resp.text)
+
+    def test_student_results__invalid_id(self):
+        resp = self.get("abc")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("Invalid student id supplied. Must be an integer", resp.text)